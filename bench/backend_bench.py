@@ -0,0 +1,95 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Compare DataAccessLayer backends on the statements the poll/hello path runs.
+
+  Backends:
+      local     SQLite stand-in (helper/local_rdsdata.py); --latency emulates the Data API round trip
+      data-api  boto3 'rds-data' against DB_CLUSTER_ARN / DB_CRED_SECRETS_STORE_ARN / DB_NAME
+      mysql     helper/mysql_client.py against DB_HOST (RDS Proxy) with the same secret or DB_USER/DB_PASSWORD
+
+  data-api and mysql expect the StripCall schema and a user whose Cognito sub is --sub.
+
+  Usage:
+      python bench/backend_bench.py --backend local --latency 0.03
+      python bench/backend_bench.py --backend data-api --backend mysql --sub <cognito sub>
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault('IDENTITY_CACHE_TTL', '0') # measure the database, not the cache
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+from helper.dal import DataAccessLayer  # noqa: E402
+
+FIXTURES = """
+INSERT INTO users(user_id, user_name, full_name, allowed_roles, sub, email, mobile) VALUES
+    (1001, 'system', 'System', 'ARM', NULL, NULL, NULL),
+    (1, 'benchA', 'Bench Armorer', 'ARM', 'bench-sub', 'bench@example.com', '5550000001');
+INSERT INTO events VALUES (1, 'Bench', 'NAC', '2020-01-01 00:00:00', '2099-01-01 00:00:00', 1, '5551234567');
+INSERT INTO crews(event_id, crew_type, user_id, sms) VALUES (1, 'ARM', 1, 0);
+"""
+
+
+def make_client(backend, latency):
+    if backend == 'local':
+        from helper.local_rdsdata import LocalRDSDataClient
+        client = LocalRDSDataClient(latency=latency)
+        client.executescript(FIXTURES)
+        return client
+    if backend == 'mysql':
+        from helper.mysql_client import MySQLDataClient
+        return MySQLDataClient(secret_arn=os.getenv('DB_CRED_SECRETS_STORE_ARN'))
+    import boto3
+    return boto3.client('rds-data')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1, int(fraction*len(ordered)))]
+
+
+def run(backend, sub, iterations, latency):
+    client = make_client(backend, latency)
+    dal = DataAccessLayer(os.getenv('DB_NAME'), os.getenv('DB_CLUSTER_ARN'), os.getenv('DB_CRED_SECRETS_STORE_ARN'),
+        rdsdata_client=client)
+    with contextlib.redirect_stdout(io.StringIO()): # the DAL's debug prints
+        user_id = dal.check_user(sub)[0] # also opens the first connection, outside the timings
+    operations = [
+        ('select_1', lambda: dal.probe()),
+        ('check_user', lambda: dal.check_user(sub)),
+        ('get_event_and_crew', lambda: dal.get_event_and_crew(user_id)),
+        ('tourney', lambda: dal.tourney()),
+        ('poll_user', lambda: dal.poll_user(sub)),
+    ]
+    print(f'{backend}: {iterations} iterations')
+    print(f'  {"operation":<20}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}')
+    for name, operation in operations:
+        samples = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(iterations):
+                start = time.perf_counter()
+                operation()
+                samples.append((time.perf_counter() - start) * 1000)
+        print(f'  {name:<20}{statistics.mean(samples):>10.2f}{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.95):>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', action='append', choices=['local', 'data-api', 'mysql'],
+        help='repeat to compare several (default: local)')
+    parser.add_argument('--sub', default='bench-sub', help='Cognito sub of an existing user')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='per-call seconds added by the local backend')
+    args = parser.parse_args()
+    for backend in args.backend or ['local']:
+        run(backend, args.sub, args.iterations, args.latency)
+
+
+if __name__ == '__main__':
+    main()
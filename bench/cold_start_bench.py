@@ -0,0 +1,154 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Cold-start cost of every Lambda entry point.
+
+  Each handler is imported in a fresh interpreter (a child run of this script)
+  against a copy of the same SQLite fixture database (helper/local_rdsdata.py), and
+  the child reports:
+      import      ms to import the handler module (its Lambda init phase)
+      first       ms for the first invocation, which builds the database client
+      warm        ms for a second invocation in the same process
+      modules     modules the import added to sys.modules
+      heavy       which of boto3, botocore, requests, aws_xray_sdk, twilio got imported
+  Handlers that need live AWS services (S3, CloudWatch Events, RDS) are only imported.
+  Every number is the median of --runs fresh processes.
+
+  Usage:
+      python bench/cold_start_bench.py [--runs 5] [--handler poll --handler hello]
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+LAMBDAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas')
+HEAVY = ['boto3', 'botocore', 'requests', 'aws_xray_sdk', 'twilio']
+
+FIXTURES = """
+INSERT INTO users(user_id, user_name, full_name, allowed_roles, sub, email, mobile) VALUES
+    (1001, 'system', 'System', 'ARM', NULL, NULL, NULL),
+    (1, 'benchA', 'Bench Armorer', 'ARM', 'bench-sub', 'bench@example.com', '5550000001'),
+    (2, 'benchB', 'Bench Referee', 'ARM,REF', 'bench-sub2', 'ref@example.com', '5550000002');
+INSERT INTO events VALUES (1, 'Bench', 'NAC', '2020-01-01 00:00:00', '2099-01-01 00:00:00', 1, '5551234567');
+INSERT INTO events VALUES (2001, 'Test', 'TEST', '2020-01-01 00:00:00', '2099-01-01 00:00:00', 1, '5559999999');
+INSERT INTO crews(event_id, crew_type, user_id, sms) VALUES (1, 'ARM', 1, 0), (1, 'ARM', 2, 1);
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc)
+    VALUES (1, 1, 'ARM', 'A1', 'A00', 1, '2020-01-01 00:00:00');
+INSERT INTO boards(event_id, crew_type, version) VALUES (1, 'ARM', 1);
+INSERT INTO board_problems(event_id, crew_type, problem_id, strip, problem_type, reporter) VALUES (1, 'ARM', 1, 'A1', 'A00', 'benchA');
+INSERT INTO messages(message_id, event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc)
+    VALUES (1, 1, 'ARM', 1, 'on my way', 2, '2020-01-01 00:00:00');
+INSERT INTO receipts(event_id, problem_id, message_id, recipient_id) VALUES (1, 1, 1, 1);
+"""
+
+
+def api_event(body=None, sub='bench-sub'):
+    event = {'requestContext': {'authorizer': {'claims': {'sub': sub}}}, 'queryStringParameters': None}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return event
+
+
+# handler module -> sample event, or None to measure the import only
+HANDLERS = {
+    'check_email': {'body': json.dumps({'auth_code': '3cb6a0a2-deac-47a9-bb60-1d8d6d3386dc', 'email': 'bench@example.com'})},
+    'cog_new_user': {'request': {'userAttributes': {'sub': 'bench-sub', 'email': 'bench@example.com'}}},
+    'create_problem': api_event({'crew_type': 'ARM', 'strip': 'B2', 'problem_type': 'A00'}),
+    'hello': api_event(),
+    'incoming_sms': {'body': 'To=%2B15551234567&From=%2B15550000002&Body=on+my+way',
+        'headers': {'X-Twilio-Signature': 'bench', 'Host': 'localhost'}, 'requestContext': {'path': '/sms'}},
+    'keepalive': {},
+    'load_csv': None,
+    'message': api_event({'problem_id': 1, 'message_text': 'bench'}, sub='bench-sub2'),
+    'outbox_worker': {},
+    'poll': api_event(),
+    'receipt': api_event({'message_id': 1}),
+    'resolve_problem': api_event({'problem_id': 1, 'resolution_code': 1}),
+    'router': dict(api_event(), httpMethod='GET', resource='/stripcall/poll/'),
+    'set_crew': api_event({'event_id': 1, 'push_token': 'bench'}),
+    'update_problem': api_event({'problem_id': 1, 'crew_type': 'ARM', 'strip': 'C3', 'problem_type': 'A00'}),
+    'wakeup': None,
+}
+
+
+def child(name):
+    # runs in a fresh interpreter: everything imported here counts against the handler
+    sys.path.insert(0, LAMBDAS)
+    before = set(sys.modules)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        imported = time.perf_counter()
+        first = warm = None
+        event = HANDLERS[name]
+        if event is not None:
+            module.handler(event, None)
+            first = time.perf_counter() - imported
+            start_warm = time.perf_counter()
+            module.handler(event, None)
+            warm = time.perf_counter() - start_warm
+    added = set(sys.modules) - before
+    print(json.dumps({
+        'import': (imported - start) * 1000,
+        'first': first * 1000 if first is not None else None,
+        'warm': warm * 1000 if warm is not None else None,
+        'modules': len(added),
+        'heavy': [module for module in HEAVY if module in added],
+    }))
+
+
+def fixture_database(directory):
+    sys.path.insert(0, LAMBDAS)
+    from helper.local_rdsdata import LocalRDSDataClient
+    path = os.path.join(directory, 'fixture.sqlite')
+    LocalRDSDataClient(path).executescript(FIXTURES)
+    return path
+
+
+def run_child(name, fixture, directory):
+    database = os.path.join(directory, f'{name}.sqlite')
+    shutil.copyfile(fixture, database) # every run starts from the same rows
+    env = dict(os.environ, LOCAL_RDSDATA_PATH=database, METRICS='off', NOTIFY_MODE='outbox', LOG_LEVEL='WARNING')
+    env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+    env.pop('OUTBOX_WORKER_FUNCTION', None)
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name], env=env,
+        capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median(samples):
+    samples = [sample for sample in samples if sample is not None]
+    return statistics.median(samples) if samples else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--handler', action='append', choices=sorted(HANDLERS), help='repeat to pick several (default: all)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        fixture = fixture_database(directory)
+        print(f'median of {args.runs} fresh processes, ms')
+        print(f'  {"handler":<18}{"import":>9}{"first":>9}{"warm":>9}{"modules":>9}  heavy')
+        for name in args.handler or sorted(HANDLERS):
+            results = [run_child(name, fixture, directory) for _ in range(args.runs)]
+            cells = [median([result[key] for result in results]) for key in ('import', 'first', 'warm')]
+            print(f'  {name:<18}' + ''.join(f'{cell:>9.1f}' if cell is not None else f'{"-":>9}' for cell in cells)
+                + f'{results[-1]["modules"]:>9}  {",".join(results[-1]["heavy"]) or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Decode cost per 1,000 rows for the registered queries.
+
+  For each query it times:
+      before      the hand-written per-row dict comprehension the DAL used to have
+      rows        Query.rows(): the typed records into namedtuple rows
+      json        Query.decode() of a formatRecordsAs='JSON' response
+  once on already-parsed records (decode only) and once from the raw response body,
+  since the typed records also cost more for botocore to parse off the wire, and
+  the size of one decoded row as a dict versus a row tuple.
+
+  Usage:
+      python bench/decode_bench.py [--rows 1000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+from helper.dal import QUERIES  # noqa: E402
+
+SAMPLES = {
+    'tourney': (1, 'Summer Nationals', 'NAC', '2020-07-01 12:00:00', '2020-07-10 23:00:00', 1),
+    'board': (1, 1, 'A1', 'A00', 'fencer'),
+    'unread_messages': (1, 1, 'bob: on my way'),
+    'old_events': (1, 1),
+}
+
+
+def typed_field(value):
+    if isinstance(value, int):
+        return {'longValue': value}
+    return {'stringValue': value}
+
+
+def before_decoder(columns):
+    # what the DAL's list comprehensions did: a dict literal indexing each record by position
+    keys = [next(iter(typed_field(value))) for value in columns.values()]
+    names = list(columns)
+    source = '[{' + ', '.join(f'{name!r}: record[{i}][{key!r}]' for i, (name, key) in enumerate(zip(names, keys))) + \
+        '} for record in records]'
+    return eval(f'lambda records: {source}')
+
+
+def bench(number, function):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+    per = 1000 / args.rows
+    print(f'microseconds per 1,000 rows ({args.rows} rows per response)')
+    print(f'  {"query":<18}{"before":>10}{"rows":>10}{"json":>10}{"before+parse":>15}{"rows+parse":>12}{"json+parse":>12}'
+        f'{"dict B":>9}{"row B":>8}')
+    for name, sample in SAMPLES.items():
+        query = QUERIES[name]
+        records = [[typed_field(i if isinstance(value, int) else value) for value in sample] for i in range(args.rows)]
+        formatted = json.dumps([dict(zip(query.columns, [next(iter(field.values())) for field in record]))
+            for record in records])
+        typed_body = json.dumps({'numberOfRecordsUpdated': 0, 'records': records})
+        json_body = json.dumps({'numberOfRecordsUpdated': 0, 'formattedRecords': formatted})
+        before = before_decoder(dict(zip(query.columns, sample)))
+        number = max(1, 20000 // args.rows)
+        timings = [
+            bench(number, lambda: before(records)),
+            bench(number, lambda: query.rows(records)),
+            bench(number, lambda: query.decode({'formattedRecords': formatted})),
+            bench(number, lambda: before(json.loads(typed_body)['records'])),
+            bench(number, lambda: query.rows(json.loads(typed_body)['records'])),
+            bench(number, lambda: query.decode(json.loads(json_body))),
+        ]
+        sizes = f'{sys.getsizeof(before(records[:1])[0]):>9}{sys.getsizeof(query.rows(records[:1])[0]):>8}'
+        print(f'  {name:<18}' + ''.join(f'{timing*per:>{width}.0f}' for timing, width in zip(timings, (10, 10, 10, 15, 12, 12)))
+            + sizes)
+
+
+if __name__ == '__main__':
+    main()
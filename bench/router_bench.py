@@ -0,0 +1,183 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Per-function API layout versus router.py behind every route.
+
+  First the cold costs are measured locally, as median of --runs fresh processes
+  against the SQLite fixture of cold_start_bench.py:
+      per-function   import + first invocation of each handler in its own process
+      router         import of router.py + first poll, then the first hit of every
+                     other route in that already-warm container
+  Then a tournament is replayed: Poisson arrivals per endpoint at --rate requests
+  per minute for --minutes, where a container is reclaimed after --idle seconds
+  without a request (one container per function; concurrent requests are not
+  modelled).  A per-function endpoint is cold whenever its own function went idle;
+  under the router only a request arriving after the whole API went idle starts a
+  container, and a route's first hit in a container pays only its module import.
+
+  Usage:
+      python bench/router_bench.py [--minutes 240] [--idle 420] [--rate message=2 --rate poll=60]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from cold_start_bench import HANDLERS, LAMBDAS, fixture_database, median, run_child
+
+ROUTES = {
+    'poll': 'GET',
+    'hello': 'GET',
+    'create_problem': 'POST',
+    'message': 'POST',
+    'resolve_problem': 'POST',
+    'update_problem': 'POST',
+    'receipt': 'POST',
+    'set_crew': 'POST',
+    'incoming_sms': 'POST',
+    'check_email': 'POST',
+}
+# requests per minute across a tournament's crews: every app polls, few people type
+RATES = {
+    'poll': 120.0,
+    'receipt': 4.0,
+    'message': 1.0,
+    'create_problem': 0.5,
+    'resolve_problem': 0.5,
+    'incoming_sms': 0.2,
+    'hello': 0.2,
+    'update_problem': 0.1,
+    'set_crew': 0.1,
+    'check_email': 0.02,
+}
+
+
+def routed_event(name):
+    return dict(HANDLERS[name], httpMethod=ROUTES[name], resource=f'/stripcall/{name}/')
+
+
+def child_router():
+    # runs in a fresh interpreter: router init + first poll, then the first hit of every other route
+    sys.path.insert(0, LAMBDAS)
+    costs = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        import router
+        costs['import'] = (time.perf_counter() - start) * 1000
+        for name in ROUTES:
+            start = time.perf_counter()
+            response = router.handler(routed_event(name), None)
+            costs[name] = (time.perf_counter() - start) * 1000
+            if response.get('statusCode') in (404, 405):
+                raise RuntimeError(f'router has no route for {name}')
+    print(json.dumps(costs))
+
+
+def measure(runs):
+    with tempfile.TemporaryDirectory() as directory:
+        fixture = fixture_database(directory)
+        per_function = {}
+        for name in ROUTES:
+            results = [run_child(name, fixture, directory) for _ in range(runs)]
+            per_function[name] = median([result['import'] + result['first'] for result in results])
+        results = []
+        for _ in range(runs):
+            database = os.path.join(directory, 'router.sqlite')
+            shutil.copyfile(fixture, database)
+            env = dict(os.environ, LOCAL_RDSDATA_PATH=database, METRICS='off', NOTIFY_MODE='outbox', LOG_LEVEL='WARNING')
+            env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+            env.pop('OUTBOX_WORKER_FUNCTION', None)
+            env.pop('ROUTER_PRELOAD', None)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child-router'], env=env,
+                capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        router = {key: median([result[key] for result in results]) for key in results[0]}
+    return per_function, router
+
+
+def arrivals(rates, minutes, seed):
+    generator = random.Random(seed)
+    requests = []
+    for name, rate in rates.items():
+        if rate <= 0:
+            continue
+        at = generator.expovariate(rate / 60)
+        while at < minutes * 60:
+            requests.append((at, name))
+            at += generator.expovariate(rate / 60)
+    return sorted(requests)
+
+
+def replay(requests, idle, per_function, router):
+    # added cold latency per request (ms) under each layout
+    added = {'per-function': [], 'router': []}
+    last_seen = {}
+    router_last = None
+    router_loaded = set()
+    for at, name in requests:
+        cold = name not in last_seen or at - last_seen[name] > idle
+        added['per-function'].append((name, per_function[name] if cold else 0.0))
+        last_seen[name] = at
+        if router_last is None or at - router_last > idle:
+            router_loaded = {name}
+            added['router'].append((name, router['import'] + router['poll'] + (router[name] if name != 'poll' else 0.0)))
+        elif name not in router_loaded:
+            router_loaded.add(name)
+            added['router'].append((name, router[name]))
+        else:
+            added['router'].append((name, 0.0))
+        router_last = at
+    return added
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1, int(fraction*len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--minutes', type=float, default=240)
+    parser.add_argument('--idle', type=float, default=420, help='seconds before an idle container is reclaimed')
+    parser.add_argument('--rate', action='append', default=[], metavar='ROUTE=PER_MINUTE')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--child-router', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child_router:
+        child_router()
+        return
+    rates = dict(RATES)
+    for rate in args.rate:
+        name, per_minute = rate.split('=')
+        if name not in ROUTES:
+            parser.error(f'unknown route {name}')
+        rates[name] = float(per_minute)
+    per_function, router = measure(args.runs)
+    print(f'cold cost, ms (median of {args.runs} fresh processes)')
+    print(f'  {"route":<18}{"per-function":>14}{"router hit":>12}')
+    for name in ROUTES:
+        print(f'  {name:<18}{per_function[name]:>14.1f}{router[name]:>12.1f}')
+    print(f'  router import {router["import"]:.1f}, first poll {router["poll"]:.1f}')
+    requests = arrivals(rates, args.minutes, args.seed)
+    added = replay(requests, args.idle, per_function, router)
+    print(f'\n{len(requests)} requests over {args.minutes:.0f} minutes, containers reclaimed after {args.idle:.0f} s idle')
+    print(f'  {"layout":<14}{"cold hits":>10}{"cold ms":>10}{"p99 ms":>9}{"message cold":>14}{"message mean ms":>17}')
+    for layout, samples in added.items():
+        latencies = [latency for _, latency in samples]
+        message = [latency for name, latency in samples if name == 'message']
+        print(f'  {layout:<14}{sum(1 for latency in latencies if latency > 0):>10}{sum(latencies):>10.0f}'
+            f'{percentile(latencies, 0.99):>9.1f}{sum(1 for latency in message if latency > 0):>8}/{len(message):<5}'
+            f'{statistics.mean(message) if message else 0:>17.2f}')
+
+
+if __name__ == '__main__':
+    main()
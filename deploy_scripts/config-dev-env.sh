@@ -32,6 +32,7 @@ export db_subnet_3="subnet-495dcb77"
 # ----- API Stack ----- #
 export api_stage_name="dev"
 export log_level="DEBUG"  # debug/info/error
+export api_layout="per-function"  # per-function/router (one Lambda behind every API route)
 
 # ---------------------------------------------------------------
 
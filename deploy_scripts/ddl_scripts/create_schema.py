@@ -1,42 +1,239 @@
-import boto3
-import json
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Versioned schema migrations, and an EXPLAIN check of the hot queries.
+
+  Every migration in MIGRATIONS runs once, in order, and is recorded in the
+  schema_migrations table, so the script is safe to re-run against a live
+  database.  Version 1 is the table_*.txt files (CREATE TABLE IF NOT EXISTS);
+  version 2 adds indexes online (ALGORITHM=INPLACE, LOCK=NONE), skipping any
+  index that information_schema says is already there; version 3 creates and
+  fills the open-problem boards.
+
+  --check runs EXPLAIN for every query in HOT_QUERIES (names from the DAL's query
+  registry) and exits non-zero when one of them reads a whole table.  With
+  LOCAL_RDSDATA_PATH set the check runs EXPLAIN QUERY PLAN against that SQLite
+  file as it is; the stand-in (helper/local_rdsdata.py) creates its schema,
+  every migration included, itself.
+
+  Usage:
+      rds_stack_name=<stack> python create_schema.py [--check]
+      LOCAL_RDSDATA_PATH=/tmp/stripcall.sqlite python create_schema.py --check
+"""
+import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambdas'))
+
+LOCAL_RDSDATA_PATH = os.getenv('LOCAL_RDSDATA_PATH')
+
+table_ddl_script_files = ['table_users.txt', 'table_events.txt', 'table_crews.txt', 'table_problems.txt', 'table_messages.txt', 'table_receipts.txt', 'table_topics.txt', 'table_outbox.txt']
+
+MIGRATIONS_TABLE_DDL = """CREATE TABLE IF NOT EXISTS schema_migrations (
+    version MEDIUMINT NOT NULL,
+    description VARCHAR(100) NOT NULL,
+    applied_time_utc DATETIME NOT NULL,
+    PRIMARY KEY (version)
+)"""
+
+# (table, index, columns) added by migration 2.  The trailing columns make the poll lookups covering:
+# the unread join reads message_id from the receipt index, the crew lookups read crew_type from theirs.
+HOT_PATH_INDEXES = [
+    ('users', 'email_idx', 'email'), # check_email, insert_email, insert_sub
+    ('events', 'arm_tn_idx', 'arm_tn'), # sms_incoming
+    ('problems', 'event_crew_resolution_idx', 'event_id, crew_type, resolution_code'), # poll: open problems
+    ('receipts', 'recipient_time_idx', 'recipient_id, receipt_time_utc, message_id'), # poll: unread messages
+    ('crews', 'user_event_idx', 'user_id, event_id, crew_type'), # poll, get_event_and_crew, add_crew
+]
+
+# registered query -> sample parameter values for its EXPLAIN
+HOT_QUERIES = {
+    'check_user': {'sub': 'explain-sub'},
+    'active_crew': {'user_id': 1},
+    'check_email': {'email': 'explain@example.com'},
+    'insert_sub': {'email': 'explain@example.com', 'sub': 'explain-sub'},
+    'event_by_tn': {'tn': '5550000000'},
+    'poll_user': {'sub': 'explain-sub'},
+    'poll_user_since': {'sub': 'explain-sub', 'since': '2020-01-01 00:00:00'},
+    'board': {'event': 1, 'crew': 'ARM'},
+    'unread_messages': {'event': 1, 'crew': 'ARM', 'user': 1},
+    'receipt': {'message': 1, 'user': 1},
+    'hello': {'event': 1, 'user': 1},
+    'find_crew': {'event': 1, 'user': 1},
+    'outbox_due': {'now': '2020-01-01 00:00:00', 'max': 5, 'limit': 25}, # every outbox_worker sweep
+    'outbox_claimed': {'claim': 'explain-claim'},
+}
+
 
 def get_cfn_output(key, outputs):
     result = [ v['OutputValue'] for v in outputs if v['OutputKey'] == key ]
     return result[0] if len(result) > 0 else ''
 
-# Retrieve required parameters from RDS stack exported output values
-rds_stack_name = os.getenv('rds_stack_name')
-cloudformation = boto3.resource('cloudformation')
-stack = cloudformation.Stack(rds_stack_name)
-database_name = get_cfn_output('DatabaseName', stack.outputs)
-db_cluster_arn = get_cfn_output('DatabaseClusterArn', stack.outputs)
-db_credentials_secrets_store_arn = get_cfn_output('DatabaseSecretArn', stack.outputs)
-print(f'Database info: [name={database_name}, cluster arn={db_cluster_arn}, secrets arn={db_credentials_secrets_store_arn}]')
-
-# Run DDL commands idempotently to create database and tables
-rds_client = boto3.client('rds-data')
-
-table_ddl_script_files = ['table_users.txt', 'table_events.txt', 'table_crews.txt', 'table_problems.txt', 'table_messages.txt', 'table_receipts.txt', 'table_topics.txt']
-
-def execute_statement(sql):
-    print(f'Running SQL statement: {sql}')
-    response = rds_client.execute_statement(
-        secretArn=db_credentials_secrets_store_arn,
-        database=database_name,
-        resourceArn=db_cluster_arn,
-        sql=sql
-    )
-    return response
-
-execute_statement(f'create database if not exists {database_name}')
-
-for table_ddl_script_file in table_ddl_script_files:
-    print(f"Creating table from DDL file: {table_ddl_script_file}")
-    with open(table_ddl_script_file, 'r') as ddl_script:
-        ddl_script_content=ddl_script.read()
-        execute_statement(ddl_script_content)
-
-response = execute_statement(f'show tables')
-print(response)
+
+class Database:
+
+    def __init__(self):
+        if LOCAL_RDSDATA_PATH:
+            from helper.local_rdsdata import LocalRDSDataClient
+            self.dialect = 'sqlite'
+            self.client = LocalRDSDataClient(LOCAL_RDSDATA_PATH, schema=None) # check the file as it is
+            self.database_name = self.db_cluster_arn = self.db_credentials_secrets_store_arn = None
+            print(f'Database info: [local={LOCAL_RDSDATA_PATH}]')
+            return
+        import boto3
+        # Retrieve required parameters from RDS stack exported output values
+        rds_stack_name = os.getenv('rds_stack_name')
+        cloudformation = boto3.resource('cloudformation')
+        stack = cloudformation.Stack(rds_stack_name)
+        self.dialect = 'mysql'
+        self.database_name = get_cfn_output('DatabaseName', stack.outputs)
+        self.db_cluster_arn = get_cfn_output('DatabaseClusterArn', stack.outputs)
+        self.db_credentials_secrets_store_arn = get_cfn_output('DatabaseSecretArn', stack.outputs)
+        print(f'Database info: [name={self.database_name}, cluster arn={self.db_cluster_arn}, secrets arn={self.db_credentials_secrets_store_arn}]')
+        self.client = boto3.client('rds-data')
+
+    def execute_statement(self, sql, parameters=(), **options):
+        print(f'Running SQL statement: {sql}')
+        return self.client.execute_statement(
+            secretArn=self.db_credentials_secrets_store_arn,
+            database=self.database_name,
+            resourceArn=self.db_cluster_arn,
+            sql=sql,
+            parameters=list(parameters),
+            **options
+        )
+
+    def rows(self, sql, parameters=()):
+        # records as dicts keyed by column label
+        response = self.execute_statement(sql, parameters, includeResultMetadata=True)
+        labels = [column['label'] for column in response['columnMetadata']]
+        return [{label: None if field.get('isNull') else next(iter(field.values()))
+            for label, field in zip(labels, record)} for record in response['records']]
+
+
+#-----------------------------------------------------------------------------------------------
+# Migrations
+#-----------------------------------------------------------------------------------------------
+def run_ddl_files(db, ddl_script_files):
+    for table_ddl_script_file in ddl_script_files:
+        print(f"Creating table from DDL file: {table_ddl_script_file}")
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), table_ddl_script_file), 'r') as ddl_script:
+            db.execute_statement(ddl_script.read())
+
+
+def create_tables(db):
+    run_ddl_files(db, table_ddl_script_files)
+
+
+def add_index(db, table, index, columns):
+    existing = db.execute_statement('SELECT 1 FROM information_schema.statistics'
+        ' WHERE table_schema = DATABASE() AND table_name = :table AND index_name = :index LIMIT 1', [
+            {'name':'table', 'value':{'stringValue': table}},
+            {'name':'index', 'value':{'stringValue': index}},
+        ])
+    if existing['records']:
+        print(f'{table}.{index} already exists')
+        return
+    # online build: fails instead of taking a table lock if the server can't do it in place.  A build
+    # that outlasts the Data API call keeps running; the migration isn't recorded, so re-run afterwards
+    db.execute_statement(f'ALTER TABLE {table} ADD INDEX {index} ({columns}), ALGORITHM=INPLACE, LOCK=NONE',
+        continueAfterTimeout=True)
+
+
+def add_hot_path_indexes(db):
+    for table, index, columns in HOT_PATH_INDEXES:
+        add_index(db, table, index, columns)
+
+
+def create_boards(db):
+    # Open-problem boards (see the DAL's board queries), filled from the problems open right now.  Problems
+    # opened or changed by functions that predate the boards are missed, so run this between events.
+    run_ddl_files(db, ['table_boards.txt', 'table_board_problems.txt'])
+    db.execute_statement('INSERT IGNORE INTO board_problems (event_id, crew_type, problem_id, strip, problem_type, reporter)'
+        ' SELECT p.event_id, p.crew_type, p.problem_id, p.strip, p.problem_type, u.user_name FROM problems p'
+        ' INNER JOIN users u ON u.user_id = p.reporter_id WHERE p.resolution_code IS NULL')
+    db.execute_statement('INSERT IGNORE INTO boards (event_id, crew_type, version)'
+        ' SELECT DISTINCT event_id, crew_type, 1 FROM board_problems')
+
+
+def widen_outbox_payload(db):
+    # JSON-escaped message text (\uXXXX per non-ASCII character) outgrows VARCHAR(2048)
+    db.execute_statement('ALTER TABLE outbox MODIFY payload TEXT NOT NULL')
+
+
+# (version, description, migration); append only, never renumber
+MIGRATIONS = [
+    (1, 'tables from table_*.txt', create_tables),
+    (2, 'hot path composite indexes', add_hot_path_indexes),
+    (3, 'open-problem boards', create_boards),
+    (4, 'outbox payload as TEXT', widen_outbox_payload),
+]
+
+
+def applied_version(db):
+    db.execute_statement(MIGRATIONS_TABLE_DDL)
+    response = db.execute_statement('SELECT MAX(version) FROM schema_migrations')
+    field = response['records'][0][0]
+    return 0 if field.get('isNull') else field['longValue']
+
+
+def migrate(db):
+    if db.dialect != 'mysql':
+        sys.exit('the SQLite stand-in creates its schema itself (helper/local_rdsdata.py); only --check runs locally')
+    db.execute_statement(f'create database if not exists {db.database_name}')
+    version = applied_version(db)
+    print(f'Schema version {version}')
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        print(f'Applying migration {migration_version}: {description}')
+        migration(db)
+        db.execute_statement('INSERT INTO schema_migrations (version, description, applied_time_utc)'
+            ' VALUES (:version, :description, now())', [
+                {'name':'version', 'value':{'longValue': migration_version}},
+                {'name':'description', 'value':{'stringValue': description}},
+            ])
+    print(f'Schema version {MIGRATIONS[-1][0]}')
+
+
+#-----------------------------------------------------------------------------------------------
+# EXPLAIN check
+#-----------------------------------------------------------------------------------------------
+def full_scans(db, sql, parameters):
+    # tables the plan reads end to end
+    if db.dialect == 'sqlite':
+        # 'SCAN users', or a SEARCH through an index SQLite had to build for this statement
+        details = [row['detail'] for row in db.rows(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+        return [detail for detail in details if detail.startswith('SCAN ') or 'AUTOMATIC' in detail]
+    # type ALL (table scan), or no key chosen for a table the plan reads, whatever possible_keys offered
+    return [f'{row["table"]} type={row["type"]} key={row["key"]}' for row in db.rows(f'EXPLAIN {sql}', parameters)
+        if row['table'] is not None and (row['type'] == 'ALL' or row['key'] is None)]
+
+
+def check(db):
+    from helper.dal import QUERIES
+    failed = []
+    for name, values in HOT_QUERIES.items():
+        query = QUERIES[name]
+        scans = full_scans(db, query.sql, query.parameters(values))
+        print(f'{name}: {"FULL SCAN " + "; ".join(scans) if scans else "ok"}')
+        if scans:
+            failed.append(name)
+    if failed:
+        sys.exit(f'full table scans in hot queries: {", ".join(failed)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='EXPLAIN the hot queries instead of migrating')
+    args = parser.parse_args()
+    db = Database()
+    if args.check:
+        check(db)
+    else:
+        migrate(db)
+
+
+if __name__ == '__main__':
+    main()
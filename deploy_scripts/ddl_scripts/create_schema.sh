@@ -16,3 +16,4 @@ env_type=$1
 . "../${env_type}-env.sh"
 
 python create_schema.py
+python create_schema.py --check
@@ -24,6 +24,7 @@ sam deploy \
         DatabaseStackName="${rds_stack_name}" \
         ApiStageName="${api_stage_name}" \
         LambdaLogLevel="${log_level}" \
+        ApiLayout="${api_layout:-per-function}" \
     --capabilities \
         CAPABILITY_IAM
 
@@ -23,7 +23,6 @@
 """
 import json
 import os
-import boto3
 from helper.dal import *
 from helper.lambdautils import *
 from helper.logger import get_logger
@@ -58,7 +57,7 @@ def handler(event, context):
         input_fields = json.loads(event['body'])
         validate_check_email_input_parameters(input_fields)
         data = json.dumps(event)
-        code, err, msg = dal.pokeme()
+        code, err, msg = dal.ready()
         print(f'code={code}')
         if code == 0:
             return error(400, "wake db failed")
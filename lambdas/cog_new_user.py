@@ -22,7 +22,6 @@
 """
 import json
 import os
-import boto3
 from helper.dal import *
 from helper.lambdautils import *
 from helper.logger import get_logger
@@ -67,11 +67,12 @@ def handler(event, context):
             crew_type=input_fields['crew_type']
             strip = input_fields['strip']
             problem_type = input_fields['problem_type']
-            works=dal.create_problem(user_id, event_id, crew_type, strip, problem_type)
-            if works:
+            problem_id=dal.create_problem(user_id, event_id, crew_type, strip, problem_type)
+            if problem_id:
                 logger.debug('problem created')
                 return success({
-                    'message': 'problem created'
+                    'message': 'problem created',
+                    'problem_id': problem_id
                     })
             else:
                 return error(400, 'could not create problem')
@@ -51,7 +51,7 @@ def validate_hello_input_parameters(event):
 def handler(event, context):
     try:
         logger.info(f'Event received: {event}')
-        code, error, msg = dal.pokeme()
+        code, err, msg = dal.ready()
         if code == 0:
             return error(400, "wake db failed")
         elif code == 1:
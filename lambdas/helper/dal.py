@@ -5,20 +5,23 @@
 """
 import json
 import os
-import boto3
-import base64
-from urllib import request, parse
-import requests
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from .logger import get_logger
-from aws_xray_sdk.core import xray_recorder, patch_all
+from .queries import QueryRegistry, LONG, STRING, BOOLEAN, TIMESTAMP
+from .tracing import Lazy, patch, propagate, put_metadata, put_payload, xray_recorder
+from . import metrics
 logger = get_logger(__name__)
 
 is_lambda_environment = (os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None)
 
-# AWS X-Ray support
-
-if is_lambda_environment:
-    patch_all()
+# boto3 and the rds-data client (see DataAccessLayer._rdsdata_client) and helper.notify with requests
+# are imported on first use, so a handler's cold start only pays for what its invocations touch
 
 users_table_name = os.getenv('USERS_TABLE_NAME', 'users')
 events_table_name = os.getenv('EVENTS_TABLE_NAME', 'events')
@@ -26,9 +29,21 @@ crews_table_name = os.getenv('CREWS_TABLE_NAME', 'crews')
 problems_table_name = os.getenv('PROBLEMS_TABLE_NAME', 'problems')
 messages_table_name = os.getenv('MESSAGES_TABLE_NAME', 'messages')
 receipts_table_name = os.getenv('RECEIPTS_TABLE_NAME', 'receipts')
-TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH")
-FCM_KEY = os.getenv("FCM_KEY")
+outbox_table_name = os.getenv('OUTBOX_TABLE_NAME', 'outbox')
+boards_table_name = os.getenv('BOARDS_TABLE_NAME', 'boards')
+board_problems_table_name = os.getenv('BOARD_PROBLEMS_TABLE_NAME', 'board_problems')
+LOCAL_RDSDATA_PATH = os.getenv('LOCAL_RDSDATA_PATH') # run against the SQLite stand-in instead of Aurora
+DB_BACKEND = os.getenv('DB_BACKEND', 'data-api') # 'data-api': RDS Data API over HTTPS, 'mysql': pooled connections (RDS Proxy)
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '60')) # seconds, 0 disables the cache
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '1024'))
+NOTIFY_MODE = os.getenv('NOTIFY_MODE', 'outbox') # 'outbox': queue push/SMS for outbox_worker, 'direct': send inline
+WARM_STATE_TTL = float(os.getenv('WARM_STATE_TTL', '60')) # seconds a successful statement vouches for the database
+WARM_PROBE_BASE_DELAY = float(os.getenv('WARM_PROBE_BASE_DELAY', '0.5')) # seconds, first resume backoff
+WARM_PROBE_MAX_DELAY = float(os.getenv('WARM_PROBE_MAX_DELAY', '8')) # seconds, backoff cap
+POLL_CURSOR_OVERLAP = int(os.getenv('POLL_CURSOR_OVERLAP', '30')) # seconds an incremental poll looks back, longer than any write transaction
+BATCH_MAX_ROWS = int(os.getenv('BATCH_MAX_ROWS', '1000')) # parameter sets per BatchExecuteStatement call
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(3 * 1024 * 1024))) # serialized SQL + parameter sets per call, under the 4 MiB request limit
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', '4')) # chunks in flight at once outside a transaction
 
 
 class DataAccessLayerException(Exception):
@@ -36,16 +51,448 @@ class DataAccessLayerException(Exception):
     def __init__(self, original_exception):
         self.original_exception = original_exception
 
+class IdentityCache:
+    # TTL + LRU cache shared by every DataAccessLayer in a warm container.  Writes made through this
+    # container invalidate explicitly; writes made by other containers are bounded by the TTL.
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+user_cache = IdentityCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE)  # sub -> (user_id, user_name, allowed_roles)
+crew_cache = IdentityCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE)  # user_id -> (event_id, crew_type)
+
+def identity_cache_stats():
+    return {'check_user': user_cache.stats(), 'get_event_and_crew': crew_cache.stats()}
+
+class WarmState:
+    # When Aurora Serverless last answered, per container.  Every successful statement refreshes it,
+    # so a warm container answers readiness checks without touching the database at all.
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.last_healthy_at = None
+        self.resuming_since = None
+
+    def mark_healthy(self):
+        self.last_healthy_at = time.monotonic()
+        self.resuming_since = None
+
+    def mark_resuming(self):
+        self.last_healthy_at = None
+        if self.resuming_since is None:
+            self.resuming_since = time.monotonic()
+
+    def is_healthy(self):
+        return self.last_healthy_at is not None and time.monotonic() - self.last_healthy_at < self.ttl
+
+
+warm_state = WarmState(WARM_STATE_TTL)
+
+def is_resuming_error(e):
+    return 'Communications link failure' in str(e)
+
+class UnitOfWork:
+    # One database transaction for a group of DataAccessLayer calls made on this thread: every statement
+    # inside the with-block carries its transactionId.  A unit opened inside another joins the outer one,
+    # so only the outermost commits; after_commit callbacks run once that commit has succeeded.
+
+    def __init__(self, dal):
+        self._dal = dal
+        self._root = self
+        self._callbacks = []
+        self.transaction_id = None
+        self.nested = False
+        self.rollback_only = False
+        self.results = []
+
+    def __enter__(self):
+        outer = getattr(self._dal._local, 'unit', None)
+        if outer is not None:
+            self._root = outer
+            self.nested = True
+            self.transaction_id = outer.transaction_id
+            return self
+        self.transaction_id = self._dal.begin_transaction()
+        self._dal._local.unit = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.nested:
+            if exc_type is not None:
+                self._root.rollback_only = True
+            return False
+        self._dal._local.unit = None
+        if exc_type is not None or self.rollback_only:
+            try:
+                self._dal.rollback_transaction(self.transaction_id)
+            except DataAccessLayerException as de:
+                if exc_type is None:
+                    raise de
+                logger.info(f'rollback of {self.transaction_id} failed: {de.original_exception}')
+            return False
+        self._dal.commit_transaction(self.transaction_id)
+        self.results = [callback() for callback in self._callbacks]
+        return False
+
+    def set_rollback_only(self):
+        self._root.rollback_only = True
+
+    def after_commit(self, callback):
+        self._root._callbacks.append(callback)
+
+_mysql_client = None
+
+def mysql_client(secret_arn):
+    # One pool per container, shared by every handler's DataAccessLayer
+    global _mysql_client
+    if _mysql_client is None:
+        from .mysql_client import MySQLDataClient
+        _mysql_client = MySQLDataClient(secret_arn=secret_arn)
+    return _mysql_client
+
+_rdsdata_client = None
+_batch_executor = None
+
+def rdsdata_client():
+    # One rds-data client per container, shared by every handler's DataAccessLayer (router.py runs several)
+    global _rdsdata_client
+    if _rdsdata_client is None:
+        import boto3
+        patch('botocore')
+        _rdsdata_client = boto3.client('rds-data')
+    return _rdsdata_client
+
+def batch_executor():
+    # kept for the life of the container so warm invocations reuse the threads
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix='batch')
+    return _batch_executor
+
+def chunk_parameter_sets(sql_param_sets, max_rows, max_bytes):
+    # Consecutive chunks of at most max_rows parameter sets and max_bytes of serialized parameters.
+    # A single set bigger than max_bytes still goes, alone, and the Data API decides.
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for parameter_set in sql_param_sets:
+        set_bytes = len(json.dumps(parameter_set))
+        if chunk and (len(chunk) >= max_rows or chunk_bytes + set_bytes > max_bytes):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(parameter_set)
+        chunk_bytes += set_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+#-----------------------------------------------------------------------------------------------
+# Query Registry: fixed statements, built and checked once per container
+#-----------------------------------------------------------------------------------------------
+QUERIES = QueryRegistry()
+QUERIES.add('check_user',
+    f'SELECT user_id, user_name, allowed_roles FROM {users_table_name} WHERE sub = :sub',
+    params=(('sub', STRING),),
+    columns=(('user_id', LONG), ('user_name', STRING), ('allowed_roles', STRING)))
+QUERIES.add('active_crew',
+    f'SELECT crews.event_id, crews.crew_type FROM {crews_table_name}' \
+    f' INNER JOIN {events_table_name} ON crews.event_id = events.event_id' \
+    f' WHERE crews.user_id = :user_id AND events.state = 1',
+    params=(('user_id', LONG),),
+    columns=(('event_id', LONG), ('crew_type', STRING)))
+QUERIES.add('test_crew',
+    f'SELECT crew_type FROM {crews_table_name} WHERE event_id = 2001 AND user_id = :user_id',
+    params=(('user_id', LONG),),
+    columns=(('crew_type', STRING),))
+QUERIES.add('get_problem',
+    f'SELECT event_id, crew_type, strip, problem_type, reporter_id FROM {problems_table_name}' \
+    f' WHERE problem_id = :problem_id',
+    params=(('problem_id', LONG),),
+    columns=(('event_id', LONG), ('crew_type', STRING), ('strip', STRING), ('problem_type', STRING),
+        ('reporter_id', LONG)))
+QUERIES.add('create_problem',
+    f'INSERT INTO {problems_table_name} (event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc)' \
+    f' VALUES (:event, :crew, :strip, :problem, :user, now())',
+    params=(('event', LONG), ('crew', STRING), ('strip', STRING), ('problem', STRING), ('user', LONG)))
+QUERIES.add('resolve_problem',
+    f'UPDATE {problems_table_name} SET resolver_id = :user, resolver_time_utc = now(), resolution_code = :resolution' \
+    f' WHERE problem_id = :problem',
+    params=(('problem', LONG), ('resolution', LONG), ('user', LONG)))
+QUERIES.add('update_problem',
+    f'UPDATE {problems_table_name}' \
+    f' SET strip = :strip, problem_type = :problem_type, updater_id = :user, update_time_utc = now()' \
+    f' WHERE problem_id = :problem AND crew_type = :crew',
+    params=(('problem', LONG), ('strip', STRING), ('problem_type', STRING), ('crew', STRING), ('user', LONG)))
+# Open-problem board: one boards row per (event, crew) with a version bumped by every change, and one
+# board_problems row per open problem, kept up to date by the same transaction that changes the problem
+QUERIES.add('board',
+    f'SELECT b.version, bp.problem_id, bp.strip, bp.problem_type, bp.reporter FROM {boards_table_name} b' \
+    f' LEFT JOIN {board_problems_table_name} bp ON bp.event_id = b.event_id AND bp.crew_type = b.crew_type' \
+    f' WHERE b.event_id = :event AND b.crew_type = :crew',
+    params=(('event', LONG), ('crew', STRING)),
+    columns=(('version', LONG), ('problem_id', LONG), ('strip', STRING), ('problem_type', STRING), ('reporter', STRING)),
+    json_rows=True)
+QUERIES.add('board_add',
+    f'INSERT INTO {board_problems_table_name} (event_id, crew_type, problem_id, strip, problem_type, reporter)' \
+    f' SELECT p.event_id, p.crew_type, p.problem_id, p.strip, p.problem_type, u.user_name FROM {problems_table_name} p' \
+    f' INNER JOIN {users_table_name} u ON u.user_id = p.reporter_id' \
+    f' WHERE p.problem_id = :problem AND p.resolution_code IS NULL',
+    params=(('problem', LONG),))
+QUERIES.add('board_update',
+    f'UPDATE {board_problems_table_name} SET strip = :strip, problem_type = :problem_type' \
+    f' WHERE problem_id = :problem AND crew_type = :crew',
+    params=(('problem', LONG), ('strip', STRING), ('problem_type', STRING), ('crew', STRING)))
+QUERIES.add('board_row',
+    f'SELECT event_id, crew_type FROM {board_problems_table_name} WHERE problem_id = :problem',
+    params=(('problem', LONG),),
+    columns=(('event_id', LONG), ('crew_type', STRING)))
+QUERIES.add('board_remove',
+    f'DELETE FROM {board_problems_table_name} WHERE problem_id = :problem',
+    params=(('problem', LONG),))
+QUERIES.add('board_bump',
+    f'INSERT INTO {boards_table_name} (event_id, crew_type, version) VALUES (:event, :crew, 1)' \
+    f' ON DUPLICATE KEY UPDATE version = version + 1',
+    params=(('event', LONG), ('crew', STRING)))
+QUERIES.add('board_bump_event',
+    f'UPDATE {boards_table_name} SET version = version + 1 WHERE event_id = :event',
+    params=(('event', LONG),))
+QUERIES.add('unread_messages',
+    f'SELECT {messages_table_name}.message_id, {messages_table_name}.problem_id, {messages_table_name}.message_text' \
+    f' FROM {messages_table_name} INNER JOIN {receipts_table_name}' \
+    f' ON {messages_table_name}.message_id = {receipts_table_name}.message_id' \
+    f' WHERE {messages_table_name}.event_id = :event AND {messages_table_name}.crew_type = :crew' \
+    f' AND {receipts_table_name}.recipient_id = :user AND {receipts_table_name}.receipt_time_utc IS NULL',
+    params=(('event', LONG), ('crew', STRING), ('user', LONG)),
+    columns=(('message_id', LONG), ('problem_id', LONG), ('message_text', STRING)),
+    json_rows=True)
+QUERIES.add('store_message',
+    f'INSERT INTO {messages_table_name} (event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc)' \
+    f' VALUES (:event, :crew, :problem, :text, :user, now())',
+    params=(('event', LONG), ('crew', STRING), ('problem', LONG), ('text', STRING), ('user', LONG)))
+QUERIES.add('crew_members',
+    f'SELECT user_id, sms FROM {crews_table_name} WHERE event_id = :event AND crew_type = :crew',
+    params=(('event', LONG), ('crew', STRING)),
+    columns=(('user_id', LONG), ('sms', BOOLEAN)))
+QUERIES.add('add_receipt',
+    f'INSERT INTO {receipts_table_name} (event_id, problem_id, message_id, recipient_id)' \
+    f' VALUES (:event, :problem, :message, :recipient)',
+    params=(('event', LONG), ('problem', LONG), ('message', LONG), ('recipient', LONG)))
+QUERIES.add('user_sub',
+    f'SELECT sub FROM {users_table_name} WHERE user_id = :user',
+    params=(('user', LONG),),
+    columns=(('sub', STRING),))
+# Outbox: one row per push/SMS delivery, written with the message and drained by outbox_worker.py
+QUERIES.add('outbox_enqueue',
+    f'INSERT INTO {outbox_table_name}' \
+    f' (message_id, channel, recipient, dedupe_key, payload, attempts, next_attempt_utc, created_time_utc)' \
+    f' VALUES (:message, :channel, :recipient, :dedupe, :payload, 0, :now, :now)',
+    params=(('message', LONG), ('channel', STRING), ('recipient', STRING), ('dedupe', STRING), ('payload', STRING),
+        ('now', TIMESTAMP)))
+QUERIES.add('outbox_due',
+    f'SELECT outbox_id FROM {outbox_table_name}' \
+    f' WHERE sent_time_utc IS NULL AND attempts < :max AND next_attempt_utc <= :now' \
+    f' ORDER BY outbox_id LIMIT :limit',
+    params=(('now', TIMESTAMP), ('max', LONG), ('limit', LONG)),
+    columns=(('outbox_id', LONG),))
+QUERIES.add('outbox_lease',
+    f'UPDATE {outbox_table_name} SET claim_id = :claim, next_attempt_utc = :lease' \
+    f' WHERE outbox_id = :outbox AND sent_time_utc IS NULL AND next_attempt_utc <= :now',
+    params=(('outbox', LONG), ('claim', STRING), ('lease', TIMESTAMP), ('now', TIMESTAMP)))
+QUERIES.add('outbox_claimed',
+    f'SELECT outbox_id, channel, dedupe_key, payload, attempts FROM {outbox_table_name}' \
+    f' WHERE claim_id = :claim ORDER BY outbox_id',
+    params=(('claim', STRING),),
+    columns=(('outbox_id', LONG), ('channel', STRING), ('dedupe_key', STRING), ('payload', STRING), ('attempts', LONG)))
+QUERIES.add('outbox_sent',
+    f'UPDATE {outbox_table_name} SET sent_time_utc = :now, claim_id = NULL WHERE outbox_id = :outbox',
+    params=(('outbox', LONG), ('now', TIMESTAMP)))
+QUERIES.add('outbox_retry',
+    f'UPDATE {outbox_table_name} SET attempts = attempts + 1, next_attempt_utc = :next,' \
+    f' last_error = :error, claim_id = NULL WHERE outbox_id = :outbox',
+    params=(('outbox', LONG), ('next', TIMESTAMP), ('error', STRING)))
+QUERIES.add('receipt',
+    f'UPDATE {receipts_table_name} SET receipt_time_utc = now() WHERE message_id = :message AND recipient_id = :user',
+    params=(('message', LONG), ('user', LONG)))
+QUERIES.add('hello',
+    f'SELECT crew_id, crew_type FROM {crews_table_name} WHERE event_id = :event AND user_id = :user',
+    params=(('event', LONG), ('user', LONG)),
+    columns=(('crew_id', LONG), ('crew_type', STRING)),
+    json_rows=True)
+QUERIES.add('tourney',
+    f'SELECT event_id, event_name, event_type, start_date_utc, end_date_utc, state FROM {events_table_name}' \
+    f' WHERE start_date_utc < now() AND end_date_utc > now()',
+    columns=(('event_id', LONG), ('event_name', STRING), ('event_type', STRING), ('start_date_utc', STRING),
+        ('end_date_utc', STRING), ('state', LONG)),
+    json_rows=True)
+QUERIES.add('old_events',
+    f'SELECT event_id, state FROM {events_table_name} WHERE end_date_utc < now() AND state != 2',
+    columns=(('event_id', LONG), ('state', LONG)))
+QUERIES.add('event_windows',
+    f'SELECT start_date_utc, end_date_utc FROM {events_table_name} WHERE end_date_utc > now() AND start_date_utc < :horizon',
+    params=(('horizon', TIMESTAMP),),
+    columns=(('start_date_utc', STRING), ('end_date_utc', STRING)))
+QUERIES.add('event_tn',
+    f'SELECT arm_tn FROM {events_table_name} WHERE event_id = :event',
+    params=(('event', LONG),),
+    columns=(('arm_tn', STRING),))
+QUERIES.add('event_by_tn',
+    f'SELECT event_id FROM {events_table_name} WHERE arm_tn = :tn',
+    params=(('tn', STRING),),
+    columns=(('event_id', LONG),))
+QUERIES.add('find_crew',
+    f'SELECT crew_id FROM {crews_table_name} WHERE user_id = :user AND event_id = :event',
+    params=(('event', LONG), ('user', LONG)),
+    columns=(('crew_id', LONG),))
+QUERIES.add('add_crew',
+    f'INSERT INTO {crews_table_name} (event_id, crew_type, user_id, sms) VALUES (:event, :crew, :user, false)',
+    params=(('event', LONG), ('crew', STRING), ('user', LONG)))
+QUERIES.add('change_state',
+    f'UPDATE {events_table_name} SET state = :state WHERE event_id = :event',
+    params=(('event', LONG), ('state', LONG)))
+QUERIES.add('insert_ref',
+    f'INSERT INTO {users_table_name} (user_name, full_name, allowed_roles, mobile) VALUES (:tn, :tn, :role, :tn)',
+    params=(('tn', STRING), ('role', STRING)))
+QUERIES.add('user_by_mobile',
+    f'SELECT user_id, user_name FROM {users_table_name} WHERE mobile = :tn',
+    params=(('tn', STRING),),
+    columns=(('user_id', LONG), ('user_name', STRING)))
+QUERIES.add('open_problem_by_reporter',
+    f'SELECT problem_id FROM {problems_table_name} WHERE reporter_id = :user AND resolution_code IS NULL',
+    params=(('user', LONG),),
+    columns=(('problem_id', LONG),))
+QUERIES.add('check_email',
+    f'SELECT user_id, allowed_roles FROM {users_table_name} WHERE email = :email',
+    params=(('email', STRING),),
+    columns=(('user_id', LONG), ('allowed_roles', STRING)))
+QUERIES.add('insert_sub',
+    f'UPDATE {users_table_name} SET sub = :sub WHERE email = :email',
+    params=(('email', STRING), ('sub', STRING)))
+QUERIES.add('insert_user',
+    f'INSERT INTO {users_table_name} (full_name, user_name, allowed_roles, email) VALUES (:full, :user, :role, :email)',
+    params=(('full', STRING), ('user', STRING), ('role', STRING), ('email', STRING)))
+QUERIES.add('set_roles',
+    f'UPDATE {users_table_name} SET allowed_roles = :roles WHERE user_id = :user',
+    params=(('user', LONG), ('roles', STRING)))
+
+# Fused poll (DataAccessLayer.poll_user): 'U' rows for the user's candidate crews, then 'P' rows for their problems
+# and 'M' rows for their unread messages.  poll_user reads the open-problem boards; poll_user_since reads the
+# problems and messages changed since a cursor.
+def _poll_user_sql(problem_branch, message_filter):
+    return f'select \'U\' as kind, me.user_id as id, b.version as ref_id, c.event_id, c.crew_type,' \
+        f' me.user_name as text1, me.allowed_roles as text2, now() as text3, e.state as num' \
+        f' from {users_table_name} me' \
+        f' left join {crews_table_name} c on c.user_id = me.user_id' \
+        f' left join {events_table_name} e on e.event_id = c.event_id' \
+        f' left join {boards_table_name} b on b.event_id = c.event_id and b.crew_type = c.crew_type' \
+        f' where me.sub = :sub' \
+        f' union all' \
+        f'{problem_branch}' \
+        f' union all' \
+        f' select \'M\', m.message_id, m.problem_id, m.event_id, m.crew_type, m.message_text, NULL, NULL, r.receipt_id' \
+        f' from {users_table_name} me' \
+        f' inner join {crews_table_name} c on c.user_id = me.user_id' \
+        f' inner join {events_table_name} e on e.event_id = c.event_id' \
+        f' inner join {messages_table_name} m on m.event_id = c.event_id and m.crew_type = c.crew_type' \
+        f' inner join {receipts_table_name} r on r.message_id = m.message_id and r.recipient_id = me.user_id' \
+        f' where me.sub = :sub and (e.state = 1 or c.event_id = 2001)' \
+        f' and r.receipt_time_utc is null{message_filter}'
+
+POLL_USER_COLUMNS = (('kind', STRING), ('id', LONG), ('ref_id', LONG), ('event_id', LONG), ('crew_type', STRING),
+    ('text1', STRING), ('text2', STRING), ('text3', STRING), ('num', LONG))
+QUERIES.add('poll_user',
+    _poll_user_sql(f' select \'P\', bp.problem_id, NULL, bp.event_id, bp.crew_type, bp.strip, bp.problem_type,' \
+        f' bp.reporter, NULL' \
+        f' from {users_table_name} me' \
+        f' inner join {crews_table_name} c on c.user_id = me.user_id' \
+        f' inner join {events_table_name} e on e.event_id = c.event_id' \
+        f' inner join {board_problems_table_name} bp on bp.event_id = c.event_id and bp.crew_type = c.crew_type' \
+        f' where me.sub = :sub and (e.state = 1 or c.event_id = 2001)', ''),
+    params=(('sub', STRING),),
+    columns=POLL_USER_COLUMNS,
+    json_rows=True)
+QUERIES.add('poll_user_since',
+    _poll_user_sql(f' select \'P\', p.problem_id, NULL, p.event_id, p.crew_type, p.strip, p.problem_type,' \
+        f' reporter.user_name, p.resolution_code' \
+        f' from {users_table_name} me' \
+        f' inner join {crews_table_name} c on c.user_id = me.user_id' \
+        f' inner join {events_table_name} e on e.event_id = c.event_id' \
+        f' inner join {problems_table_name} p on p.event_id = c.event_id and p.crew_type = c.crew_type' \
+        f' inner join {users_table_name} reporter on reporter.user_id = p.reporter_id' \
+        f' where me.sub = :sub and (e.state = 1 or c.event_id = 2001)' \
+        f' and (p.reported_time_utc >= :since or p.update_time_utc >= :since or p.resolver_time_utc >= :since)',
+        ' and m.sent_time_utc >= :since'),
+    params=(('sub', STRING), ('since', TIMESTAMP)),
+    columns=POLL_USER_COLUMNS,
+    json_rows=True)
+
 class DataAccessLayer:
 
-    def __init__(self, database_name, db_cluster_arn, db_credentials_secrets_store_arn):
-        self._rdsdata_client = boto3.client('rds-data')
+    def __init__(self, database_name, db_cluster_arn, db_credentials_secrets_store_arn, rdsdata_client=None):
+        self._client = rdsdata_client # built by the first statement when not given
+        self._client_lock = threading.Lock()
         self._database_name = database_name
         self._db_cluster_arn = db_cluster_arn
         self._db_credentials_secrets_store_arn = db_credentials_secrets_store_arn
+        self._local = threading.local() # the open UnitOfWork, per thread
+
+    @property
+    def _rdsdata_client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._make_client()
+        return self._client
+
+    def _make_client(self):
+        if LOCAL_RDSDATA_PATH:
+            from .local_rdsdata import LocalRDSDataClient
+            return LocalRDSDataClient(LOCAL_RDSDATA_PATH)
+        if DB_BACKEND == 'mysql':
+            return mysql_client(self._db_credentials_secrets_store_arn)
+        return rdsdata_client()
 
     @staticmethod
     def _xray_start(segment_name):
+        metrics.start(segment_name) #every X-Ray span is also a metrics span, see metrics.py
         if is_lambda_environment and xray_recorder:
             xray_recorder.begin_subsegment(segment_name)
 
@@ -53,15 +500,27 @@ class DataAccessLayer:
     def _xray_stop():
         if is_lambda_environment and xray_recorder:
             xray_recorder.end_subsegment()
+        metrics.stop()
 
     @staticmethod
     def _xray_add_metadata(name, value):
-        if is_lambda_environment and xray_recorder and xray_recorder.current_subsegment():
-            return xray_recorder.current_subsegment().put_metadata(name, value)
+        return put_metadata(name, value) #strings are truncated, see tracing.py
+
+    @staticmethod
+    def _generated_key(response):
+        # auto-increment key of the row an INSERT just created, 0 if nothing was inserted
+        generated_fields = response.get('generatedFields') or [{}]
+        return generated_fields[0].get('longValue', 0)
+
+    @staticmethod
+    def _count(response, rows):
+        # response size and SDK retries come from the HTTP metadata botocore attaches to every response
+        metadata = response.get('ResponseMetadata', {})
+        nbytes = int(metadata.get('HTTPHeaders', {}).get('content-length', 0))
+        metrics.add(rows=rows, nbytes=nbytes, retries=metadata.get('RetryAttempts', 0))
 
-    def execute_statement(self, sql_stmt, sql_params=[], transaction_id=None):
-        parameters = f' with parameters: {sql_params}' if len(sql_params) > 0 else ''
-        logger.debug(f'Running SQL statement: {sql_stmt}{parameters}')
+    def execute_statement(self, sql_stmt, sql_params=[], transaction_id=None, format_records_as='NONE'):
+        logger.debug('Running SQL statement: %s with parameters: %s', sql_stmt, Lazy(sql_params))
         DataAccessLayer._xray_start('execute_statement')
         try:
             DataAccessLayer._xray_add_metadata('sql_statement', sql_stmt)
@@ -72,90 +531,218 @@ class DataAccessLayer:
                 'sql': sql_stmt,
                 'parameters': sql_params
             }
+            if transaction_id is None:
+                transaction_id = self._current_transaction_id()
             if transaction_id is not None:
                 parameters['transactionId'] = transaction_id
+            if format_records_as != 'NONE':
+                parameters['formatRecordsAs'] = format_records_as # rows come back as one JSON string
             result = self._rdsdata_client.execute_statement(**parameters)
         except Exception as e:
-            logger.debug(f'Error running SQL statement (error class: {e.__class__})')
+            logger.debug('Error running SQL statement (error class: %s)', e.__class__)
+            if is_resuming_error(e):
+                warm_state.mark_resuming()
             raise DataAccessLayerException(e) from e
         else:
-            DataAccessLayer._xray_add_metadata('rdsdata_executesql_result', json.dumps(result))
+            warm_state.mark_healthy()
+            put_payload('rdsdata_executesql_result', result)
+            #JSON-format rows are counted by select() once decoded
+            DataAccessLayer._count(result, len(result['records']) if 'records' in result else result.get('numberOfRecordsUpdated', 0))
             return result
         finally:
            DataAccessLayer._xray_stop()
 
-    def batch_execute_statement(self, sql_stmt, sql_param_sets, batch_size, transaction_id=None):
-        parameters = f' with parameters: {sql_param_sets}' if len(sql_param_sets) > 0 else ''
-        logger.debug(f'Running SQL statement: {sql_stmt}{parameters}')
+    def batch_execute_statement(self, sql_stmt, sql_param_sets, batch_size=None, transaction_id=None):
+        # Returns one response per chunk, in parameter set order; see update_results() / generated_keys().
+        # Chunks are sized by rows (batch_size, capped at BATCH_MAX_ROWS) and bytes (BATCH_MAX_BYTES). Outside a
+        # transaction each chunk commits on its own, so up to BATCH_MAX_WORKERS run at once; inside one they
+        # share the transaction's connection and go in order.
+        logger.debug('Running SQL statement: %s with parameter sets: %s', sql_stmt, Lazy(sql_param_sets))
         DataAccessLayer._xray_start('batch_execute_statement')
+        if transaction_id is None:
+            transaction_id = self._current_transaction_id()
         try:
-            array_length = len(sql_param_sets)
-            num_batches = 1 + len(sql_param_sets)//batch_size
-            results = []
-            for i in range(0, num_batches):
-                start_idx = i*batch_size
-                end_idx = min(start_idx + batch_size, array_length)
-                batch_sql_param_sets = sql_param_sets[start_idx:end_idx]
-                if len(batch_sql_param_sets) > 0:
-                    print(f'Running SQL statement: [batch #{i+1}/{num_batches}, batch size {batch_size}, SQL: {sql_stmt}]')
-                    DataAccessLayer._xray_add_metadata('sql_statement', sql_stmt)
-                    parameters = {
-                        'secretArn': self._db_credentials_secrets_store_arn,
-                        'database': self._database_name,
-                        'resourceArn': self._db_cluster_arn,
-                        'sql': sql_stmt,
-                        'parameterSets': batch_sql_param_sets
-                    }
-                    if transaction_id is not None:
-                        parameters['transactionId'] = transaction_id
-                    result = self._rdsdata_client.batch_execute_statement(**parameters)
-                    results.append(result)
-        except Exception as e:
-            logger.debug(f'Error running SQL statement (error class: {e.__class__})')
+            DataAccessLayer._xray_add_metadata('sql_statement', sql_stmt)
+            max_rows = min(batch_size or BATCH_MAX_ROWS, BATCH_MAX_ROWS)
+            chunks = chunk_parameter_sets(sql_param_sets, max_rows, BATCH_MAX_BYTES - len(sql_stmt))
+            logger.debug('Running SQL statement: [%d batches of up to %d]', len(chunks), max_rows)
+            if transaction_id is not None or len(chunks) < 2 or BATCH_MAX_WORKERS < 2:
+                results = [self._batch_chunk(sql_stmt, chunk, transaction_id) for chunk in chunks]
+            else:
+                run_chunk = propagate(self._batch_chunk)
+                futures = [batch_executor().submit(run_chunk, sql_stmt, chunk, None) for chunk in chunks]
+                results = []
+                failure = None
+                for future in futures: # wait for every chunk, then report the first failure
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        failure = failure or e
+                if failure is not None:
+                    raise failure
+            for result in results:
+                DataAccessLayer._count(result, len(result.get('updateResults', ())))
+        except Exception as e:
+            logger.debug('Error running SQL statement (error class: %s)', e.__class__)
+            if is_resuming_error(e):
+                warm_state.mark_resuming()
             raise DataAccessLayerException(e) from e
         else:
-            DataAccessLayer._xray_add_metadata('rdsdata_executesql_result', json.dumps(result))
-            print(json.dumps(result))
+            put_payload('rdsdata_batchexecutesql_results', results)
             return results
         finally:
            DataAccessLayer._xray_stop()
 
+    def _batch_chunk(self, sql_stmt, sql_param_sets, transaction_id):
+        parameters = {
+            'secretArn': self._db_credentials_secrets_store_arn,
+            'database': self._database_name,
+            'resourceArn': self._db_cluster_arn,
+            'sql': sql_stmt,
+            'parameterSets': sql_param_sets
+        }
+        if transaction_id is not None:
+            parameters['transactionId'] = transaction_id
+        result = self._rdsdata_client.batch_execute_statement(**parameters)
+        warm_state.mark_healthy()
+        return result
+
+    @staticmethod
+    def update_results(responses):
+        # every chunk's updateResults from batch_execute_statement, one per parameter set in order
+        return [update for response in responses for update in response.get('updateResults', ())]
+
+    @staticmethod
+    def generated_keys(responses):
+        # auto-increment key per parameter set of a batched INSERT, 0 where nothing was inserted
+        return [DataAccessLayer._generated_key(update) for update in DataAccessLayer.update_results(responses)]
+
+    def execute_query(self, name, transaction_id=None, **values):
+        # Run a registered query; returns the raw Data API response
+        query = QUERIES[name]
+        return self.execute_statement(query.sql, query.parameters(values), transaction_id)
+
+    def execute_batch(self, name, value_sets, batch_size=None):
+        # Run a registered statement once per dict of values in value_sets; returns the batch response
+        query = QUERIES[name]
+        return self.batch_execute_statement(query.sql, [query.parameters(values) for values in value_sets], batch_size)
+
+    def select(self, name, transaction_id=None, **values):
+        # Run a registered query; returns dicts for json_rows queries, compact row tuples otherwise
+        query = QUERIES[name]
+        rows = query.decode(self.execute_statement(query.sql, query.parameters(values), transaction_id, query.format))
+        if query.format == 'JSON':
+            metrics.add(rows=len(rows))
+        return rows
+
+    def transaction(self):
+        # with dal.transaction() as unit: every DAL call in the block commits (or rolls back) together
+        return UnitOfWork(self)
+
+    def _current_transaction_id(self):
+        unit = getattr(self._local, 'unit', None)
+        return unit.transaction_id if unit is not None else None
+
+    def begin_transaction(self):
+        DataAccessLayer._xray_start('begin_transaction')
+        try:
+            response = self._rdsdata_client.begin_transaction(
+                resourceArn=self._db_cluster_arn, secretArn=self._db_credentials_secrets_store_arn,
+                database=self._database_name)
+            return response['transactionId']
+        except Exception as e:
+            if is_resuming_error(e):
+                warm_state.mark_resuming()
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def commit_transaction(self, transaction_id):
+        DataAccessLayer._xray_start('commit_transaction')
+        try:
+            return self._rdsdata_client.commit_transaction(
+                resourceArn=self._db_cluster_arn, secretArn=self._db_credentials_secrets_store_arn,
+                transactionId=transaction_id)
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def rollback_transaction(self, transaction_id):
+        DataAccessLayer._xray_start('rollback_transaction')
+        try:
+            return self._rdsdata_client.rollback_transaction(
+                resourceArn=self._db_cluster_arn, secretArn=self._db_credentials_secrets_store_arn,
+                transactionId=transaction_id)
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
     #-----------------------------------------------------------------------------------------------
     # Package Functions
     #-----------------------------------------------------------------------------------------------
-    def pokeme(self):
+    # Readiness codes: 2 awake, 1 resuming from pause, 0 any other database error
+    def probe(self):
         parameters = {
             'secretArn': self._db_credentials_secrets_store_arn,
             'database': self._database_name,
             'resourceArn': self._db_cluster_arn,
-            'sql': 'SELECT event_id FROM events WHERE start_date_utc>now()'
+            'sql': 'SELECT 1'
         }
+        metrics.start('probe')
         try:
-            result = self._rdsdata_client.execute_statement(**parameters)
-            print('success')
+            self._rdsdata_client.execute_statement(**parameters)
+            warm_state.mark_healthy()
             return 2, 200, 'success'
         except Exception as e:
-            if 'Communications link failure' in str(e):
-                print('retry')
+            if is_resuming_error(e):
+                warm_state.mark_resuming()
+                logger.info('database is resuming')
                 return 1, 400, f'Timeout Error: {e}'
             else:
-                print(f'pokeme error e={e}')
+                logger.warning(f'probe error e={e}')
                 return 0, 400, f'Wakeup Error: {e}'
+        finally:
+            metrics.stop()
+
+    def ready(self):
+        # Non-blocking: no query at all if this container talked to the database recently,
+        # otherwise a single probe (which is what kicks off a resume)
+        if warm_state.is_healthy():
+            return 2, 200, 'success'
+        return self.probe()
+
+    def wait_until_ready(self, timeout):
+        # Probe with capped exponential backoff and jitter until awake, a hard error, or timeout
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        metrics.start('wait_until_ready')
+        try:
+            while True:
+                code, status, msg = self.ready()
+                remaining = deadline - time.monotonic()
+                if code != 1 or remaining <= 0:
+                    return code, status, msg
+                backoff = min(WARM_PROBE_MAX_DELAY, WARM_PROBE_BASE_DELAY * 2 ** attempt)
+                time.sleep(min(remaining, backoff/2 + random.uniform(0, backoff/2)))
+                attempt += 1
+                metrics.add(retries=1)
+        finally:
+            metrics.stop()
 
     def check_user(self,sub):
+        cached = user_cache.get(sub)
+        if cached is not None:
+            return cached
         DataAccessLayer._xray_start('check_user')
         try:
-            sql_parameters = [
-                {'name':'sub', 'value':{'stringValue': sub}}
-            ]
-            sql = f'select user_id, user_name, allowed_roles' \
-                f' from {users_table_name}' \
-                f' where sub = :sub'
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            print(returned_records)
-            if len(returned_records) == 1:
-                return returned_records[0][0]['longValue'], returned_records[0][1]['stringValue'], returned_records[0][2]['stringValue']
+            rows = self.select('check_user', sub=sub)
+            logger.debug(rows)
+            if len(rows) == 1:
+                user = rows[0].user_id, rows[0].user_name, rows[0].allowed_roles
+                user_cache.put(sub, user)
+                return user
             else:
                 return 0,"",""
         except DataAccessLayerException as de:
@@ -166,28 +753,24 @@ class DataAccessLayer:
             DataAccessLayer._xray_stop()
 
     def get_event_and_crew(self, user_id):
+        cached = crew_cache.get(user_id)
+        if cached is not None:
+            return cached
         DataAccessLayer._xray_start('get_event_and_crew')
         try:
-            sql_parameters = [
-                {'name':'user_id', 'value':{'longValue': user_id}},
-            ]
-            sql = f'select crews.event_id, crews.crew_type' \
-                f' from {crews_table_name}' \
-                f' inner join events on crews.event_id = events.event_id' \
-                f' where crews.user_id=:user_id' \
-                f' and events.state=1'
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            if len(returned_records) == 1:
-                event_id = returned_records[0][0]['longValue']
+            rows = self.select('active_crew', user_id=user_id)
+            if len(rows) == 1:
+                event_id = rows[0].event_id
+                metrics.set_event(event_id)
                 if event_id>0:
-                    return event_id, returned_records[0][1]['stringValue']
-            sql = f'select crew_type from {crews_table_name} ' \
-                f'where event_id = 2001 and user_id = :user_id '
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            if len(returned_records) == 1:
-                return 2001, returned_records[0][0]['stringValue']
+                    crew = event_id, rows[0].crew_type
+                    crew_cache.put(user_id, crew)
+                    return crew
+            rows = self.select('test_crew', user_id=user_id)
+            if len(rows) == 1:
+                crew = 2001, rows[0].crew_type
+                crew_cache.put(user_id, crew)
+                return crew
             else:
                 return 0,""
         except DataAccessLayerException as de:
@@ -200,18 +783,9 @@ class DataAccessLayer:
     def get_problem(self, problem_id):
         DataAccessLayer._xray_start('get_problem')
         try:
-            sql_parameters = [
-                {'name':'problem_id', 'value':{'longValue': problem_id}},
-            ]
-            sql = f'select event_id, crew_type, strip, problem_type, reporter_id' \
-                f' from {problems_table_name}' \
-                f' where problem_id=:problem_id'
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            if len(returned_records) > 0:
-                return returned_records[0][0]['longValue'], returned_records[0][1]['stringValue'], \
-                    returned_records[0][2]['stringValue'], returned_records[0][3]['stringValue'], \
-                    returned_records[0][4]['longValue']
+            rows = self.select('get_problem', problem_id=problem_id)
+            if len(rows) > 0:
+                return tuple(rows[0])
             else:
                 return 0,"","","",0
         except DataAccessLayerException as de:
@@ -223,24 +797,21 @@ class DataAccessLayer:
 
     def create_problem(self, user_id, event_id, crew_type, strip, problem_type):
         DataAccessLayer._xray_start('create_problem')
+        metrics.set_event(event_id)
         try:
             DataAccessLayer._xray_add_metadata('event', event_id)
             DataAccessLayer._xray_add_metadata('crew', crew_type)
             DataAccessLayer._xray_add_metadata('strip', strip)
             DataAccessLayer._xray_add_metadata('problem', problem_type)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-                {'name':'strip', 'value':{'stringValue': strip}},
-                {'name':'problem', 'value':{'stringValue': problem_type}},
-                {'name':'user', 'value':{'longValue': user_id}},
-            ]
-            sql = f'insert into {problems_table_name}' \
-                f' (event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc)' \
-                f' values (:event, :crew, :strip, :problem, :user, now())'
-            response = self.execute_statement(sql, sql_parameters)
-            return response['numberOfRecordsUpdated'] == 1
+            with self.transaction():
+                response = self.execute_query('create_problem', event=event_id, crew=crew_type, strip=strip,
+                    problem=problem_type, user=user_id)
+                if response['numberOfRecordsUpdated'] != 1:
+                    return 0
+                problem_id = DataAccessLayer._generated_key(response)
+                self._board_add(problem_id, event_id, crew_type)
+                return problem_id
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -254,16 +825,15 @@ class DataAccessLayer:
             DataAccessLayer._xray_add_metadata('problem', problem_id)
             DataAccessLayer._xray_add_metadata('resolution_code', resolution_code)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'problem', 'value':{'longValue': problem_id}},
-                {'name':'resolution', 'value':{'longValue': resolution_code}},
-                {'name':'user', 'value':{'longValue': user_id}},
-                ]
-            sql = f'UPDATE {problems_table_name} ' \
-                f' SET resolver_id = :user, resolver_time_utc = now(), resolution_code = :resolution' \
-                f' WHERE problem_id = :problem'
-            response = self.execute_statement(sql, sql_parameters)
-            return response['numberOfRecordsUpdated']==1
+            with self.transaction():
+                board_rows = self.select('board_row', problem=problem_id) #none once the problem is resolved
+                response = self.execute_query('resolve_problem', problem=problem_id, resolution=resolution_code, user=user_id)
+                if response['numberOfRecordsUpdated'] != 1:
+                    return False
+                if board_rows:
+                    self.execute_query('board_remove', problem=problem_id)
+                    self._board_changed(board_rows[0].event_id, board_rows[0].crew_type)
+                return True
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -279,19 +849,18 @@ class DataAccessLayer:
             DataAccessLayer._xray_add_metadata('problem_type', problem_type)
             DataAccessLayer._xray_add_metadata('crew_type', problem_type)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'problem', 'value':{'longValue': problem_id}},
-                {'name':'strip', 'value':{'stringValue': strip}},
-                {'name':'problem_type', 'value':{'stringValue': problem_type}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-                {'name':'user', 'value':{'longValue': user_id}},
-            ]
-            sql = f'UPDATE {problems_table_name} ' \
-                f' SET strip = :strip, problem_type = :problem_type, updater_id = :user, update_time_utc = now()' \
-                f' WHERE problem_id = :problem' \
-                f' AND crew_type = :crew'
-            response = self.execute_statement(sql, sql_parameters)
-            return response['numberOfRecordsUpdated']==1
+            with self.transaction():
+                board_rows = self.select('board_row', problem=problem_id) #none once the problem is resolved
+                response = self.execute_query('update_problem', problem=problem_id, strip=strip, problem_type=problem_type,
+                    crew=crew_type, user=user_id)
+                if response['numberOfRecordsUpdated'] != 1:
+                    return False
+                if board_rows:
+                    response = self.execute_query('board_update', problem=problem_id, strip=strip, problem_type=problem_type,
+                        crew=crew_type)
+                    if response['numberOfRecordsUpdated'] > 0:
+                        self._board_changed(board_rows[0].event_id, crew_type)
+                return True
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -299,8 +868,45 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
+    def _board_add(self, problem_id, event_id, crew_type):
+        # call inside the transaction that inserted the problem
+        self.execute_query('board_add', problem=problem_id)
+        self._board_changed(event_id, crew_type)
+
+    def _board_changed(self, event_id, crew_type):
+        # Bump the board's version in one upsert; its first change creates it at version 1
+        self.execute_query('board_bump', event=event_id, crew=crew_type)
+
     def message(self, user_id, event_id, crew_type, problem_id, message_text):
+        # The message, its receipts and (outbox mode) its deliveries are one unit of work; push and SMS
+        # only go out once it has committed, so a recipient never gets a notification for a missing receipt
+        with self.transaction() as unit:
+            stored = self._store_message(user_id, event_id, crew_type, problem_id, message_text)
+            if stored is None:
+                unit.set_rollback_only()
+                return False
+            message_id, push, sms, all_found = stored
+            if NOTIFY_MODE == 'outbox':
+                from .outbox import wake_outbox_worker
+                unit.after_commit(wake_outbox_worker)
+            else:
+                unit.after_commit(lambda: self._send(push, sms, event_id))
+        if unit.nested or NOTIFY_MODE == 'outbox':
+            return all_found
+        return all_found and unit.results[-1]
+
+    @staticmethod
+    def _send(push, sms, event_id=None):
+        #push and SMS go out concurrently
+        from .notify import deliver
+        results = deliver(push, sms, event_id)
+        logger.info(f'deliveries={results}')
+        return all(result['ok'] for result in results)
+
+    def _store_message(self, user_id, event_id, crew_type, problem_id, message_text):
+        # message() minus the sending: returns (message_id, push, sms, all_found), or None on failure
         DataAccessLayer._xray_start('message')
+        metrics.set_event(event_id)
         try:
             #First we create the new message
             #Then we create receipts for the crew that gets the message
@@ -313,86 +919,44 @@ class DataAccessLayer:
             DataAccessLayer._xray_add_metadata('problem', problem_id)
             DataAccessLayer._xray_add_metadata('text', message_text)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-                {'name':'problem', 'value':{'longValue': problem_id}},
-                {'name':'text', 'value':{'stringValue': message_text}},
-                {'name':'user', 'value':{'longValue': user_id}},
-            ]
-            sql = f'insert into {messages_table_name}' \
-                f' (event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc)' \
-                f' values (:event, :crew, :problem, :text, :user, now())'
-            response = self.execute_statement(sql, sql_parameters)
+            response = self.execute_query('store_message', event=event_id, crew=crew_type, problem=problem_id,
+                text=message_text, user=user_id)
             if response['numberOfRecordsUpdated']!=1:
-                logger.info('failed to insert problem')
-                return True
-            sql = f'SELECT message_id from {messages_table_name} WHERE' \
-                f' event_id=:event AND crew_type=:crew AND problem_id=:problem AND message_text=:text AND sender_id=:user'
-            response = self.execute_statement(sql, sql_parameters)
-            records = response['records']
-            if len(records) < 1:
+                logger.info('failed to insert message')
+                return None
+            message_id = DataAccessLayer._generated_key(response)
+            if message_id == 0:
                 logger.info('failed to retrieve message id')
-                return False
-            message_id = records[len(records)-1][0]['longValue']
+                return None
             logger.info(f'message {message_id}')
                 #create receipt records for all crew members
-            sql_parameters = [
-                {'name':'problem', 'value':{'longValue': problem_id}},
-            ]
-            sql = f'select strip, problem_type, reporter_id from {problems_table_name} ' \
-                f'where problem_id=:problem'
-            response = self.execute_statement(sql, sql_parameters)
-            records = response['records']
-            if len(records) != 1:
+            problem_rows = self.select('get_problem', problem_id=problem_id)
+            if len(problem_rows) != 1:
                 logger.info(f'could not get reporter for problem {problem_id}')
-                return False
-            strip = records[0][0]['stringValue']
-            ptype = records[0][1]['stringValue']
-            prbtype = ptype[0:2]
+                return None
+            strip = problem_rows[0].strip
+            prbtype = problem_rows[0].problem_type[0:2]
             print(f'ptype={prbtype}, strip={strip}')
-            reporter_id = records[0][2]['longValue']
-            fcm_data = {"notification": { "title": strip, "body": message_text}, "to": "/topics/"+str(event_id)+crew_type,
-                "data": {'message_id': message_id}}
-            print(fcm_data)
-            fcm_data_json = json.dumps(fcm_data)
-            print(fcm_data_json)
-            key = f'Key={FCM_KEY}'
-            fcm_headers = {'Content-type': 'application/json', 'Authorization': key}
-            print(fcm_headers)
-            url = 'https://fcm.googleapis.com/fcm/send'
-            response = requests.post(url, data=fcm_data_json, headers=fcm_headers)
-            print(f'back from request, response={response}')
-            if response.status_code != 200:
-                logger.info(f'could not send notification to FCM, response was {response}')
-                return false
-            jsonResponse = json.loads(response.content)
-            print(jsonResponse)
+            reporter_id = problem_rows[0].reporter_id
+            push = {'topic': str(event_id)+crew_type, 'title': strip, 'body': message_text, 'message_id': message_id}
 
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-            ]
-            sql = f'select user_id, sms from {crews_table_name} '\
-                f'where event_id=:event AND crew_type=:crew'
-            response = self.execute_statement(sql, sql_parameters)
-            records = response['records']
-            num_records = len(records)
+            crew_rows = self.select('crew_members', event=event_id, crew=crew_type)
+            num_records = len(crew_rows)
             logger.info(f'crew size={num_records}')
             if num_records<1:
-                return False
-            sql_parameters_sets = []
+                return None
+            receipt_sets = []
             sms_crew = []
             reporter_increw = False
             sender_increw = False
-            for record in records:
-                print(record)
-                recipient_id = record[0]['longValue']
+            for row in crew_rows:
+                logger.debug(row)
+                recipient_id = row.user_id
                 if recipient_id == user_id:
                     sender_increw = True #sender is in the crew
                 if recipient_id == reporter_id:
                     reporter_increw = True #problem reporter is in the crew
-                sms = record[1]['booleanValue']
+                sms = row.sms
                 print(f'SMS crewmember {sms}')
                 if sms==True:
                     sms_crew.append(recipient_id)
@@ -400,123 +964,111 @@ class DataAccessLayer:
                     num_records -= 1
                 else:
                     logger.info(f'Adding receipt for {recipient_id}')
-                    sql_parameters_sets.append([
-                        {'name':'event', 'value':{'longValue': event_id}},
-                        {'name':'problem', 'value':{'longValue': problem_id}},
-                        {'name':'message', 'value':{'longValue': message_id}},
-                        {'name':'recipient', 'value':{'longValue': recipient_id}},
-                    ])
-            sql = f'insert into {receipts_table_name}' \
-                f'(event_id, problem_id, message_id, recipient_id) ' \
-                f'values (:event, :problem, :message, :recipient)'
-            response = self.batch_execute_statement(sql, sql_parameters_sets, 100)
-            num_updated = len(response[0]['updateResults'])
+                    receipt_sets.append({'event': event_id, 'problem': problem_id, 'message': message_id,
+                        'recipient': recipient_id})
+            response = self.execute_batch('add_receipt', receipt_sets)
+            num_updated = len(DataAccessLayer.update_results(response))
             print(f'num_updated={num_updated}')
             print(f'sender={user_id}, reporter={reporter_id}, {sender_increw}, {reporter_increw}')
             if num_updated != num_records:
                 logger.info(f'receipt update failed, got {num_updated} expected {num_records}')
-                return False
+                return None
             #sender could be sms or reporter could be sms but if sender is sms, he has to be the reporter.
             test_id=""
             if reporter_increw:
                 if sender_increw:
                     test_id=""#return True  #both reporter and sender are in crew, nothing else to do
                 else:
-                    test_id = sender_id #repprter is in, sender is not
+                    test_id = user_id #repprter is in, sender is not
             else:
                 if sender_increw:
                     test_id = reporter_id  #sender is in  reporter is not
                 else:
                     if user_id != reporter_id:
                         logger.info(f'neither sender {user_id} nor reporter {reporter_id} is in crew but reporter <> sender')
-                        return False
+                        return None
                     if user_id == reporter_id:
                         test_id="" #sender = reporter and sms, so no sms needed
                     else: test_id=reporter_id #they are the same, doesn't matter which
             print(f'test_id={test_id}')
             if test_id != "":
-                sql_parameters = [
-                    {'name':'user', 'value':{'longValue': test_id}},
-                    ]
-                sql = f'select sub from {users_table_name} '\
-                    f'where user_id=:user'
-                response = self.execute_statement(sql, sql_parameters)
-                records = response['records']
-                if len(records)!=1:
+                sub_rows = self.select('user_sub', user=test_id)
+                if len(sub_rows)!=1:
                     logger.info(f'could not get mobile for user {test_id}')
-                    return False
-                print(f'records={records}')
-                subDict = records[0][0]
-                print(subDict)
-                if 'stringValue' in subDict: #user is on app, create receipt
+                    return None
+                logger.debug(f'rows={sub_rows}')
+                if sub_rows[0].sub is not None: #user is on app, create receipt
                     logger.info(f'Adding receipt for {test_id}')
-                    sql_parameters = [
-                        {'name':'event', 'value':{'longValue': event_id}},
-                        {'name':'problem', 'value':{'longValue': problem_id}},
-                        {'name':'message', 'value':{'longValue': message_id}},
-                        {'name':'recipient', 'value':{'longValue': test_id}},
-                        ]
-                    sql = f'insert into {receipts_table_name}' \
-                        f'(event_id, problem_id, message_id, recipient_id) ' \
-                        f'values (:event, :problem, :message, :recipient)'
-                    response = self.execute_statement(sql, sql_parameters)
+                    response = self.execute_query('add_receipt', event=event_id, problem=problem_id, message=message_id,
+                        recipient=test_id)
                     if response['numberOfRecordsUpdated']!=1:
                         logger.info(f'Failed to insert receipt for user {test_id}')
-                        return False
+                        return None
                 else:
                     sms_crew.append(test_id)
 
-            if len(sms_crew)==0: return True # no SMS
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': 'ARM'}},
-            ]
-            sql = f'select arm_tn from {events_table_name} '\
-                f'where event_id=:event'
-            response = self.execute_statement(sql, sql_parameters)
-            records = response['records']
-            if len(records) != 1:
-                logger.info(f'could not get twilio tn for event {event_id}')
-                return False
-            from_tn = records[0][0]['stringValue']
-            logger.info(f'from_tn {from_tn}')
-            TWILIO_SMS_URL = "https://api.twilio.com/2010-04-01/Accounts/{}/Messages.json"
-            populated_url = TWILIO_SMS_URL.format(TWILIO_ACCOUNT_SID)
-            print(populated_url)
-            for send_id in sms_crew:
-                sql_parameters = [
-                    {'name':'user', 'value':{'longValue': send_id}},
-                    ]
-                sql = f'select mobile from {users_table_name} '\
-                    f'where user_id=:user'
+            sms = []
+            all_found = True
+            if len(sms_crew) > 0:
+                tn_rows = self.select('event_tn', event=event_id)
+                if len(tn_rows) != 1:
+                    logger.info(f'could not get twilio tn for event {event_id}')
+                    return None
+                from_tn = tn_rows[0].arm_tn
+                logger.info(f'from_tn {from_tn}')
+                #one lookup for every SMS recipient's mobile
+                sql_parameters = []
+                id_names = []
+                for i, send_id in enumerate(sms_crew):
+                    id_names.append(f':u{i}')
+                    sql_parameters.append({'name':f'u{i}', 'value':{'longValue': send_id}})
+                sql = f'select user_id, mobile from {users_table_name} '\
+                    f'where user_id in ({", ".join(id_names)})'
                 response = self.execute_statement(sql, sql_parameters)
-                records = response['records']
-                if len(records)!=1:
-                    logger.info(f'could not get mobile for user {send_id}')
-                    return False
-                print(f'records={records}')
-                toDict = records[0][0]
-                print(f'to response={toDict}')
-                if 'stringValue' not in toDict:
-                    return False
-                to_tn = toDict['stringValue']
-                logger.info(f'to_tn {to_tn}')
-
-                post_params = {"To": to_tn, "From": from_tn, "Body": message_text}
-                print(post_params)
-                # encode the parameters for Python's urllib
-                data = parse.urlencode(post_params).encode()
-                req = request.Request(populated_url)
-
-                # add authentication header to request based on Account SID + Auth Token
-                authentication = "{}:{}".format(TWILIO_ACCOUNT_SID, TWILIO_AUTH)
-                base64string = base64.b64encode(authentication.encode('utf-8'))
-                print("Basic %s" % base64string.decode('ascii'))
-                req.add_header("Authorization", "Basic %s" % base64string.decode('ascii'))
-                with request.urlopen(req, data) as f:
-                    logger.info("Twilio returned {}".format(str(f.read().decode('utf-8'))))
+                mobiles = {record[0]['longValue']: record[1].get('stringValue') for record in response['records']}
+                for send_id in sms_crew:
+                    to_tn = mobiles.get(send_id)
+                    if to_tn is None:
+                        logger.info(f'could not get mobile for user {send_id}')
+                        all_found = False
+                        continue
+                    sms.append({'from_tn': from_tn, 'to_tn': to_tn, 'body': message_text})
+            if NOTIFY_MODE == 'outbox':
+                if not self.enqueue_notifications(message_id, push, sms):
+                    logger.info(f'could not queue notifications for message {message_id}')
+                    return None
+            return message_id, push, sms, all_found
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
 
-            return True
+    @staticmethod
+    def _utc(seconds_from_now=0):
+        return (datetime.utcnow() + timedelta(seconds=seconds_from_now)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def enqueue_notifications(self, message_id, push, sms):
+        # One outbox row per delivery; dedupe_key keeps a recipient from getting the same message twice
+        DataAccessLayer._xray_start('enqueue_notifications')
+        try:
+            jobs = [('push', push['topic'], push)] if push is not None else []
+            jobs += [('sms', one_sms['to_tn'], one_sms) for one_sms in sms]
+            now = DataAccessLayer._utc()
+            outbox_sets = []
+            dedupe_keys = set()
+            for channel, recipient, payload in jobs:
+                dedupe_key = f'{message_id}:{channel}:{recipient}'
+                if dedupe_key in dedupe_keys:
+                    continue
+                dedupe_keys.add(dedupe_key)
+                outbox_sets.append({'message': message_id, 'channel': channel, 'recipient': recipient,
+                    'dedupe': dedupe_key, 'payload': json.dumps(payload), 'now': now})
+            if len(outbox_sets) == 0:
+                return True
+            response = self.execute_batch('outbox_enqueue', outbox_sets)
+            return len(DataAccessLayer.update_results(response)) == len(outbox_sets)
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -524,52 +1076,207 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
-    def poll(self, user_id, event_id, crew_type):
-        DataAccessLayer._xray_start('poll')
+    def claim_outbox(self, batch_size, max_attempts, lease_seconds):
+        # Lease up to batch_size due deliveries to this worker by pushing next_attempt_utc past the
+        # lease, so a concurrent worker skips them and a crashed worker's rows come back on their own.
+        DataAccessLayer._xray_start('claim_outbox')
         try:
-            sql_parameters = [
-                {'name':'user', 'value':{'longValue': user_id}},
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-            ]
-            sql = f'select {problems_table_name}.problem_id, {problems_table_name}.strip, {problems_table_name}.problem_type, '\
-                f' {users_table_name}.user_name' \
-                f' from {problems_table_name} inner join {users_table_name} ON' \
-                f' {problems_table_name}.reporter_id = {users_table_name}.user_id' \
-                f' where {problems_table_name}.event_id = :event' \
-                f' and {problems_table_name}.crew_type = :crew' \
-                f' and {problems_table_name}.resolution_code is null'
-            response = self.execute_statement(sql, sql_parameters)
-            problem_results = [
-                {
-                    'problem_id': record[0]['longValue'],
-                    'strip': record[1]['stringValue'],
-                    'problem_type': record[2]['stringValue'],
-                    'reporter': record[3]['stringValue']
-                }
-                for record in response['records']
-            ]
-            sql = f'select {messages_table_name}.message_id, {messages_table_name}.problem_id,' \
-                f' {messages_table_name}.message_text' \
-                f' from {messages_table_name}' \
-                f' inner join {receipts_table_name}' \
-                f' on {messages_table_name}.message_id = {receipts_table_name}.message_id' \
-                f' where {messages_table_name}.event_id = :event' \
-                f' and {messages_table_name}.crew_type = :crew' \
-                f' and {receipts_table_name}.recipient_id = :user' \
-                f' and {receipts_table_name}.receipt_time_utc is null'
-            response = self.execute_statement(sql, sql_parameters)
-            message_results = [
+            now = DataAccessLayer._utc()
+            due_rows = self.select('outbox_due', now=now, max=max_attempts, limit=batch_size)
+            if len(due_rows) == 0:
+                return []
+            claim_id = str(uuid.uuid4())
+            lease = DataAccessLayer._utc(lease_seconds)
+            # the lease only takes rows still due, so a row another worker claimed meanwhile is skipped
+            self.execute_batch('outbox_lease', [{'outbox': row.outbox_id, 'claim': claim_id, 'lease': lease, 'now': now}
+                for row in due_rows])
+            results = [
                 {
-                    'message_id': record[0]['longValue'],
-                    'problem_id': record[1]['longValue'],
-                    'message_text': record[2]['stringValue']
+                    'outbox_id': row.outbox_id,
+                    'channel': row.channel,
+                    'dedupe_key': row.dedupe_key,
+                    'payload': json.loads(row.payload),
+                    'attempts': row.attempts
                 }
-                for record in response['records']
+                for row in self.select('outbox_claimed', claim=claim_id)
             ]
-            return problem_results, message_results
+            return results
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def complete_outbox(self, outbox_ids):
+        DataAccessLayer._xray_start('complete_outbox')
+        try:
+            if len(outbox_ids) == 0:
+                return 0
+            now = DataAccessLayer._utc()
+            response = self.execute_batch('outbox_sent', [{'outbox': outbox_id, 'now': now} for outbox_id in outbox_ids])
+            return len(DataAccessLayer.update_results(response))
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def retry_outbox(self, failures):
+        # failures: list of (outbox_id, delay_seconds, error text)
+        DataAccessLayer._xray_start('retry_outbox')
+        try:
+            if len(failures) == 0:
+                return 0
+            response = self.execute_batch('outbox_retry', [
+                {'outbox': outbox_id, 'next': DataAccessLayer._utc(delay), 'error': error_text[0:255]}
+                for outbox_id, delay, error_text in failures
+            ])
+            return len(DataAccessLayer.update_results(response))
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def poll(self, user_id, event_id, crew_type):
+        DataAccessLayer._xray_start('poll')
+        metrics.set_event(event_id)
+        try:
+            board_version, problem_results = self.board(event_id, crew_type)
+            message_results = self.select('unread_messages', event=event_id, crew=crew_type, user=user_id)
+            return problem_results, message_results, board_version
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def board(self, event_id, crew_type):
+        # (version, open problems) of a crew's board; a board nobody has touched yet is version 0 and empty
+        DataAccessLayer._xray_start('board')
+        metrics.set_event(event_id)
+        try:
+            rows = self.select('board', event=event_id, crew=crew_type)
+            version = rows[0]['version'] if rows else 0
+            problems = [{
+                'problem_id': row['problem_id'],
+                'strip': row['strip'],
+                'problem_type': row['problem_type'],
+                'reporter': row['reporter']
+            } for row in rows if row['problem_id'] is not None]
+            return version, problems
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    @staticmethod
+    def parse_poll_cursor(cursor):
+        # cursor is 'YYYYMMDDhhmmss-<event_id>-<crew_type>' as returned by poll_user.  Returns the time to
+        # look back to (POLL_CURSOR_OVERLAP before the cursor) and the crew it was issued for; cursors
+        # from before the crew was recorded come back with crew (None, None), which forces a full poll.
+        try:
+            parts = cursor.split('-')
+            stamp = parts[0]
+            if len(parts) not in (2, 3) or len(stamp) != 14 or not stamp.isdecimal():
+                raise ValueError(cursor)
+            since = datetime.strptime(stamp, '%Y%m%d%H%M%S') - timedelta(seconds=POLL_CURSOR_OVERLAP)
+            if len(parts) == 2:
+                return since.strftime('%Y-%m-%d %H:%M:%S'), None, None
+            return since.strftime('%Y-%m-%d %H:%M:%S'), int(parts[1]), parts[2]
+        except ValueError:
+            raise ValueError(f'Invalid poll cursor: {cursor}')
+
+    def poll_user(self, sub, cursor=None):
+        # Fused poll: resolves the user, the active crew, open problems and unread messages in one
+        # round trip. Candidate crews come back as 'U' rows and the crew is chosen with the same rules
+        # as get_event_and_crew; 'P' and 'M' rows are fetched for every candidate crew and filtered here.
+        # A full poll reads the crews' open-problem boards, and each 'U' row carries its board's version.
+        # With a cursor only problems reported/updated/resolved and unread messages sent since the cursor
+        # time, less POLL_CURSOR_OVERLAP, are returned (resolved problems as ids).  Rows are stamped inside
+        # their transaction and only become visible at commit, so the window looks back further than a
+        # transaction takes: a change can be sent more than once, but is never skipped.  A cursor issued
+        # for another event or crew gets a full poll instead.  resolved is None for a full poll.
+        DataAccessLayer._xray_start('poll_user')
+        try:
+            if cursor is None:
+                rows = self.select('poll_user', sub=sub)
+            else:
+                since, cursor_event_id, cursor_crew_type = DataAccessLayer.parse_poll_cursor(cursor)
+                rows = self.select('poll_user_since', sub=sub, since=since)
+            user_id = 0
+            db_now = ''
+            active_crews = []
+            test_crews = []
+            board_versions = {}
+            problem_rows = []
+            message_rows = []
+            for row in rows:
+                kind = row['kind']
+                if kind == 'U':
+                    user_id = row['id']
+                    db_now = row['text3']
+                    if row['event_id'] is None:
+                        continue
+                    crew = (row['event_id'], row['crew_type'])
+                    board_versions[crew] = row['ref_id'] or 0
+                    if row['num'] == 1:
+                        active_crews.append(crew)
+                    if crew[0] == 2001:
+                        test_crews.append(crew)
+                elif kind == 'P':
+                    problem_rows.append(row)
+                else:
+                    message_rows.append(row)
+            if user_id == 0:
+                return 0, [], [], [], cursor, 0
+            if len(active_crews) == 1 and active_crews[0][0] > 0:
+                event_id, crew_type = active_crews[0]
+            elif len(test_crews) == 1:
+                event_id, crew_type = test_crews[0]
+            else:
+                event_id, crew_type = 0, ''
+            if cursor is not None and (event_id, crew_type) != (cursor_event_id, cursor_crew_type):
+                return self.poll_user(sub)
+            metrics.set_event(event_id or None)
+            problem_results = []
+            resolved_results = []
+            for row in problem_rows:
+                if row['event_id'] != event_id or row['crew_type'] != crew_type:
+                    continue
+                if row['num'] is not None:
+                    resolved_results.append(row['id'])
+                    continue
+                problem_results.append({
+                    'problem_id': row['id'],
+                    'strip': row['text1'],
+                    'problem_type': row['text2'],
+                    'reporter': row['text3']
+                })
+            message_results = []
+            for row in message_rows:
+                if row['event_id'] != event_id or row['crew_type'] != crew_type:
+                    continue
+                message_results.append({
+                    'message_id': row['id'],
+                    'problem_id': row['ref_id'],
+                    'message_text': row['text1']
+                })
+            next_cursor = ''.join(ch for ch in db_now[0:19] if ch.isdecimal()) + f'-{event_id}-{crew_type}'
+            board_version = board_versions.get((event_id, crew_type), 0)
+            if cursor is None:
+                resolved_results = None
+            return user_id, problem_results, message_results, resolved_results, next_cursor, board_version
         except DataAccessLayerException as de:
             raise de
+        except ValueError as ve:
+            raise ve
         except Exception as e:
             raise DataAccessLayerException(e) from e
         finally:
@@ -580,14 +1287,7 @@ class DataAccessLayer:
         try:
             DataAccessLayer._xray_add_metadata('message_id', message_id)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'message', 'value':{'longValue': message_id}},
-                {'name':'user', 'value':{'longValue': user_id}},
-                ]
-            sql = f'UPDATE {receipts_table_name} ' \
-                f' SET receipt_time_utc = now() ' \
-                f' WHERE message_id = :message AND recipient_id=:user'
-            response = self.execute_statement(sql, sql_parameters)
+            response = self.execute_query('receipt', message=message_id, user=user_id)
             return response['numberOfRecordsUpdated']>=1
         except DataAccessLayerException as de:
             raise de
@@ -596,28 +1296,83 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
-    def hello(self, event_id, user_id):
-        DataAccessLayer._xray_start('hello')
+    def receipts(self, user_id, message_ids=None, problem_id=None, up_to_message_id=None):
+        # Acknowledge many messages with one SELECT and one set-based UPDATE.  Select by an explicit
+        # list of message ids and/or every unread message for a problem and/or up to a message id.
+        # Returns [{'message_id', 'status'}] with status acknowledged, already_acknowledged or not_found.
+        # At least one selector is required: with none this would acknowledge everything the user has unread.
+        DataAccessLayer._xray_start('receipts')
         try:
-            DataAccessLayer._xray_add_metadata('event', crew_type)
+            if not message_ids and problem_id is None and up_to_message_id is None:
+                raise ValueError('receipts needs message_ids, problem_id or up_to_message_id')
             DataAccessLayer._xray_add_metadata('user', user_id)
             sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
                 {'name':'user', 'value':{'longValue': user_id}},
-                ]
-            sql = f'SELECT crew_id, crew_type FROM {crews_table_name} ' \
-                f' WHERE event_id = :event AND user_id = :user'
-            response = self.execute_statement(sql, sql_parameters)
-            results = [
-                {
-                    'crew_id': record[0]['longValue'],
-                    'crew_type': record[1]['stringValue'],
-                }
-                for record in response['records']
             ]
+            where = ' WHERE recipient_id = :user'
+            if message_ids:
+                id_names = []
+                for i, message_id in enumerate(message_ids):
+                    id_names.append(f':m{i}')
+                    sql_parameters.append({'name':f'm{i}', 'value':{'longValue': message_id}})
+                where += f' AND message_id IN ({", ".join(id_names)})'
+            else:
+                where += ' AND receipt_time_utc IS NULL'
+            if problem_id is not None:
+                sql_parameters.append({'name':'problem', 'value':{'longValue': problem_id}})
+                where += ' AND problem_id = :problem'
+            if up_to_message_id is not None:
+                sql_parameters.append({'name':'upto', 'value':{'longValue': up_to_message_id}})
+                where += ' AND message_id <= :upto'
+            sql = f'SELECT message_id, receipt_time_utc FROM {receipts_table_name}{where}'
+            response = self.execute_statement(sql, sql_parameters)
+            pending = []
+            acknowledged = set()
+            for record in response['records']:
+                message_id = record[0]['longValue']
+                if record[1].get('isNull'):
+                    if message_id not in pending:
+                        pending.append(message_id)
+                else:
+                    acknowledged.add(message_id)
+            if pending:
+                sql_parameters = [
+                    {'name':'user', 'value':{'longValue': user_id}},
+                ]
+                id_names = []
+                for i, message_id in enumerate(pending):
+                    id_names.append(f':m{i}')
+                    sql_parameters.append({'name':f'm{i}', 'value':{'longValue': message_id}})
+                sql = f'UPDATE {receipts_table_name} ' \
+                    f' SET receipt_time_utc = now() ' \
+                    f' WHERE recipient_id = :user AND receipt_time_utc IS NULL' \
+                    f' AND message_id IN ({", ".join(id_names)})'
+                self.execute_statement(sql, sql_parameters)
+            results = [{'message_id': message_id, 'status': 'acknowledged'} for message_id in pending]
+            for message_id in (message_ids or []):
+                if message_id in pending:
+                    continue
+                status = 'already_acknowledged' if message_id in acknowledged else 'not_found'
+                results.append({'message_id': message_id, 'status': status})
             return results
         except DataAccessLayerException as de:
             raise de
+        except ValueError as ve:
+            raise ve
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
+    def hello(self, event_id, user_id):
+        DataAccessLayer._xray_start('hello')
+        metrics.set_event(event_id)
+        try:
+            DataAccessLayer._xray_add_metadata('event', event_id)
+            DataAccessLayer._xray_add_metadata('user', user_id)
+            return self.select('hello', event=event_id, user=user_id)
+        except DataAccessLayerException as de:
+            raise de
         except Exception as e:
             raise DataAccessLayerException(e) from e
         finally:
@@ -626,21 +1381,7 @@ class DataAccessLayer:
     def tourney(self):
         DataAccessLayer._xray_start('tourney')
         try:
-            sql = f'SElECT * FROM {events_table_name} ' \
-                    f' WHERE (start_date_utc<now() AND end_date_utc>now())'
-            response = self.execute_statement(sql)
-            results = [
-                {
-                    'event_id': record[0]['longValue'],
-                    'event_name': record[1]['stringValue'],
-                    'event_type': record[2]['stringValue'],
-                    'start_date_utc': record[3]['stringValue'],
-                    'end_date_utc': record[4]['stringValue'],
-                    'state': record[5]['longValue']
-                }
-                for record in response['records']
-            ]
-            return results
+            return self.select('tourney')
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -651,17 +1392,8 @@ class DataAccessLayer:
     def old_events(self):
         DataAccessLayer._xray_start('old_events')
         try:
-            sql = f'SElECT event_id, state FROM {events_table_name} ' \
-                    f' WHERE end_date_utc<now() AND state != 2'
-            response = self.execute_statement(sql)
-            print(response['records'])
-            results = [
-                {
-                    'event_id': record[0]['longValue'],
-                    'state': record[1]['longValue']
-                }
-                for record in response['records']
-            ]
+            results = self.select('old_events')
+            logger.debug(results)
             return results
         except DataAccessLayerException as de:
             raise de
@@ -670,33 +1402,30 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
+    def event_windows(self, horizon_hours):
+        # (start, end) strings of events not yet over that start within the horizon, for the warm-up plan
+        DataAccessLayer._xray_start('event_windows')
+        try:
+            rows = self.select('event_windows', horizon=DataAccessLayer._utc(horizon_hours*3600))
+            return [tuple(row) for row in rows]
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
     def add_crew(self, event_id, crew_type, user_id):
         DataAccessLayer._xray_start('add_crew')
+        metrics.set_event(event_id)
         try:
             DataAccessLayer._xray_add_metadata('event', event_id)
             DataAccessLayer._xray_add_metadata('crew', crew_type)
             DataAccessLayer._xray_add_metadata('user', user_id)
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'user', 'value':{'longValue': user_id}},
-            ]
-            sql = f'select crew_id' \
-                f' from {crews_table_name}' \
-                f' where user_id=:user' \
-                f' and event_id=:event'
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            if len(returned_records) >= 1:
+            if len(self.select('find_crew', event=event_id, user=user_id)) >= 1:
                 return 1
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-                {'name':'user', 'value':{'longValue': user_id}},
-                ]
-            sql = f'INSERT INTO {crews_table_name} ' \
-                f' (event_id, crew_type,user_id, sms) ' \
-                f' VALUES (:event, :crew, :user, false)'
-            response = self.execute_statement(sql, sql_parameters)
+            response = self.execute_query('add_crew', event=event_id, crew=crew_type, user=user_id)
+            crew_cache.invalidate(user_id)
             return response['numberOfRecordsUpdated']
         except DataAccessLayerException as de:
             raise de
@@ -706,17 +1435,13 @@ class DataAccessLayer:
             DataAccessLayer._xray_stop()
 
     def change_state(self, event_id, new_state):
+        DataAccessLayer._xray_start('change_state')
+        metrics.set_event(event_id)
         DataAccessLayer._xray_add_metadata('event', event_id)
         DataAccessLayer._xray_add_metadata('state', new_state)
         try:
-            sql_parameters = [
-                {'name':'event', 'value':{'longValue': event_id}},
-                {'name':'state', 'value':{'longValue': new_state}},
-            ]
-            sql = f'UPDATE {events_table_name} ' \
-                f' SET state = :state' \
-                f' WHERE event_id = :event'
-            response = self.execute_statement(sql, sql_parameters)
+            response = self.execute_query('change_state', event=event_id, state=new_state)
+            crew_cache.clear() #active event changed for everyone in it
             return response['numberOfRecordsUpdated']
         except DataAccessLayerException as de:
             raise de
@@ -725,58 +1450,47 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
-
-    def cleanup(self, event_id):
+    def cleanup(self, event_id, chunk_size=1000, deadline=None):
+        # Close out an event with chunked set-based updates: each UPDATE ... LIMIT commits on its own
+        # and only touches rows that are still open, so an interrupted cleanup resumes where it
+        # stopped when called again.  deadline is a time.monotonic() value to stop before.
+        DataAccessLayer._xray_start('cleanup')
+        metrics.set_event(event_id)
         DataAccessLayer._xray_add_metadata('event', event_id)
-        event_sql_parameters = [
-            {'name':'event', 'value':{'longValue': event_id}}
-        ]
-        try:
-            sql = f'SELECT receipt_id from {receipts_table_name} ' \
-                f' WHERE event_id = :event' \
-                f' AND receipt_time_utc IS NULL'
-            response = self.execute_statement(sql, event_sql_parameters)
-            returned_records = response['records']
-            for record in returned_records:
-                receipt_id = record[0]['longValue']
-                sql_parameters = [
-                    {'name':'receipt', 'value':{'longValue': receipt_id}}
-                ]
-                sql = f'UPDATE {receipts_table_name} ' \
+        try:
+            steps = [
+                ('receipts', f'UPDATE {receipts_table_name} ' \
                     f' SET receipt_time_utc = now()' \
-                    f' WHERE receipt_id = :receipt'
-                receipt_response = self.execute_statement(sql, sql_parameters)
-            sql = f'SELECT message_id from {messages_table_name} ' \
-                f' WHERE event_id = :event' \
-                f' AND finished_time_utc IS NULL'
-            response = self.execute_statement(sql, event_sql_parameters)
-            returned_records = response['records']
-            for record in returned_records:
-                message_id = record[0]['longValue']
-
-                sql_parameters = [
-                    {'name':'message', 'value':{'longValue': message_id}}
-                ]
-                sql = f'UPDATE {messages_table_name} ' \
+                    f' WHERE event_id = :event AND receipt_time_utc IS NULL LIMIT {int(chunk_size)}'),
+                ('messages', f'UPDATE {messages_table_name} ' \
                     f' SET finished_time_utc = now()' \
-                    f' WHERE message_id = :message'
-                message_response = self.execute_statement(sql, sql_parameters)
-            sql = f'SELECT problem_id from {problems_table_name} ' \
-                f' WHERE event_id = :event' \
-                f' AND resolver_id IS NULL'
-            response = self.execute_statement(sql, event_sql_parameters)
-            returned_records = response['records']
-            for record in returned_records:
-                problem_id = record[0]['longValue']
-
-                sql_parameters = [
-                    {'name':'problem', 'value':{'longValue': problem_id}}
-                ]
-                sql = f'UPDATE {problems_table_name} ' \
+                    f' WHERE event_id = :event AND finished_time_utc IS NULL LIMIT {int(chunk_size)}'),
+                ('problems', f'UPDATE {problems_table_name} ' \
                     f' SET resolver_id = 1001, resolver_time_utc = now(), resolution_code=77' \
-                    f' WHERE problem_id = :problem'
-                problem_response = self.execute_statement(sql, sql_parameters)
-            return 1
+                    f' WHERE event_id = :event AND resolver_id IS NULL LIMIT {int(chunk_size)}'),
+                ('board', f'DELETE FROM {board_problems_table_name} ' \
+                    f' WHERE event_id = :event LIMIT {int(chunk_size)}'),
+            ]
+            event_sql_parameters = [
+                {'name':'event', 'value':{'longValue': event_id}}
+            ]
+            counts = {'receipts': 0, 'messages': 0, 'problems': 0, 'board': 0, 'complete': False}
+            for name, sql in steps:
+                while True:
+                    if deadline is not None and time.monotonic() > deadline:
+                        logger.info(f'cleanup of event {event_id} stopped at deadline: {counts}')
+                        return counts
+                    response = self.execute_statement(sql, event_sql_parameters)
+                    updated = response['numberOfRecordsUpdated']
+                    counts[name] += updated
+                    if updated < chunk_size:
+                        break
+            # the event's boards are empty now; bump on every finished run, since the run that deleted the
+            # last board rows may have stopped at its deadline before getting here
+            self.execute_query('board_bump_event', event=event_id)
+            counts['complete'] = True
+            logger.info(f'cleanup of event {event_id}: {counts}')
+            return counts
         except DataAccessLayerException as de:
             raise de
         except Exception as e:
@@ -786,58 +1500,42 @@ class DataAccessLayer:
 
 
     def sms_incoming(self, to_tn, from_tn, msg):
-        DataAccessLayer._xray_start('sms incoming')
+        # New ref, new problem and the message are one unit of work; failure codes roll all of it back
+        with self.transaction() as unit:
+            code = self._sms_incoming(to_tn, from_tn, msg)
+            if code in (0, 3, 4):
+                unit.set_rollback_only()
+        return code
+
+    def _sms_incoming(self, to_tn, from_tn, msg):
+        DataAccessLayer._xray_start('sms_incoming')
         DataAccessLayer._xray_add_metadata('totn', to_tn)
         DataAccessLayer._xray_add_metadata('fromtn', from_tn)
         try:
             role = 'REF'
-            sql_parameters = [
-                {'name':'tn', 'value':{'stringValue': from_tn}},
-                {'name':'role', 'value':{'stringValue': role}},
-            ]
-            sql = f'SELECT user_id, user_name FROM {users_table_name} ' \
-                f' WHERE mobile = :tn'
-            response = self.execute_statement(sql,sql_parameters) #lookup ref by tn
-            returned_records = response['records']
-            if len(returned_records) == 0: #new ref
-                sql = f'INSERT INTO {users_table_name} (user_name, full_name, allowed_roles, mobile) ' \
-                    f' VALUES (:tn, :tn, :role, :tn)'
-                insert_response = self.execute_statement(sql,sql_parameters)
+            user_rows = self.select('user_by_mobile', tn=from_tn) #lookup ref by tn
+            if len(user_rows) == 0: #new ref
+                insert_response = self.execute_query('insert_ref', tn=from_tn, role=role)
                 if insert_response['numberOfRecordsUpdated']==1:
-                    sql = f'SELECT user_id from {users_table_name} where user_name=:tn'
-                    last_response = self.execute_statement(sql,sql_parameters)
-                    records = last_response['records']
-                    user_id = records[0][0]['longValue']
+                    user_id = DataAccessLayer._generated_key(insert_response)
                     user_name = from_tn
                 else:
                     return(0)
             else: #existing user
-                user_id=response['records'][0][0]['longValue']
-                user_name = response['records'][0][1]['stringValue']
+                user_id = user_rows[0].user_id
+                user_name = user_rows[0].user_name
             logger.info(user_id)
             # should checl/insert into crew table
             crew_type = 'ARM'
-            sql_parameters = [
-                {'name':'tn', 'value':{'stringValue': to_tn}},
-                {'name':'crew', 'value':{'stringValue': crew_type}},
-            ]
-            sql = f'SELECT event_id FROM {events_table_name} ' \
-                f' WHERE arm_tn=:tn'
-            event_response = self.execute_statement(sql,sql_parameters)
-            returned_records = event_response['records']
-            if len(returned_records)!=1:
+            event_rows = self.select('event_by_tn', tn=to_tn)
+            if len(event_rows)!=1:
                 return(1)
-            event_id = returned_records[0][0]['longValue']
+            event_id = event_rows[0].event_id
+            metrics.set_event(event_id)
             logger.info(event_id)
-            sql_parameters = [
-                {'name':'user_id', 'value':{'longValue': user_id}},
-            ]
-            sql = f'SELECT problem_id FROM {problems_table_name} ' \
-                f' WHERE reporter_id=:user_id AND resolution_code IS NULL'
-            prob_response = self.execute_statement(sql,sql_parameters)
-            returned_records = prob_response['records']
+            problem_rows = self.select('open_problem_by_reporter', user=user_id)
             newProb=False
-            if len(returned_records)==0: #new problem
+            if len(problem_rows)==0: #new problem
                 newProb = True
                 msg_words = msg.split()
                 print(msg)
@@ -859,34 +1557,16 @@ class DataAccessLayer:
                         problem_type = onceKeywords[token]
                     if problem_type != 'A62' and (token in otherKeywords):
                         problem_type = otherKeywords[token]
-                sql_parameters = [
-                    {'name':'event', 'value':{'longValue': event_id}},
-                    {'name':'crew', 'value':{'stringValue': crew_type}},
-                    {'name':'strip', 'value':{'stringValue': strip}},
-                    {'name':'problem', 'value':{'stringValue': problem_type}},
-                    {'name':'user', 'value':{'longValue': user_id}},
-                ]
-                sql = f'insert into {problems_table_name}' \
-                    f' (event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc)' \
-                    f' values (:event, :crew, :strip, :problem, :user, now())'
-                prob_response = self.execute_statement(sql, sql_parameters)
+                prob_response = self.execute_query('create_problem', event=event_id, crew=crew_type, strip=strip,
+                    problem=problem_type, user=user_id)
                 if prob_response['numberOfRecordsUpdated'] != 1:
                     return(3)
-                sql = f'SELECT MAX(problem_id) from {problems_table_name};'
-                last_response = self.execute_statement(sql)
-                records = last_response['records']
-                problem_id = records[0][0]['longValue']
+                problem_id = DataAccessLayer._generated_key(prob_response)
+                self._board_add(problem_id, event_id, crew_type)
             else:
-                problem_id = returned_records[0][0]['longValue']
+                problem_id = problem_rows[0].problem_id
             logger.info(problem_id)
-            sql_parameters = [
-                {'name':'user', 'value':{'longValue': user_id}},
-                {'name':'event', 'value':{'longValue': event_id}},
-            ]
-            sql = f'SELECT crew_id FROM {crews_table_name} ' \
-                f' WHERE user_id=:user and event_id=:event'
-            crew_response = self.execute_statement(sql,sql_parameters)
-            returned_records = crew_response['records']  #fix here
+            crew_rows = self.select('find_crew', event=event_id, user=user_id)  #fix here
             if not self.message(user_id, event_id, crew_type, problem_id, user_name+":"+msg):
                 return(4)
             else:
@@ -904,44 +1584,26 @@ class DataAccessLayer:
 
 
     def insert_email(self, email, full_name, user_name, role):
+        DataAccessLayer._xray_start('insert_email')
         DataAccessLayer._xray_add_metadata('email', email)
         DataAccessLayer._xray_add_metadata('first_name', full_name)
         DataAccessLayer._xray_add_metadata('last_name', user_name)
         DataAccessLayer._xray_add_metadata('role', role)
         try:
-            sql_parameters = [
-                {'name':'email', 'value':{'stringValue': email.lower()}},
-            ]
-            sql = f'SELECT user_id, allowed_roles  FROM {users_table_name} ' \
-                f' WHERE email = :email'
-            response = self.execute_statement(sql, sql_parameters)
-            returned_records = response['records']
-            if len(returned_records) > 0: #already have a record with that email
-                allowed_roles = returned_records[0][1]['stringValue']
+            rows = self.select('check_email', email=email.lower())
+            if len(rows) > 0: #already have a record with that email
+                allowed_roles = rows[0].allowed_roles
                 if (role in allowed_roles):
                     return True #record is up to date, nothing else to do
-                user_id = returned_records[0][0]['longValue'] #add another role
+                user_id = rows[0].user_id #add another role
                 allowed_roles=allowed_roles+","+role.upper()
-                sql_parameters = [
-                    {'name':'user', 'value':{'longValue': user_id}},
-                    {'name':'roles', 'value':{'stringValue': allowed_roles}},
-                ]
-                sql = f'UPDATE {users_table_name} ' \
-                    f' SET allowed_roles=:roles ' \
-                    f' WHERE user_id=:user '
-                response = self.execute_statement(sql, sql_parameters)
+                response = self.execute_query('set_roles', user=user_id, roles=allowed_roles)
+                user_cache.clear() #cached allowed_roles are keyed by sub
                 if response['numberOfRecordsUpdated'] != 1:
                     return False
                 return True
-            sql_parameters = [ #here if no record with that email exists, add a new one
-                {'name':'email', 'value':{'stringValue': email.lower()}},
-                {'name':'full', 'value':{'stringValue': full_name}},
-                {'name':'user', 'value':{'stringValue': user_name}},
-                {'name':'role', 'value':{'stringValue': role}},
-            ]
-            sql=f'INSERT INTO {users_table_name} (full_name, user_name, allowed_roles, email) ' \
-                f'VALUES(:full, :user, :role, :email)'
-            response = self.execute_statement(sql, sql_parameters)
+            #here if no record with that email exists, add a new one
+            response = self.execute_query('insert_user', full=full_name, user=user_name, role=role, email=email.lower())
             if response['numberOfRecordsUpdated'] != 1:
                 return False
             return True
@@ -952,18 +1614,58 @@ class DataAccessLayer:
         finally:
             DataAccessLayer._xray_stop()
 
+    def bulk_upsert_users(self, users, chunk_size=500):
+        # Roster import: users maps lower-cased email -> (full_name, user_name, [roles]).  Existing users are
+        # fetched chunk_size emails per SELECT and only gain missing roles; their names are never overwritten,
+        # since each roster file formats them differently.  New users are inserted.  All writes go through
+        # batch_execute_statement.  Returns {'inserted', 'updated', 'unchanged'}.
+        DataAccessLayer._xray_start('bulk_upsert_users')
+        try:
+            DataAccessLayer._xray_add_metadata('users', len(users))
+            emails = list(users)
+            existing = {}
+            for start in range(0, len(emails), chunk_size):
+                chunk = emails[start:start+chunk_size]
+                sql_parameters = [{'name':f'e{i}', 'value':{'stringValue': email}} for i, email in enumerate(chunk)]
+                id_names = ', '.join(f':e{i}' for i in range(len(chunk)))
+                sql = f'SELECT user_id, email, allowed_roles FROM {users_table_name} WHERE email IN ({id_names})'
+                response = self.execute_statement(sql, sql_parameters)
+                for record in response['records']:
+                    existing[record[1]['stringValue'].lower()] = (record[0]['longValue'], record[2]['stringValue'])
+            inserts = []
+            updates = []
+            unchanged = 0
+            for email, (full_name, user_name, roles) in users.items():
+                if email not in existing:
+                    inserts.append({'full': full_name, 'user': user_name, 'role': ','.join(roles), 'email': email})
+                    continue
+                user_id, allowed_roles = existing[email]
+                have = allowed_roles.split(',') if allowed_roles else []
+                missing = [role for role in roles if role not in have]
+                if not missing:
+                    unchanged += 1
+                    continue
+                updates.append({'user': user_id, 'roles': ','.join(have + missing)})
+            if inserts:
+                self.execute_batch('insert_user', inserts, chunk_size)
+            if updates:
+                self.execute_batch('set_roles', updates, chunk_size)
+                user_cache.clear() #cached allowed_roles are keyed by sub
+            return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': unchanged}
+        except DataAccessLayerException as de:
+            raise de
+        except Exception as e:
+            raise DataAccessLayerException(e) from e
+        finally:
+            DataAccessLayer._xray_stop()
+
     def check_email(self, email):
+        DataAccessLayer._xray_start('check_email')
         DataAccessLayer._xray_add_metadata('email', email)
         try:
-            sql_parameters = [
-                {'name':'email', 'value':{'stringValue': email.lower()}},
-            ]
-            sql = f'SELECT user_id, allowed_roles  FROM {users_table_name} ' \
-                f' WHERE email = :email'
-            response = self.execute_statement(sql, sql_parameters)
-            print(response)
-            returned_records = response['records']
-            if returned_records: #already have a record with that email
+            rows = self.select('check_email', email=email.lower())
+            logger.debug(rows)
+            if rows: #already have a record with that email
                 return True
             return False
         except DataAccessLayerException as de:
@@ -974,18 +1676,13 @@ class DataAccessLayer:
             DataAccessLayer._xray_stop()
 
     def insert_sub(self, email, sub):
+        DataAccessLayer._xray_start('insert_sub')
         DataAccessLayer._xray_add_metadata('email', email)
         DataAccessLayer._xray_add_metadata('sub', sub)
 
         try:
-            sql_parameters = [
-                {'name':'email', 'value':{'stringValue': email.lower()}},
-                {'name':'sub', 'value':{'stringValue': sub}},
-            ]
-            sql = f'UPDATE {users_table_name} ' \
-                f' SET sub=:sub ' \
-                f' WHERE email=:email '
-            response = self.execute_statement(sql, sql_parameters)
+            response = self.execute_query('insert_sub', email=email.lower(), sub=sub)
+            user_cache.clear() #the user's previous sub may still be cached
             if response['numberOfRecordsUpdated'] != 1:
                 return False
             return True
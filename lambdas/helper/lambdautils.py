@@ -37,6 +37,12 @@ def success(output):
         'body': json.dumps(output)
 }
 
+def not_modified(headers=None):
+    return {
+        'statusCode': 304,
+        'headers': headers or {}
+    }
+
 def error(error_code, error):
     return {
         'statusCode': error_code,
@@ -0,0 +1,362 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  In-process stand-in for the boto3 'rds-data' client.
+
+  LocalRDSDataClient runs the DAL's SQL against SQLite and answers with the same
+  request/response shapes as the RDS Data API (records of typed field dicts,
+  numberOfRecordsUpdated, generatedFields, updateResults, transaction ids, and
+  formattedRecords for formatRecordsAs='JSON').
+  It can add per-call latency and raise the 'Communications link failure' error
+  that Aurora Serverless returns while it resumes, so the hot paths can be
+  measured and regressed without a live cluster.
+
+  Usage:
+      client = LocalRDSDataClient(latency=0.02, cold_start_failures=3)
+      dal = DataAccessLayer(database_name, db_cluster_arn, secret_arn, rdsdata_client=client)
+  or set LOCAL_RDSDATA_PATH=<sqlite file> and every handler's DataAccessLayer picks it up.
+"""
+import collections
+import datetime
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# Schema mirrors deploy_scripts/ddl_scripts (tables and every migration in create_schema.py), in SQLite dialect
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_name VARCHAR(30) NOT NULL,
+    full_name VARCHAR(50) NOT NULL,
+    allowed_roles VARCHAR(50) NOT NULL,
+    sub VARCHAR(30),
+    mobile VARCHAR(20),
+    email VARCHAR(50)
+);
+CREATE INDEX IF NOT EXISTS user_name_idx ON users(user_name);
+CREATE INDEX IF NOT EXISTS sub_idx ON users(sub);
+CREATE INDEX IF NOT EXISTS mobile_idx ON users(mobile);
+CREATE INDEX IF NOT EXISTS email_idx ON users(email);
+
+CREATE TABLE IF NOT EXISTS events (
+    event_id MEDIUMINT NOT NULL PRIMARY KEY,
+    event_name VARCHAR(30) NOT NULL,
+    event_type VARCHAR(10) NOT NULL,
+    start_date_utc DATETIME NOT NULL,
+    end_date_utc DATETIME NOT NULL,
+    state MEDIUMINT,
+    arm_tn VARCHAR(10)
+);
+CREATE INDEX IF NOT EXISTS start_date_idx ON events(start_date_utc);
+CREATE INDEX IF NOT EXISTS end_date_idx ON events(end_date_utc);
+CREATE INDEX IF NOT EXISTS arm_tn_idx ON events(arm_tn);
+
+CREATE TABLE IF NOT EXISTS crews (
+    crew_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    crew_type VARCHAR(4) NOT NULL,
+    user_id MEDIUMINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    sms BOOLEAN
+);
+CREATE INDEX IF NOT EXISTS crews_event_idx ON crews(event_id);
+CREATE INDEX IF NOT EXISTS user_event_idx ON crews(user_id, event_id, crew_type);
+
+CREATE TABLE IF NOT EXISTS problems (
+    problem_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    crew_type VARCHAR(4) NOT NULL,
+    strip VARCHAR(5) NOT NULL,
+    problem_type VARCHAR(5) NOT NULL,
+    reporter_id MEDIUMINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    reported_time_utc DATETIME NOT NULL,
+    updater_id MEDIUMINT REFERENCES users(user_id) ON DELETE CASCADE,
+    update_time_utc DATETIME,
+    resolver_id MEDIUMINT REFERENCES users(user_id) ON DELETE CASCADE,
+    resolver_time_utc DATETIME,
+    resolution_code MEDIUMINT
+);
+CREATE INDEX IF NOT EXISTS problems_event_idx ON problems(event_id);
+CREATE INDEX IF NOT EXISTS event_crew_resolution_idx ON problems(event_id, crew_type, resolution_code);
+
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    crew_type VARCHAR(4) NOT NULL,
+    problem_id MEDIUMINT NOT NULL REFERENCES problems(problem_id) ON DELETE CASCADE,
+    message_text VARCHAR(1024) NOT NULL,
+    sender_id MEDIUMINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    sent_time_utc DATETIME NOT NULL,
+    finished_time_utc DATETIME
+);
+CREATE INDEX IF NOT EXISTS message_idx ON messages(problem_id);
+CREATE INDEX IF NOT EXISTS messages_event_idx ON messages(event_id);
+
+CREATE TABLE IF NOT EXISTS receipts (
+    receipt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    problem_id MEDIUMINT NOT NULL REFERENCES problems(problem_id) ON DELETE CASCADE,
+    message_id MEDIUMINT NOT NULL REFERENCES messages(message_id) ON DELETE CASCADE,
+    recipient_id MEDIUMINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    receipt_time_utc DATETIME
+);
+CREATE INDEX IF NOT EXISTS receipts_event_idx ON receipts(event_id);
+CREATE INDEX IF NOT EXISTS receipts_problem_idx ON receipts(problem_id);
+CREATE INDEX IF NOT EXISTS receipts_message_idx ON receipts(message_id);
+CREATE INDEX IF NOT EXISTS recipient_time_idx ON receipts(recipient_id, receipt_time_utc, message_id);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id MEDIUMINT NOT NULL REFERENCES messages(message_id) ON DELETE CASCADE,
+    channel VARCHAR(5) NOT NULL,
+    recipient VARCHAR(64) NOT NULL,
+    dedupe_key VARCHAR(100) NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    attempts SMALLINT NOT NULL DEFAULT 0,
+    next_attempt_utc DATETIME NOT NULL,
+    claim_id VARCHAR(36),
+    created_time_utc DATETIME NOT NULL,
+    sent_time_utc DATETIME,
+    last_error VARCHAR(255)
+);
+CREATE INDEX IF NOT EXISTS pending_idx ON outbox(sent_time_utc, next_attempt_utc);
+CREATE INDEX IF NOT EXISTS claim_idx ON outbox(claim_id);
+
+CREATE TABLE IF NOT EXISTS boards (
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    crew_type VARCHAR(4) NOT NULL,
+    version BIGINT NOT NULL,
+    PRIMARY KEY (event_id, crew_type)
+);
+
+CREATE TABLE IF NOT EXISTS board_problems (
+    event_id MEDIUMINT NOT NULL REFERENCES events(event_id) ON DELETE CASCADE,
+    crew_type VARCHAR(4) NOT NULL,
+    problem_id MEDIUMINT NOT NULL UNIQUE REFERENCES problems(problem_id) ON DELETE CASCADE,
+    strip VARCHAR(5) NOT NULL,
+    problem_type VARCHAR(5) NOT NULL,
+    reporter VARCHAR(30) NOT NULL,
+    PRIMARY KEY (event_id, crew_type, problem_id)
+);
+"""
+
+COMMUNICATIONS_LINK_FAILURE = 'Communications link failure\n\n' \
+    'The last packet sent successfully to the server was 0 milliseconds ago. ' \
+    'The driver has not received any packets from the server.'
+
+# SQLite hands BOOLEAN columns back as integers; the Data API returns booleanValue
+sqlite3.register_converter('BOOLEAN', lambda value: value not in (b'0', b''))
+
+
+class BadRequestException(Exception):
+    """Same name and message format as botocore's rds-data BadRequestException"""
+
+    def __init__(self, operation_name, message):
+        self.operation_name = operation_name
+        self.message = message
+        super().__init__(f'An error occurred (BadRequestException) when calling the {operation_name} operation: {message}')
+
+
+class LocalRDSDataClient:
+
+    exceptions = collections.namedtuple('exceptions', ['BadRequestException'])(BadRequestException)
+
+    def __init__(self, path=None, latency=0.0, jitter=0.0, cold_start_failures=0, schema=SCHEMA):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='stripcall-', suffix='.sqlite')
+            os.close(fd)
+        self.path = path
+        self.latency = latency
+        self.jitter = jitter
+        self._failures_left = cold_start_failures
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._transactions = {}
+        self.call_counts = collections.Counter()
+        if schema:
+            self._conn.executescript(schema)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None,
+            check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.create_function('now', 0, lambda: datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        return conn
+
+    #-----------------------------------------------------------------------------------------------
+    # Lab controls
+    #-----------------------------------------------------------------------------------------------
+    def fail_next(self, count):
+        """The next `count` calls raise the cold-resume 'Communications link failure' error"""
+        self._failures_left = count
+
+    def pause(self, resume_seconds):
+        """Behave like a paused Aurora Serverless cluster that takes `resume_seconds` to come back"""
+        self._paused_until = time.monotonic() + resume_seconds
+
+    def executescript(self, script):
+        """Seed fixtures directly, bypassing latency, failure injection and call counting"""
+        with self._lock:
+            self._conn.executescript(script)
+
+    def reset_stats(self):
+        self.call_counts.clear()
+
+    #-----------------------------------------------------------------------------------------------
+    # rds-data client surface
+    #-----------------------------------------------------------------------------------------------
+    def execute_statement(self, resourceArn=None, secretArn=None, sql=None, database=None, parameters=(),
+            transactionId=None, includeResultMetadata=False, continueAfterTimeout=False, schema=None,
+            resultSetOptions=None, formatRecordsAs='NONE'):
+        self._enter('ExecuteStatement')
+        with self._connection(transactionId) as conn:
+            cursor = conn.execute(_sqlite_dialect(sql), _decode_parameters(parameters))
+            result = {'numberOfRecordsUpdated': 0}
+            if cursor.description is not None:
+                rows = cursor.fetchall()
+                if formatRecordsAs == 'JSON':
+                    labels = [column[0] for column in cursor.description]
+                    result['formattedRecords'] = json.dumps([dict(zip(labels, row)) for row in rows])
+                else:
+                    result['records'] = [[_encode_value(value) for value in row] for row in rows]
+                if includeResultMetadata:
+                    result['columnMetadata'] = [{'name': column[0], 'label': column[0]} for column in cursor.description]
+            else:
+                result['numberOfRecordsUpdated'] = max(cursor.rowcount, 0)
+                if _is_insert(sql) and cursor.rowcount > 0:
+                    result['generatedFields'] = [{'longValue': cursor.lastrowid}]
+            return _with_metadata(result)
+
+    def batch_execute_statement(self, resourceArn=None, secretArn=None, sql=None, database=None, parameterSets=(),
+            transactionId=None, schema=None):
+        self._enter('BatchExecuteStatement')
+        with self._connection(transactionId) as conn:
+            own_transaction = transactionId is None
+            if own_transaction:
+                conn.execute('BEGIN')
+            try:
+                update_results = []
+                for parameter_set in parameterSets:
+                    cursor = conn.execute(_sqlite_dialect(sql), _decode_parameters(parameter_set))
+                    generated = [{'longValue': cursor.lastrowid}] if _is_insert(sql) and cursor.rowcount > 0 else []
+                    update_results.append({'generatedFields': generated})
+                if own_transaction:
+                    conn.execute('COMMIT')
+            except Exception:
+                if own_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            return _with_metadata({'updateResults': update_results})
+
+    def begin_transaction(self, resourceArn=None, secretArn=None, database=None, schema=None):
+        self._enter('BeginTransaction')
+        conn = self._connect()
+        conn.execute('BEGIN')
+        transaction_id = uuid.uuid4().hex
+        self._transactions[transaction_id] = (conn, threading.Lock())
+        return _with_metadata({'transactionId': transaction_id})
+
+    def commit_transaction(self, resourceArn=None, secretArn=None, transactionId=None):
+        self._enter('CommitTransaction')
+        conn = self._pop_transaction('CommitTransaction', transactionId)
+        conn.execute('COMMIT')
+        conn.close()
+        return _with_metadata({'transactionStatus': 'Transaction Committed'})
+
+    def rollback_transaction(self, resourceArn=None, secretArn=None, transactionId=None):
+        self._enter('RollbackTransaction')
+        conn = self._pop_transaction('RollbackTransaction', transactionId)
+        conn.execute('ROLLBACK')
+        conn.close()
+        return _with_metadata({'transactionStatus': 'Rollback Complete'})
+
+    #-----------------------------------------------------------------------------------------------
+    # Internals
+    #-----------------------------------------------------------------------------------------------
+    def _enter(self, operation_name):
+        self.call_counts[operation_name] += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self._failures_left > 0:
+            self._failures_left -= 1
+            raise BadRequestException(operation_name, COMMUNICATIONS_LINK_FAILURE)
+        if time.monotonic() < self._paused_until:
+            raise BadRequestException(operation_name, COMMUNICATIONS_LINK_FAILURE)
+
+    def _pop_transaction(self, operation_name, transaction_id):
+        entry = self._transactions.pop(transaction_id, None)
+        if entry is None:
+            raise BadRequestException(operation_name, f'Transaction {transaction_id} is not found')
+        return entry[0]
+
+    def _connection(self, transaction_id):
+        if transaction_id is None:
+            return _Locked(self._lock, self._conn)
+        entry = self._transactions.get(transaction_id)
+        if entry is None:
+            raise BadRequestException('ExecuteStatement', f'Transaction {transaction_id} is not found')
+        conn, lock = entry
+        return _Locked(lock, conn)
+
+
+class _Locked:
+
+    def __init__(self, lock, conn):
+        self._lock = lock
+        self._conn = conn
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self._conn
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _sqlite_dialect(sql):
+    # MySQL's upsert; in SQLite's the bare column names in SET also refer to the existing row
+    return sql.replace(' ON DUPLICATE KEY UPDATE ', ' ON CONFLICT DO UPDATE SET ')
+
+
+def _is_insert(sql):
+    return sql.lstrip().upper().startswith('INSERT')
+
+
+def _decode_parameters(parameters):
+    decoded = {}
+    for parameter in parameters or ():
+        value = parameter['value']
+        if value.get('isNull'):
+            decoded[parameter['name']] = None
+        else:
+            decoded[parameter['name']] = next(iter(value.values()))
+    return decoded
+
+
+def _encode_value(value):
+    if value is None:
+        return {'isNull': True}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'longValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, bytes):
+        return {'blobValue': value}
+    return {'stringValue': str(value)}
+
+
+def _with_metadata(result):
+    # content-length is what the JSON body would weigh on the wire, for the DAL's Bytes metric
+    body_length = len(json.dumps(result, default=str))
+    result['ResponseMetadata'] = {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': 200, 'RetryAttempts': 0,
+        'HTTPHeaders': {'content-length': str(body_length)}}
+    return result
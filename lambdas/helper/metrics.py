@@ -0,0 +1,124 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Per-operation metrics in CloudWatch Embedded Metric Format (EMF).
+
+  Every DAL method (the same spans it opens for X-Ray) and every FCM/Twilio send
+  prints one JSON line to stdout.  CloudWatch Logs turns those lines into metrics
+  in METRICS_NAMESPACE, with no PutMetricData call on the request path:
+      Latency (Milliseconds), Rows, Bytes, Retries, Errors
+  dimensioned by [Operation, Handler] and, when the operation belongs to an event,
+  also by [Operation, Handler, EventId].  Nested spans add their rows, bytes and
+  retries to the spans around them, so a method's numbers include its statements.
+
+  Locally, parse() reads the same lines back from captured stdout.  METRICS=off
+  turns emission off.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+METRICS = os.getenv('METRICS', 'on') # off: emit nothing
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'StripCall')
+HANDLER = os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')
+
+_UNITS = (('Latency', 'Milliseconds'), ('Rows', 'Count'), ('Bytes', 'Bytes'), ('Retries', 'Count'), ('Errors', 'Count'))
+_local = threading.local() # open spans, per thread
+
+
+class _Span:
+    __slots__ = ('operation', 'event_id', 'started', 'pending', 'rows', 'bytes', 'retries')
+
+    def __init__(self, operation, event_id):
+        self.operation = operation
+        self.event_id = event_id
+        self.started = time.perf_counter()
+        self.pending = sys.exc_info()[1] # an exception already being handled when the span opened is not ours
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+
+
+def _spans():
+    spans = getattr(_local, 'spans', None)
+    if spans is None:
+        spans = _local.spans = []
+    return spans
+
+
+def start(operation):
+    spans = _spans()
+    spans.append(_Span(operation, spans[-1].event_id if spans else None))
+
+
+def stop():
+    # Call from a finally block: an exception propagating through it counts as an error
+    spans = _spans()
+    if len(spans) == 0:
+        return
+    span = spans.pop()
+    failed = sys.exc_info()[1] is not None and sys.exc_info()[1] is not span.pending
+    emit(span.operation, (time.perf_counter() - span.started) * 1000, span.event_id,
+        rows=span.rows, nbytes=span.bytes, retries=span.retries, errors=int(failed))
+
+
+def set_handler(name):
+    # router.py serves several endpoints from one function; keep the Handler dimension per endpoint
+    global HANDLER
+    HANDLER = name
+
+
+def set_event(event_id):
+    # the event the current operation (and the ones it is nested in) works on
+    for span in _spans():
+        span.event_id = event_id
+
+
+def current_event():
+    spans = _spans()
+    return spans[-1].event_id if spans else None
+
+
+def add(rows=0, nbytes=0, retries=0):
+    for span in _spans():
+        span.rows += rows
+        span.bytes += nbytes
+        span.retries += retries
+
+
+def emit(operation, latency_ms, event_id=None, rows=0, nbytes=0, retries=0, errors=0):
+    if METRICS == 'off':
+        return
+    dimensions = [['Operation', 'Handler']]
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': dimensions,
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in _UNITS],
+            }],
+        },
+        'Operation': operation,
+        'Handler': HANDLER,
+        'Latency': round(latency_ms, 3),
+        'Rows': rows,
+        'Bytes': nbytes,
+        'Retries': retries,
+        'Errors': errors,
+    }
+    if event_id is not None:
+        dimensions.append(['Operation', 'Handler', 'EventId'])
+        record['EventId'] = str(event_id)
+    sys.stdout.write(json.dumps(record) + '\n')
+
+
+def parse(text):
+    """EMF records in captured stdout, skipping every other line"""
+    records = []
+    for line in text.splitlines():
+        if line.startswith('{"_aws"'):
+            records.append(json.loads(line))
+    return records
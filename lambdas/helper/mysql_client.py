@@ -0,0 +1,278 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Direct MySQL-protocol backend for DataAccessLayer.
+
+  MySQLDataClient answers the same calls as the boto3 'rds-data' client
+  (execute_statement, batch_execute_statement, begin/commit/rollback_transaction)
+  with the same response shapes, so dal.py and the handlers do not change.  It
+  talks to the cluster (normally through RDS Proxy) over pooled connections that
+  stay open across warm invocations instead of making an HTTPS call per statement.
+
+  Selected with DB_BACKEND=mysql; see DataAccessLayer.__init__.  Needs pymysql in
+  the deployment package.  Credentials come from DB_USER/DB_PASSWORD or, when those
+  are unset, from the same Secrets Manager secret the Data API uses.
+"""
+import collections
+import datetime
+import decimal
+import json
+import os
+import re
+import threading
+import uuid
+from .logger import get_logger
+logger = get_logger(__name__)
+
+DB_HOST = os.getenv('DB_HOST') # RDS Proxy or cluster endpoint
+DB_PORT = int(os.getenv('DB_PORT', '3306'))
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5')) # seconds
+
+# :name placeholders outside quoted literals; literals are matched first so they are skipped
+_PLACEHOLDER = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|(?<![:\w]):([A-Za-z_]\w*)")
+_BOOLEAN_TYPE = 1 # FIELD_TYPE.TINY; TINYINT(1) columns come back as booleanValue like the Data API
+
+
+class BadRequestException(Exception):
+    """Same name and message format as botocore's rds-data BadRequestException"""
+
+    def __init__(self, operation_name, message):
+        self.operation_name = operation_name
+        self.message = message
+        super().__init__(f'An error occurred (BadRequestException) when calling the {operation_name} operation: {message}')
+
+
+class MySQLDataClient:
+
+    exceptions = collections.namedtuple('exceptions', ['BadRequestException'])(BadRequestException)
+
+    def __init__(self, host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, secret_arn=None,
+            pool_size=DB_POOL_SIZE):
+        try:
+            import pymysql
+            from pymysql.constants import CLIENT
+        except ImportError as e:
+            raise ImportError('DB_BACKEND=mysql needs pymysql in the deployment package') from e
+        from .tracing import patch
+        patch('pymysql')
+        self._pymysql = pymysql
+        if user is None and secret_arn is not None:
+            user, password = _secret_credentials(secret_arn)
+        # FOUND_ROWS: an UPDATE's rowcount is the rows matched, not the rows changed, like the Data API
+        self._connect_args = {'host': host, 'port': port, 'user': user, 'password': password,
+            'connect_timeout': DB_CONNECT_TIMEOUT, 'autocommit': True, 'charset': 'utf8mb4',
+            'client_flag': CLIENT.FOUND_ROWS}
+        self._pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._transactions = {}
+        self._sql_cache = {}
+        self.call_counts = collections.Counter()
+
+    #-----------------------------------------------------------------------------------------------
+    # rds-data client surface
+    #-----------------------------------------------------------------------------------------------
+    def execute_statement(self, resourceArn=None, secretArn=None, sql=None, database=None, parameters=(),
+            transactionId=None, includeResultMetadata=False, continueAfterTimeout=False, schema=None,
+            resultSetOptions=None, formatRecordsAs='NONE'):
+        self.call_counts['ExecuteStatement'] += 1
+        with self._connection('ExecuteStatement', database, transactionId) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self._translate(sql), _decode_parameters(parameters))
+                result = {'numberOfRecordsUpdated': 0}
+                if cursor.description is not None:
+                    boolean_columns = [column[1] == _BOOLEAN_TYPE and column[3] == 1 for column in cursor.description]
+                    if formatRecordsAs == 'JSON':
+                        labels = [column[0] for column in cursor.description]
+                        result['formattedRecords'] = json.dumps([
+                            {label: bool(value) if is_boolean and value is not None else value
+                                for label, value, is_boolean in zip(labels, row, boolean_columns)}
+                            for row in cursor.fetchall()
+                        ], default=_json_value)
+                    else:
+                        result['records'] = [
+                            [_encode_value(value, is_boolean) for value, is_boolean in zip(row, boolean_columns)]
+                            for row in cursor.fetchall()
+                        ]
+                    if includeResultMetadata:
+                        result['columnMetadata'] = [{'name': column[0], 'label': column[0]} for column in cursor.description]
+                else:
+                    result['numberOfRecordsUpdated'] = max(cursor.rowcount, 0)
+                    if cursor.lastrowid:
+                        result['generatedFields'] = [{'longValue': cursor.lastrowid}]
+                return result
+
+    def batch_execute_statement(self, resourceArn=None, secretArn=None, sql=None, database=None, parameterSets=(),
+            transactionId=None, schema=None):
+        self.call_counts['BatchExecuteStatement'] += 1
+        with self._connection('BatchExecuteStatement', database, transactionId) as conn:
+            own_transaction = transactionId is None
+            if own_transaction:
+                conn.begin()
+            try:
+                update_results = []
+                with conn.cursor() as cursor:
+                    statement = self._translate(sql)
+                    for parameter_set in parameterSets:
+                        cursor.execute(statement, _decode_parameters(parameter_set))
+                        update_results.append({'generatedFields': [{'longValue': cursor.lastrowid}] if cursor.lastrowid else []})
+                if own_transaction:
+                    conn.commit()
+            except Exception:
+                if own_transaction:
+                    conn.rollback()
+                raise
+            return {'updateResults': update_results}
+
+    def begin_transaction(self, resourceArn=None, secretArn=None, database=None, schema=None):
+        self.call_counts['BeginTransaction'] += 1
+        conn = self._checkout(database)
+        conn.begin()
+        transaction_id = uuid.uuid4().hex
+        self._transactions[transaction_id] = (conn, threading.Lock())
+        return {'transactionId': transaction_id}
+
+    def commit_transaction(self, resourceArn=None, secretArn=None, transactionId=None):
+        self.call_counts['CommitTransaction'] += 1
+        conn = self._pop_transaction('CommitTransaction', transactionId)
+        try:
+            conn.commit()
+        finally:
+            self._checkin(conn)
+        return {'transactionStatus': 'Transaction Committed'}
+
+    def rollback_transaction(self, resourceArn=None, secretArn=None, transactionId=None):
+        self.call_counts['RollbackTransaction'] += 1
+        conn = self._pop_transaction('RollbackTransaction', transactionId)
+        try:
+            conn.rollback()
+        finally:
+            self._checkin(conn)
+        return {'transactionStatus': 'Rollback Complete'}
+
+    def reset_stats(self):
+        self.call_counts.clear()
+
+    #-----------------------------------------------------------------------------------------------
+    # Pool
+    #-----------------------------------------------------------------------------------------------
+    def _checkout(self, database):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._pymysql.connect(database=database, **self._connect_args)
+        else:
+            conn.ping(reconnect=True) # the socket may have been closed while the container was frozen
+            if database and conn.db != database.encode():
+                conn.select_db(database)
+        return conn
+
+    def _checkin(self, conn):
+        with self._lock:
+            if len(self._idle) < self._pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _connection(self, operation_name, database, transaction_id):
+        if transaction_id is None:
+            return _Pooled(self, database)
+        entry = self._transactions.get(transaction_id)
+        if entry is None:
+            raise BadRequestException(operation_name, f'Transaction {transaction_id} is not found')
+        return _Locked(*entry)
+
+    def _pop_transaction(self, operation_name, transaction_id):
+        entry = self._transactions.pop(transaction_id, None)
+        if entry is None:
+            raise BadRequestException(operation_name, f'Transaction {transaction_id} is not found')
+        return entry[0]
+
+    def _translate(self, sql):
+        # Data API :name placeholders -> pymysql %(name)s, with literal % escaped
+        statement = self._sql_cache.get(sql)
+        if statement is None:
+            escaped = sql.replace('%', '%%')
+            statement = _PLACEHOLDER.sub(lambda m: f'%({m.group(1)})s' if m.group(1) else m.group(0), escaped)
+            self._sql_cache[sql] = statement
+        return statement
+
+
+class _Pooled:
+
+    def __init__(self, client, database):
+        self._client = client
+        self._database = database
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = self._client._checkout(self._database)
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and isinstance(exc, self._client._pymysql.err.OperationalError):
+            self._conn.close() # don't hand a broken connection to the next caller
+        else:
+            self._client._checkin(self._conn)
+
+
+class _Locked:
+
+    def __init__(self, conn, lock):
+        self._conn = conn
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self._conn
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _secret_credentials(secret_arn):
+    import boto3
+    secret = boto3.client('secretsmanager').get_secret_value(SecretId=secret_arn)
+    values = json.loads(secret['SecretString'])
+    return values['username'], values['password']
+
+
+def _decode_parameters(parameters):
+    decoded = {}
+    for parameter in parameters or ():
+        value = parameter['value']
+        if value.get('isNull'):
+            decoded[parameter['name']] = None
+        else:
+            decoded[parameter['name']] = next(iter(value.values()))
+    return decoded
+
+
+def _json_value(value):
+    # formatRecordsAs='JSON' renders DATETIME as the same string the typed records use
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+
+def _encode_value(value, is_boolean=False):
+    if value is None:
+        return {'isNull': True}
+    if is_boolean:
+        return {'booleanValue': bool(value)}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'longValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (bytes, bytearray)):
+        return {'blobValue': bytes(value)}
+    if isinstance(value, datetime.datetime):
+        return {'stringValue': value.strftime('%Y-%m-%d %H:%M:%S')}
+    if isinstance(value, decimal.Decimal):
+        return {'stringValue': str(value)}
+    return {'stringValue': str(value)}
@@ -0,0 +1,151 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Push (FCM) and SMS (Twilio) delivery for crew messages.
+
+  deliver() sends the push notification and every SMS concurrently on a bounded
+  worker pool, each with its own timeout, and returns one result per delivery,
+  so a message to a large crew costs one slowest-send latency instead of the sum.
+  With NOTIFY_MODE=outbox the DAL queues these deliveries instead and
+  outbox_worker.py drains them through deliver_jobs(); outbox.py wakes the worker.
+
+  Each provider has one pooled keep-alive requests.Session per container with its
+  auth headers built once, so warm sends reuse an open TLS connection.
+
+  Every send emits an EMF metrics line (operation fcm or twilio) with its latency,
+  response bytes and connection retries; see metrics.py.
+"""
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics
+from .logger import get_logger
+from .tracing import patch
+logger = get_logger(__name__)
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH = os.getenv("TWILIO_AUTH")
+FCM_KEY = os.getenv("FCM_KEY")
+NOTIFY_CONNECT_TIMEOUT = float(os.getenv('NOTIFY_CONNECT_TIMEOUT', '2')) # seconds
+NOTIFY_TIMEOUT = float(os.getenv('NOTIFY_TIMEOUT', '5')) # seconds, read timeout per FCM/Twilio call
+NOTIFY_MAX_WORKERS = int(os.getenv('NOTIFY_MAX_WORKERS', '8'))
+
+FCM_URL = 'https://fcm.googleapis.com/fcm/send'
+TWILIO_SMS_URL = "https://api.twilio.com/2010-04-01/Accounts/{}/Messages.json"
+
+_executor = None
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class NotifyException(Exception):
+    pass
+
+
+def _session(provider):
+    # One pooled keep-alive session per provider for the life of the container
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(provider)
+        if session is None:
+            patch('requests')
+            session = requests.Session()
+            # max_retries=1 only retries failed connects, e.g. a keep-alive socket closed while frozen
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=NOTIFY_MAX_WORKERS, max_retries=1)
+            session.mount('https://', adapter)
+            if provider == 'fcm':
+                session.headers.update({'Content-type': 'application/json', 'Authorization': f'Key={FCM_KEY}'})
+            else:
+                authentication = "{}:{}".format(TWILIO_ACCOUNT_SID, TWILIO_AUTH)
+                base64string = base64.b64encode(authentication.encode('utf-8'))
+                session.headers.update({'Authorization': "Basic %s" % base64string.decode('ascii')})
+            _sessions[provider] = session
+    return session
+
+
+def prewarm():
+    """Open the FCM and Twilio connections during init so the first send skips the TCP+TLS handshake"""
+    for provider, url in (('fcm', FCM_URL), ('twilio', TWILIO_SMS_URL.format(TWILIO_ACCOUNT_SID))):
+        try:
+            _session(provider).head(url, timeout=(NOTIFY_CONNECT_TIMEOUT, NOTIFY_TIMEOUT))
+        except Exception as e:
+            logger.info(f'could not prewarm {provider}: {e}')
+
+
+def send_push(topic, title, body, message_id, timeout=NOTIFY_TIMEOUT):
+    fcm_data = {"notification": { "title": title, "body": body}, "to": "/topics/"+topic,
+        "data": {'message_id': message_id}}
+    response = _session('fcm').post(FCM_URL, data=json.dumps(fcm_data), timeout=(NOTIFY_CONNECT_TIMEOUT, timeout))
+    if response.status_code != 200:
+        raise NotifyException(f'FCM returned {response.status_code}')
+    return response
+
+
+def send_sms(from_tn, to_tn, body, timeout=NOTIFY_TIMEOUT):
+    post_params = {"To": to_tn, "From": from_tn, "Body": body}
+    response = _session('twilio').post(TWILIO_SMS_URL.format(TWILIO_ACCOUNT_SID), data=post_params,
+        timeout=(NOTIFY_CONNECT_TIMEOUT, timeout))
+    logger.info("Twilio returned {}".format(response.text))
+    if response.status_code >= 300:
+        raise NotifyException(f'Twilio returned {response.status_code}')
+    return response
+
+
+def _retries(response):
+    # connection retries urllib3 made under the adapter's max_retries
+    retries = getattr(response.raw, 'retries', None)
+    return len(getattr(retries, 'history', ()) or ())
+
+
+def _run(channel, recipient, send, kwargs, event_id=None):
+    start = time.monotonic()
+    try:
+        response = send(**kwargs)
+        elapsed = time.monotonic() - start
+        metrics.emit('fcm' if channel == 'push' else 'twilio', elapsed * 1000, event_id,
+            nbytes=len(response.content), retries=_retries(response))
+        return {'channel': channel, 'to': recipient, 'ok': True, 'status': response.status_code,
+            'elapsed': elapsed}
+    except Exception as e:
+        elapsed = time.monotonic() - start
+        metrics.emit('fcm' if channel == 'push' else 'twilio', elapsed * 1000, event_id, errors=1)
+        logger.info(f'{channel} delivery to {recipient} failed: {e}')
+        return {'channel': channel, 'to': recipient, 'ok': False, 'error': str(e),
+            'elapsed': elapsed}
+
+
+def deliver(push=None, sms=(), event_id=None):
+    """Send one push (send_push kwargs) and any number of SMS (send_sms kwargs) concurrently.
+
+    Returns a result dict per delivery, push first and then SMS in the order given.
+    """
+    jobs = []
+    if push is not None:
+        jobs.append(('push', push))
+    for one_sms in sms:
+        jobs.append(('sms', one_sms))
+    return deliver_jobs(jobs, event_id)
+
+
+def deliver_jobs(jobs, event_id=None):
+    """Send a list of (channel, kwargs) deliveries concurrently, results in the same order"""
+    global _executor
+    runs = [(channel, kwargs['topic'] if channel == 'push' else kwargs['to_tn'],
+        send_push if channel == 'push' else send_sms, kwargs, event_id) for channel, kwargs in jobs]
+    if len(runs) == 0:
+        return []
+    if len(runs) == 1:
+        return [_run(*runs[0])]
+    if _executor is None:
+        # kept for the life of the container so warm invocations reuse the threads
+        _executor = ThreadPoolExecutor(max_workers=NOTIFY_MAX_WORKERS, thread_name_prefix='notify')
+    futures = [_executor.submit(_run, *run) for run in runs]
+    return [future.result() for future in futures]
+
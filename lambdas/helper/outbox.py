@@ -0,0 +1,32 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Wake-up call for the outbox worker.
+
+  With NOTIFY_MODE=outbox a message only writes outbox rows and its unit of work
+  invokes outbox_worker.py after commit.  Kept apart from notify so the message
+  path never imports requests; only the worker, and NOTIFY_MODE=direct, send.
+"""
+import os
+from .logger import get_logger
+from .tracing import patch
+logger = get_logger(__name__)
+
+OUTBOX_WORKER_FUNCTION = os.getenv('OUTBOX_WORKER_FUNCTION') # invoked asynchronously when the outbox gets work
+
+_lambda_client = None
+
+
+def wake_outbox_worker():
+    """Fire-and-forget invoke of the outbox worker; its schedule catches anything this misses"""
+    global _lambda_client
+    if not OUTBOX_WORKER_FUNCTION:
+        return
+    try:
+        if _lambda_client is None:
+            import boto3
+            patch('botocore')
+            _lambda_client = boto3.client('lambda')
+        _lambda_client.invoke(FunctionName=OUTBOX_WORKER_FUNCTION, InvocationType='Event', Payload=b'{}')
+    except Exception as e:
+        logger.info(f'could not wake outbox worker: {e}')
@@ -0,0 +1,94 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Named-query registry for the DAL.
+
+  Each Query is built once at import: its SQL text is final, every :name placeholder
+  is checked against a declared parameter type, and the projected columns are
+  declared next to the SQL.  parameters() turns keyword values into Data API
+  parameter dicts, so no method indexes into a record by position or depends on
+  SELECT * order.
+
+  Results come back one of two ways:
+    json_rows=True   the statement runs with formatRecordsAs='JSON' and the rows are
+                     plain dicts, for results that go straight into an API response
+    otherwise        typed records are decoded into namedtuple rows, NULL fields
+                     as None
+"""
+import collections
+import json
+import re
+
+LONG = 'long'
+STRING = 'string'
+BOOLEAN = 'boolean'
+DOUBLE = 'double'
+TIMESTAMP = 'timestamp' # 'YYYY-MM-DD HH:MM:SS' string sent with typeHint TIMESTAMP
+
+# Data API value key and Python coercion for each declared type
+_TYPES = {
+    LONG: ('longValue', int),
+    STRING: ('stringValue', str),
+    BOOLEAN: ('booleanValue', bool),
+    DOUBLE: ('doubleValue', float),
+    TIMESTAMP: ('stringValue', str),
+}
+
+_PLACEHOLDER = re.compile(r"'(?:[^'\\]|\\.)*'|(?<![:\w]):([A-Za-z_]\w*)")
+
+
+class Query:
+    __slots__ = ('name', 'sql', 'params', 'columns', 'format', 'row_type', '_column_keys')
+
+    def __init__(self, name, sql, params=(), columns=(), json_rows=False):
+        self.name = name
+        self.sql = sql
+        self.params = tuple(params)
+        self.columns = tuple(column for column, _ in columns)
+        self.format = 'JSON' if json_rows else 'NONE'
+        self._column_keys = tuple((column, _TYPES[column_type][0]) for column, column_type in columns)
+        self.row_type = collections.namedtuple(''.join(part.title() for part in name.split('_')) + 'Row', self.columns)
+        for _, param_type in self.params:
+            if param_type not in _TYPES:
+                raise ValueError(f'{name}: unknown parameter type {param_type}')
+        placeholders = {match.group(1) for match in _PLACEHOLDER.finditer(sql) if match.group(1)}
+        declared = {param for param, _ in self.params}
+        if placeholders != declared:
+            raise ValueError(f'{name}: placeholders {sorted(placeholders)} do not match parameters {sorted(declared)}')
+
+    def parameters(self, values):
+        if len(values) != len(self.params):
+            unknown = set(values) - {param for param, _ in self.params}
+            if unknown:
+                raise ValueError(f'{self.name}: unknown parameters {sorted(unknown)}')
+        parameters = []
+        for param, param_type in self.params:
+            if param not in values:
+                raise ValueError(f'{self.name}: missing parameter {param}')
+            value = values[param]
+            key, coerce = _TYPES[param_type]
+            parameter = {'name': param, 'value': {'isNull': True} if value is None else {key: coerce(value)}}
+            if param_type == TIMESTAMP:
+                parameter['typeHint'] = 'TIMESTAMP'
+            parameters.append(parameter)
+        return parameters
+
+    def rows(self, records):
+        """Decode a whole typed records array into row_type tuples"""
+        keys = [key for _, key in self._column_keys]
+        return [self.row_type(*[field.get(key) for field, key in zip(record, keys)]) for record in records]
+
+    def decode(self, response):
+        """Rows of an execute_statement response: dicts in JSON mode, row_type tuples otherwise"""
+        if 'formattedRecords' in response:
+            return json.loads(response['formattedRecords'])
+        return self.rows(response.get('records', ()))
+
+
+class QueryRegistry(dict):
+
+    def add(self, name, sql, params=(), columns=(), json_rows=False):
+        if name in self:
+            raise ValueError(f'query {name} is already registered')
+        self[name] = Query(name, sql, params, columns, json_rows)
+        return self[name]
@@ -0,0 +1,106 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  X-Ray metadata policy for the DAL hot path.
+
+  Small values (SQL text, ids) are always attached, truncated to
+  XRAY_METADATA_MAX_BYTES.  Whole payloads (Data API responses, parameter sets)
+  are only serialized when capture_payloads() says so:
+      XRAY_PAYLOADS=off      never
+      XRAY_PAYLOADS=traced   only inside a sampled X-Ray trace (default)
+      XRAY_PAYLOADS=all      in every invocation
+  and then only for XRAY_PAYLOAD_SAMPLE_RATE of the statements.  Lazy() defers
+  formatting of debug-log arguments until a handler actually emits the record.
+
+  patch() instruments a library for X-Ray the first time a function uses it,
+  instead of patch_all() importing every supported library into every function.
+"""
+import json
+import os
+import random
+
+is_lambda_environment = (os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None)
+
+if is_lambda_environment:
+    from aws_xray_sdk.core import xray_recorder
+else:
+    xray_recorder = None # X-Ray only runs inside Lambda; don't pay for the import anywhere else
+
+XRAY_PAYLOADS = os.getenv('XRAY_PAYLOADS', 'traced')
+XRAY_PAYLOAD_SAMPLE_RATE = float(os.getenv('XRAY_PAYLOAD_SAMPLE_RATE', '0.1'))
+XRAY_METADATA_MAX_BYTES = int(os.getenv('XRAY_METADATA_MAX_BYTES', '2048'))
+
+
+_patched = set()
+
+
+def patch(*modules):
+    if not is_lambda_environment:
+        return
+    unpatched = [module for module in modules if module not in _patched]
+    if unpatched:
+        from aws_xray_sdk.core import patch as xray_patch
+        xray_patch(unpatched)
+        _patched.update(unpatched)
+
+
+def propagate(function):
+    # wrap function to run on a worker thread inside the caller's X-Ray segment
+    if not (is_lambda_environment and xray_recorder):
+        return function
+    entity = xray_recorder.get_trace_entity()
+
+    def traced(*args, **kwargs):
+        xray_recorder.set_trace_entity(entity)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            xray_recorder.clear_trace_entities()
+    return traced
+
+
+def truncate(text, max_bytes=None):
+    max_bytes = XRAY_METADATA_MAX_BYTES if max_bytes is None else max_bytes
+    if len(text) <= max_bytes:
+        return text
+    return f'{text[:max_bytes]}... ({len(text)} chars)'
+
+
+def _in_sampled_trace():
+    try:
+        segment = xray_recorder.current_segment()
+    except Exception: # no active segment outside a traced invocation
+        return False
+    return bool(getattr(segment, 'sampled', False))
+
+
+def capture_payloads():
+    if not (is_lambda_environment and xray_recorder) or XRAY_PAYLOADS == 'off':
+        return False
+    if XRAY_PAYLOADS == 'traced' and not _in_sampled_trace():
+        return False
+    return XRAY_PAYLOAD_SAMPLE_RATE >= 1 or random.random() < XRAY_PAYLOAD_SAMPLE_RATE
+
+
+def put_metadata(name, value):
+    if is_lambda_environment and xray_recorder and xray_recorder.current_subsegment():
+        if isinstance(value, str):
+            value = truncate(value)
+        return xray_recorder.current_subsegment().put_metadata(name, value)
+
+
+def put_payload(name, payload):
+    # payload is only serialized when this statement's payloads are being captured
+    if capture_payloads():
+        put_metadata(name, json.dumps(payload, default=str))
+
+
+class Lazy:
+    """Debug-log argument whose str() (truncated) is only computed if the record is emitted"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return truncate(str(self.value))
@@ -0,0 +1,82 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Calendar-driven warm-up plan for the Aurora Serverless cluster.
+
+  wakeup.py reads the upcoming event windows once a day and turns them into warm
+  windows: each event's start/end padded by WARMUP_LEAD_MINUTES before and
+  WARM_TAIL_MINUTES after, overlapping windows merged.  The plan is handed to the
+  KeepAlive rule as its input, so keepalive.py can decide from the clock alone
+  whether to probe; outside a warm window it never touches the database and the
+  cluster is free to pause.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+WARMUP_LEAD_MINUTES = int(os.getenv('WARMUP_LEAD_MINUTES', '20')) # resume well before the first crew logs in
+WARM_TAIL_MINUTES = int(os.getenv('WARM_TAIL_MINUTES', '30')) # stragglers after the scheduled end
+WARM_HORIZON_HOURS = int(os.getenv('WARM_HORIZON_HOURS', '26')) # until the next daily wakeup, with margin
+KEEPALIVE_INTERVAL_MINUTES = int(os.getenv('KEEPALIVE_INTERVAL_MINUTES', '10')) # must match the KeepAlive rule rate
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_utc(value):
+    # Data API DATETIME strings may carry fractional seconds
+    return datetime.strptime(value[:19], DATETIME_FORMAT)
+
+
+def plan_windows(events, now, lead_minutes=WARMUP_LEAD_MINUTES, tail_minutes=WARM_TAIL_MINUTES,
+        horizon_hours=WARM_HORIZON_HOURS):
+    """Merge (start, end) event datetimes into sorted (warm_from, warm_until) windows.
+
+    Only windows that are still open at now and begin within the horizon are kept.
+    """
+    lead = timedelta(minutes=lead_minutes)
+    tail = timedelta(minutes=tail_minutes)
+    horizon = now + timedelta(hours=horizon_hours)
+    padded = sorted((start - lead, end + tail) for start, end in events)
+    windows = []
+    for warm_from, warm_until in padded:
+        if warm_until <= now or warm_from >= horizon:
+            continue
+        if windows and warm_from <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], warm_until))
+        else:
+            windows.append((warm_from, warm_until))
+    return windows
+
+
+def in_warm_window(windows, now):
+    return any(warm_from <= now < warm_until for warm_from, warm_until in windows)
+
+
+def probe_times(windows, now, interval_minutes=KEEPALIVE_INTERVAL_MINUTES):
+    """Times the KeepAlive rule will actually probe, for checking a plan offline"""
+    interval = timedelta(minutes=interval_minutes)
+    times = []
+    for warm_from, warm_until in windows:
+        probe = max(warm_from, now)
+        while probe < warm_until:
+            times.append(probe)
+            probe += interval
+    return times
+
+
+def windows_to_json(windows):
+    return [{'warm_from': warm_from.strftime(DATETIME_FORMAT), 'warm_until': warm_until.strftime(DATETIME_FORMAT)}
+        for warm_from, warm_until in windows]
+
+
+def windows_from_json(data):
+    return [(parse_utc(window['warm_from']), parse_utc(window['warm_until'])) for window in data]
+
+
+def schedule_report(windows, now, interval_minutes=KEEPALIVE_INTERVAL_MINUTES):
+    """The computed schedule as JSON: the warm windows and every probe the plan implies"""
+    return json.dumps({
+        'computed_at': now.strftime(DATETIME_FORMAT),
+        'warm_windows': windows_to_json(windows),
+        'probes': [probe.strftime(DATETIME_FORMAT) for probe in probe_times(windows, now, interval_minutes)]
+    })
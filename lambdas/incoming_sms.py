@@ -23,8 +23,7 @@
 
 import json
 import os
-import boto3
-import urllib
+import urllib.parse
 from twilio.request_validator import *
 from helper.dal import *
 from helper.lambdautils import *
@@ -40,6 +39,11 @@ db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
 twilio_auth = os.getenv('TWILIO_AUTH')
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
 
+# open the FCM/Twilio connections while the container initializes
+if is_lambda_environment and NOTIFY_MODE == 'direct':
+    from helper.notify import prewarm
+    prewarm()
+
 
 def handler(event, context):
     request_valid = False
@@ -22,7 +22,9 @@
 """
 
 import os
+from datetime import datetime
 from helper.dal import *
+from helper.warmup import in_warm_window, windows_from_json
 from helper.lambdautils import *
 from helper.logger import get_logger
 
@@ -39,7 +41,14 @@ dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_stor
 #-----------------------------------------------------------------------------------------------
 def handler(event, context):
     try:
-        tournaments=dal.tourney()
+        # Outside the warm windows wakeup planned, leave the database alone so it can pause
+        if 'warm_windows' in event and not in_warm_window(windows_from_json(event['warm_windows']), datetime.utcnow()):
+            return success({
+                'message': 'idle'
+            })
+        code, err, msg = dal.probe()
+        if code != 2:
+            return error(400, msg)
         return success({
             'message': 'alive'
         })
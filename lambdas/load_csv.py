@@ -21,7 +21,11 @@
   SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import boto3
+import codecs
 import csv
+import hashlib
+import json
+import time
 from helper.dal import *
 from helper.lambdautils import *
 from helper.logger import get_logger
@@ -31,61 +35,115 @@ logger = get_logger(__name__)
 database_name = os.getenv('DB_NAME')
 db_cluster_arn = os.getenv('DB_CLUSTER_ARN')
 db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
+roster_bucket = os.getenv('ROSTER_BUCKET', 'stripcall-email')
+roster_chunk_size = int(os.getenv('ROSTER_CHUNK_SIZE', '500')) # emails per SELECT / rows per batch write
+progress_every = 500 # rows
+manifest_suffix = '.manifest.json' # row hashes of the last import, stored next to each CSV
 
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
 
+#-----------------------------------------------------------------------------------------------
+# Row Parsers: return (email, full_name, user_name) or None to skip the row
+#-----------------------------------------------------------------------------------------------
+def parse_hire_row(row):
+    if len(row)>13 and len(row[5])>0:
+        lastfirst = row[5].split(',')
+        firstname = lastfirst[1].replace(' ','')
+        lastname=lastfirst[0]
+        return row[13], firstname + " " + lastname, firstname + lastname[0]
+    return None
+
+def parse_ref_row(row):
+    if len(row)>2 and len(row[0])>0:
+        lastname = row[0]
+        firstname = row[1]
+        return row[2], firstname + " " + lastname, firstname[0] + lastname
+    return None
+
+roster_files = [('hirelist.csv', 'ARM', parse_hire_row), ('reflist.csv', 'REF', parse_ref_row)]
+
+def row_hash(email, full_name, user_name):
+    return hashlib.sha1(f'{email}\t{full_name}\t{user_name}'.encode('utf-8')).hexdigest()
+
+def load_manifest(s3, key):
+    # {'etag': ..., 'rows': {email: row hash}} from the previous import, empty if there was none
+    try:
+        manifest = s3.get_object(Bucket=roster_bucket, Key=key+manifest_suffix)
+        return json.loads(manifest['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return {'etag': None, 'rows': {}}
+
+def save_manifest(s3, key, etag, rows):
+    s3.put_object(Bucket=roster_bucket, Key=key+manifest_suffix,
+        Body=json.dumps({'etag': etag, 'rows': rows}).encode('utf-8'), ContentType='application/json')
+
+def read_roster(s3, key, role, parse_row, users, previous):
+    # Stream the object through the csv reader.  Rows that are new or changed since the previous
+    # manifest are merged into users, keyed by lower-cased email; returns (counts, etag, row hashes).
+    # changed only means the row differs from the last import: the database write (bulk_upsert_users)
+    # adds missing roles and leaves names alone, and reports what it really updated
+    start = time.monotonic()
+    confile = s3.get_object(Bucket=roster_bucket, Key=key)
+    csv_reader = csv.reader(codecs.getreader('utf-8')(confile['Body']), delimiter=',', quotechar='"')
+    next(csv_reader, None) #header
+    counts = {'rows': 0, 'added': 0, 'changed': 0, 'unchanged': 0}
+    hashes = {}
+    for row in csv_reader:
+        counts['rows'] += 1
+        if counts['rows'] % progress_every == 0:
+            print(f'{key}: {counts["rows"]} rows, {len(users)} to write, {time.monotonic()-start:.1f}s')
+        if counts['rows'] <= 10:
+            print(row)
+        parsed = parse_row(row)
+        if parsed is None or len(parsed[0])==0:
+            continue
+        email, full_name, user_name = parsed
+        email = email.strip().lower()
+        if email in hashes:
+            continue #duplicate row within this file, first one wins
+        hashes[email] = row_hash(email, full_name, user_name)
+        if email not in previous:
+            counts['added'] += 1
+        elif previous[email] != hashes[email]:
+            counts['changed'] += 1
+        else:
+            counts['unchanged'] += 1
+            continue
+        if email in users:
+            if role not in users[email][2]:
+                users[email][2].append(role)
+        else:
+            users[email] = (full_name, user_name, [role])
+    print(f'{key}: {counts} in {time.monotonic()-start:.1f}s')
+    return counts, confile['ETag'], hashes
+
+#-----------------------------------------------------------------------------------------------
+# Lambda Entrypoint
+#-----------------------------------------------------------------------------------------------
 def handler(event, context):
     print("starting")
-    region='us-east-1'
-    recList=[]
     try:
+        start = time.monotonic()
+        force = bool(event.get('force')) if isinstance(event, dict) else False #ignore the manifests
         s3=boto3.client('s3')
-        confile= s3.get_object(Bucket='stripcall-email', Key='hirelist.csv')
-        recList = confile['Body'].read().decode('utf-8').splitlines(True)
-        firstrecord=True
-        csv_reader = csv.reader(recList, delimiter=',', quotechar='"')
-        print("Got csv reader")
-        firstfew=0;
-        for row in csv_reader:
-            if (firstrecord):
-                firstrecord=False
-                continue
-            if (firstfew<10):
-                print(row)
-            if len(row)>13:
-                if len(row[5])>0:
-                    email = row[13]
-                    lastfirst = row[5].split(',')
-                    firstname = lastfirst[1].replace(' ','')
-                    lastname=lastfirst[0]
-                    full_name = firstname + " " + lastname
-                    user_name = firstname + lastname[0]
-                    if (firstfew<10): print(f'email={email}, fullname={full_name}, username={user_name}')
-                    dal.insert_email(email, full_name, user_name, "ARM")
-                    firstfew+=1
-        print('Armory Put succeeded:')
-        confile= s3.get_object(Bucket='stripcall-email', Key='reflist.csv')
-        recList = confile['Body'].read().decode('utf-8').splitlines(True)
-        firstrecord=True
-        csv_reader = csv.reader(recList, delimiter=',', quotechar='"')
-        print("Got ref csv reader")
-        firstfew=0;
-        for row in csv_reader:
-            if (firstrecord):
-                firstrecord=False
+        users = {}
+        report = {}
+        manifests = []
+        for key, role, parse_row in roster_files:
+            manifest = {'etag': None, 'rows': {}} if force else load_manifest(s3, key)
+            if manifest['etag'] is not None and s3.head_object(Bucket=roster_bucket, Key=key)['ETag'] == manifest['etag']:
+                print(f'{key}: unchanged since the last import, skipped')
+                report[key] = {'rows': len(manifest['rows']), 'added': 0, 'changed': 0,
+                    'unchanged': len(manifest['rows']), 'skipped': True}
                 continue
-            if (firstfew<10):
-                print(row)
-            if len(row)>2:
-                if len(row[0])>0:
-                    email = row[2]
-                    lastname = row[0]
-                    firstname = row[1]
-                    full_name = firstname + " " + lastname
-                    user_name = firstname[0] + lastname
-                    if (firstfew<10): print(f'email={email}, fullname={full_name}, username={user_name}')
-                    dal.insert_email(email, full_name, user_name, "REF")
-                    firstfew+=1
-        print('Ref Put succeeded:')
+            counts, etag, hashes = read_roster(s3, key, role, parse_row, users, manifest['rows'])
+            report[key] = counts
+            manifests.append((key, etag, hashes))
+        report['users'] = dal.bulk_upsert_users(users, roster_chunk_size)
+        for key, etag, hashes in manifests: #only once the database has the rows
+            save_manifest(s3, key, etag, hashes)
+        report['elapsed'] = round(time.monotonic()-start, 2)
+        print(f'Roster load succeeded: {report}')
+        return success(report)
     except Exception as e:
         return handle_error(e)
@@ -34,6 +34,11 @@ db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
 
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
 
+# open the FCM/Twilio connections while the container initializes
+if is_lambda_environment and NOTIFY_MODE == 'direct':
+    from helper.notify import prewarm
+    prewarm()
+
 message_valid_fields = ['problem_id', 'message_text']
 
 #-----------------------------------------------------------------------------------------------
@@ -0,0 +1,102 @@
+"""
+  Copyright 2020 Brian Rosen, All Rights Reserved.
+  Brian Rosen Licensing Statement:
+  Contact Author for license
+
+  Derived from work Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Amazon Licensing statement:
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import random
+from datetime import datetime
+from helper.dal import *
+from helper.lambdautils import *
+from helper.logger import get_logger
+from helper.notify import deliver_jobs, prewarm
+from helper.warmup import in_warm_window, windows_from_json
+
+logger = get_logger(__name__)
+
+database_name = os.getenv('DB_NAME')
+db_cluster_arn = os.getenv('DB_CLUSTER_ARN')
+db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
+
+dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
+
+# open the FCM/Twilio connections while the container initializes
+if is_lambda_environment:
+    prewarm()
+
+batch_size = int(os.getenv('OUTBOX_BATCH_SIZE', '25'))
+max_attempts = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '6'))
+lease_seconds = int(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+base_delay_seconds = 2
+max_delay_seconds = 300
+reserve_millis = 15000 # stop claiming when the invocation has less than this left
+
+#-----------------------------------------------------------------------------------------------
+# Retry schedule: exponential backoff with full jitter
+#-----------------------------------------------------------------------------------------------
+def retry_delay(attempts):
+    return random.uniform(base_delay_seconds, min(max_delay_seconds, base_delay_seconds * 2 ** attempts))
+
+#-----------------------------------------------------------------------------------------------
+# Lambda Entrypoint
+#-----------------------------------------------------------------------------------------------
+def handler(event, context):
+    try:
+        # The sweep schedule carries wakeup's warm windows; outside them leave the database alone so it
+        # can pause.  The post-commit invoke from message() carries no windows and always drains.
+        if event and 'warm_windows' in event and not in_warm_window(windows_from_json(event['warm_windows']), datetime.utcnow()):
+            return success({
+                'message': 'idle'
+            })
+        sent = 0
+        failed = 0
+        batches = 0
+        while context is None or context.get_remaining_time_in_millis() > reserve_millis:
+            rows = dal.claim_outbox(batch_size, max_attempts, lease_seconds)
+            if len(rows) == 0:
+                break
+            batches += 1
+            jobs = []
+            job_rows = []
+            duplicates = []
+            seen = set()
+            for row in rows:
+                if row['dedupe_key'] in seen:
+                    duplicates.append(row['outbox_id'])
+                    continue
+                seen.add(row['dedupe_key'])
+                jobs.append((row['channel'], row['payload']))
+                job_rows.append(row)
+            results = deliver_jobs(jobs)
+            done = duplicates + [row['outbox_id'] for row, result in zip(job_rows, results) if result['ok']]
+            failures = [(row['outbox_id'], retry_delay(row['attempts']), result.get('error', ''))
+                for row, result in zip(job_rows, results) if not result['ok']]
+            dal.complete_outbox(done)
+            dal.retry_outbox(failures)
+            sent += len(done)
+            failed += len(failures)
+        logger.info(f'outbox drained: batches={batches} sent={sent} failed={failed}')
+        return success({
+            'sent': sent,
+            'failed': failed
+        })
+    except Exception as e:
+        return handle_error(e)
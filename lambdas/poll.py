@@ -33,6 +33,10 @@ db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
 
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
 
+# FUSED_POLL=false falls back to the check_user / get_event_and_crew / poll sequence
+# for full polls; polls carrying a ?cursor= always take the fused incremental path
+fused_poll = os.getenv('FUSED_POLL', 'true').lower() != 'false'
+
 
 #-----------------------------------------------------------------------------------------------
 # Lambda Entrypoint
@@ -45,14 +49,33 @@ def handler(event, context):
         data = json.dumps(event)
         y = json.loads(data)
         sub = y['requestContext']['authorizer']['claims']['sub']
-        user_id,user_name,allowed_roles = dal.check_user(sub)
-        if user_id == 0:
-            return error(400, "no user found")
-        #find crew for user in event
-        event_id, crew_type = dal.get_event_and_crew(user_id)
-        problems, messages=dal.poll(user_id,event_id,crew_type)
-        output = {'problems': problems,
-          'messages': messages}
+        query = y.get('queryStringParameters') or {}
+        cursor = query.get('cursor') or None
+        if fused_poll or cursor is not None:
+            user_id, problems, messages, resolved, next_cursor, board_version = dal.poll_user(sub, cursor)
+            if user_id == 0:
+                return error(400, "no user found")
+            # resolved is None when the cursor was for another crew and this is a full poll instead
+            if cursor is not None and resolved is not None and not problems and not messages and not resolved:
+                return not_modified({'X-Poll-Cursor': next_cursor})
+            output = {'problems': problems,
+              'messages': messages,
+              'cursor': next_cursor,
+              'board_version': board_version}
+            if cursor is not None and resolved is None:
+                output['reset'] = True
+            elif cursor is not None:
+                output['resolved'] = resolved
+        else:
+            user_id,user_name,allowed_roles = dal.check_user(sub)
+            if user_id == 0:
+                return error(400, "no user found")
+            #find crew for user in event
+            event_id, crew_type = dal.get_event_and_crew(user_id)
+            problems, messages, board_version=dal.poll(user_id,event_id,crew_type)
+            output = {'problems': problems,
+              'messages': messages,
+              'board_version': board_version}
         logger.debug(f'Output: {output}')
         return success(output)
     except Exception as e:
@@ -36,11 +36,20 @@ db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
 
 receipt_valid_fields = ['message_id' ]
+receipt_batch_fields = ['message_ids', 'problem_id', 'up_to_message_id']
+max_batch_message_ids = 500
 
 #-----------------------------------------------------------------------------------------------
 # Input Validation
 #-----------------------------------------------------------------------------------------------
 def validate_receipt_input_parameters(event):
+    if any(field in event for field in receipt_batch_fields):
+        message_ids = event.get('message_ids', [])
+        if not isinstance(message_ids, list) or len(message_ids) > max_batch_message_ids:
+            raise ValueError('Invalid receipt input parameter: message_ids')
+        if not message_ids and event.get('problem_id') is None and event.get('up_to_message_id') is None:
+            raise ValueError('Invalid receipt input parameter: one of message_ids, problem_id or up_to_message_id is required')
+        return
     for field in receipt_valid_fields:
         if field not in event:
             raise ValueError(f'Invalid receipt input parameter: {field}')
@@ -61,6 +70,16 @@ def handler(event, context):
         user_id,user_name,allowed_roles = dal.check_user(sub)
         if user_id == 0:
             return error(400, "no user found")
+        if 'message_id' not in input_fields:
+            problem_id = input_fields.get('problem_id')
+            up_to_message_id = input_fields.get('up_to_message_id')
+            results = dal.receipts(user_id, [int(message_id) for message_id in input_fields.get('message_ids', [])],
+                int(problem_id) if problem_id is not None else None,
+                int(up_to_message_id) if up_to_message_id is not None else None)
+            return success({
+                'message': 'Messages acknowledged',
+                'results': results
+                })
         message_id = input_fields['message_id']
         works=dal.receipt(user_id, message_id)
         if works:
@@ -0,0 +1,71 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Single API entry point.  With ApiLayout=router the API Gateway routes all go to
+  this one function, which dispatches on method and resource path to the same
+  handler() the per-function layout deploys, so one warm pool of containers serves
+  every endpoint.  A handler module is imported the first time its route is hit
+  (or during init for the routes listed in ROUTER_PRELOAD), and all of them share
+  the container's database client.
+"""
+
+import importlib
+import os
+from helper import metrics
+from helper.lambdautils import *
+from helper.logger import get_logger
+
+logger = get_logger(__name__)
+
+# (method, resource path) -> handler module
+ROUTES = {
+    ('POST', '/stripcall/create_problem'): 'create_problem',
+    ('POST', '/stripcall/message'): 'message',
+    ('POST', '/stripcall/resolve_problem'): 'resolve_problem',
+    ('POST', '/stripcall/update_problem'): 'update_problem',
+    ('GET', '/stripcall/poll'): 'poll',
+    ('POST', '/stripcall/receipt'): 'receipt',
+    ('GET', '/stripcall/hello'): 'hello',
+    ('POST', '/stripcall/set_crew'): 'set_crew',
+    ('POST', '/stripcall/incoming_sms'): 'incoming_sms',
+    ('POST', '/stripcall/check_email'): 'check_email',
+}
+ROUTER_PRELOAD = os.getenv('ROUTER_PRELOAD', '') # comma separated handler modules to import during init, or 'all'
+
+_handlers = {}
+
+
+def route_handler(module_name):
+    handler = _handlers.get(module_name)
+    if handler is None:
+        handler = _handlers[module_name] = importlib.import_module(module_name).handler
+    return handler
+
+
+def resolve(event):
+    # 'resource' is the template path the request matched; 'path' is the fallback for direct invokes
+    path = (event.get('resource') or event.get('path') or '').rstrip('/')
+    method = (event.get('httpMethod') or '').upper()
+    module_name = ROUTES.get((method, path))
+    if module_name is not None:
+        return module_name, 200
+    if any(route_path == path for _, route_path in ROUTES):
+        return None, 405
+    return None, 404
+
+
+preload = list(dict.fromkeys(ROUTES.values())) if ROUTER_PRELOAD == 'all' else \
+    [name.strip() for name in ROUTER_PRELOAD.split(',') if name.strip()]
+for module_name in preload:
+    route_handler(module_name)
+
+#-----------------------------------------------------------------------------------------------
+# Lambda Entrypoint
+#-----------------------------------------------------------------------------------------------
+def handler(event, context):
+    module_name, status = resolve(event)
+    if module_name is None:
+        logger.info(f'no route for {event.get("httpMethod")} {event.get("resource") or event.get("path")}')
+        return error(status, 'Not Found' if status == 404 else 'Method Not Allowed')
+    metrics.set_handler(module_name)
+    return route_handler(module_name)(event, context)
@@ -23,8 +23,11 @@
 """
 import json
 import os
+import time
 import boto3
+from datetime import datetime
 from helper.dal import *
+from helper.warmup import parse_utc, plan_windows, schedule_report, windows_to_json, WARM_HORIZON_HOURS
 from helper.lambdautils import *
 from helper.logger import get_logger
 
@@ -36,18 +39,17 @@ db_cluster_id = os.getenv('DB_CLUSTER_ID')
 db_cluster_arn = os.getenv('DB_CLUSTER_ARN')
 db_credentials_secrets_store_arn = os.getenv('DB_CRED_SECRETS_STORE_ARN')
 dal = DataAccessLayer(database_name, db_cluster_arn, db_credentials_secrets_store_arn)
+wake_timeout = float(os.getenv('WAKE_TIMEOUT', '150')) # seconds to wait for Aurora to resume
+warm_rules = ['KeepAlive', 'OutboxWorkerSweep'] # schedule rules that may only run inside the warm windows
 
 
 def handler(event, context):
 
     try:
-        code = 1
-        loops = 0
-        while code == 1:
-            code, error_code, msg = dal.pokeme()
-            if loops > 40:  #about 3 seconds per iteration, 20 per minute
-                break
-            loops+=1
+        timeout = wake_timeout
+        if context:
+            timeout = min(timeout, context.get_remaining_time_in_millis()/1000 - 60) #leave time for the work below
+        code, error_code, msg = dal.wait_until_ready(timeout)
         if code==2:
             active_tournaments = dal.tourney()
             for record in active_tournaments:
@@ -62,27 +64,41 @@ def handler(event, context):
                         return error(400, "Could not change state")
             oldies = dal.old_events()
             for record in oldies:
-                if record['state']==1: #active
-                    event_id=record['event_id']
+                if record.state==1: #active
+                    event_id=record.event_id
                     print(f'Ending Tournament {event_id}')
-                    dal.cleanup(event_id)
+                    deadline = time.monotonic() + context.get_remaining_time_in_millis()/1000 - 30 if context else None
+                    counts = dal.cleanup(event_id, deadline=deadline)
+                    if not counts['complete']:
+                        continue #stays active, the next run resumes the cleanup
                     works = dal.change_state(event_id, 2) #finished
                     if not works:
                         return error(400, "Could not create problem")
-            # Create CloudWatchEvents client
+            # Plan the day's warm windows from the event calendar and hand them to the KeepAlive and
+            # outbox sweep rules, which are disabled on days without a window so Aurora can pause
+            now = datetime.utcnow()
+            events = [(parse_utc(start), parse_utc(end)) for start, end in dal.event_windows(WARM_HORIZON_HOURS)]
+            windows = plan_windows(events, now)
+            schedule = schedule_report(windows, now)
+            logger.info(f'warm-up schedule: {schedule}')
             cloudwatch_events=boto3.client('events')
             response = cloudwatch_events.list_rules()
             for rule in response["Rules"]:
                 name = rule["Name"]
-                if name.find("KeepAlive")>0:
-            # Put an event rule
-                    if len(active_tournaments)>0:
+                if any(name.find(marker)>0 for marker in warm_rules):
+                    targets = cloudwatch_events.list_targets_by_rule(Rule=name)['Targets']
+                    for target in targets:
+                        target['Input'] = json.dumps({'warm_windows': windows_to_json(windows)})
+                    if len(targets)>0:
+                        cloudwatch_events.put_targets(Rule=name, Targets=targets)
+                    if len(windows)>0:
                         response=cloudwatch_events.enable_rule(Name=name)
                     else:
                         response=cloudwatch_events.disable_rule(Name=name)
                     print(f'response={response}')
             return success({
-                'message': 'woke'
+                'message': 'woke',
+                'schedule': json.loads(schedule)
             })
         else:
             return error(400, "Could not wake database")
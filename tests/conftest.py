@@ -0,0 +1,42 @@
+"""
+  Copyright 2020 Brian Rosen.  All rights reserved.
+
+  Fixtures for the DAL behavior tests: every test gets a DataAccessLayer over its
+  own LocalRDSDataClient (helper/local_rdsdata.py) seeded with one active event
+  and an armorer crew.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+os.environ.setdefault('METRICS', 'off')
+os.environ.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+os.environ.pop('OUTBOX_WORKER_FUNCTION', None)
+
+from helper.dal import DataAccessLayer, crew_cache, user_cache
+from helper.local_rdsdata import LocalRDSDataClient
+
+FIXTURES = """
+INSERT INTO users(user_id, user_name, full_name, allowed_roles, sub, email, mobile) VALUES
+    (1001, 'system', 'System', 'ARM', NULL, NULL, NULL),
+    (1, 'armA', 'Armorer A', 'ARM', 'sub-a', 'a@example.com', '5550000001'),
+    (2, 'armB', 'Armorer B', 'ARM', 'sub-b', 'b@example.com', '5550000002');
+INSERT INTO events VALUES (1, 'NAC', 'NAC', '2020-01-01 00:00:00', '2099-01-01 00:00:00', 1, '5551234567');
+INSERT INTO crews(event_id, crew_type, user_id, sms) VALUES (1, 'ARM', 1, 0), (1, 'ARM', 2, 0);
+"""
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = LocalRDSDataClient(str(tmp_path / 'stripcall.sqlite'))
+    client.executescript(FIXTURES)
+    return client
+
+
+@pytest.fixture
+def dal(client):
+    user_cache.clear()
+    crew_cache.clear()
+    return DataAccessLayer('stripcall', 'cluster-arn', 'secret-arn', rdsdata_client=client)
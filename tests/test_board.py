@@ -0,0 +1,77 @@
+def problem_ids(board):
+    return [problem['problem_id'] for problem in board[1]]
+
+
+def test_changes_bump_the_version(dal):
+    assert dal.board(1, 'ARM') == (0, [])
+    first = dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    second = dal.create_problem(2, 1, 'ARM', 'B2', 'A10')
+    board = dal.board(1, 'ARM')
+    assert board[0] == 2
+    assert problem_ids(board) == [first, second]
+    assert dal.update_problem(1, first, 'ARM', 'C3', 'A11')
+    version, problems = dal.board(1, 'ARM')
+    assert version == 3
+    assert (problems[0]['strip'], problems[0]['problem_type'], problems[0]['reporter']) == ('C3', 'A11', 'armB')
+    assert dal.resolve_problem(1, first, 1)
+    board = dal.board(1, 'ARM')
+    assert board[0] == 4
+    assert problem_ids(board) == [second]
+
+
+def test_resolved_problem_leaves_the_board_alone(dal):
+    problem_id = dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    assert dal.resolve_problem(1, problem_id, 1)
+    assert dal.board(1, 'ARM') == (2, [])
+    assert dal.resolve_problem(1, problem_id, 1)
+    assert dal.update_problem(1, problem_id, 'ARM', 'D4', 'A11')
+    assert dal.board(1, 'ARM') == (2, [])
+
+
+def test_unknown_problem_leaves_the_board_alone(dal):
+    dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    assert not dal.update_problem(1, 999, 'ARM', 'C3', 'A11')
+    assert dal.board(1, 'ARM')[0] == 1
+
+
+def test_boards_are_per_crew(dal):
+    dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    dal.create_problem(2, 1, 'MED', 'B2', 'M00')
+    assert dal.board(1, 'ARM')[0] == 1
+    assert dal.board(1, 'MED')[0] == 1
+
+
+def test_cleanup_empties_the_board(dal):
+    dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    dal.create_problem(2, 1, 'ARM', 'B2', 'A10')
+    counts = dal.cleanup(1)
+    assert counts['board'] == 2
+    assert counts['complete']
+    assert dal.board(1, 'ARM') == (3, [])
+
+
+def test_resumed_cleanup_bumps_the_version(client, dal):
+    dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    # an earlier run deleted the last board rows and stopped at its deadline
+    client._conn.execute('DELETE FROM board_problems')
+    client._conn.commit()
+    counts = dal.cleanup(1)
+    assert counts['board'] == 0
+    assert counts['complete']
+    assert dal.board(1, 'ARM') == (2, [])
+
+
+def test_board_matches_open_problems(client, dal):
+    dal.create_problem(2, 1, 'ARM', 'A1', 'A00')
+    resolved = dal.create_problem(2, 1, 'ARM', 'B2', 'A10')
+    dal.create_problem(2, 1, 'ARM', 'C3', 'A20')
+    dal.resolve_problem(1, resolved, 1)
+    open_problems = client._conn.execute('SELECT p.problem_id, p.strip, p.problem_type, u.user_name FROM problems p'
+        ' INNER JOIN users u ON u.user_id = p.reporter_id'
+        ' WHERE p.event_id = 1 AND p.crew_type = \'ARM\' AND p.resolution_code IS NULL ORDER BY p.problem_id').fetchall()
+    board = dal.board(1, 'ARM')[1]
+    assert [(problem['problem_id'], problem['strip'], problem['problem_type'], problem['reporter'])
+        for problem in board] == open_problems
+    problems, _, version = dal.poll(1, 1, 'ARM')
+    assert problems == board
+    assert version == 4
@@ -0,0 +1,55 @@
+import pytest
+
+from helper.dal import DataAccessLayerException
+
+PROBLEM = """
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc) VALUES
+    (1, 1, 'ARM', 'A1', 'A00', 2, '2020-01-01 00:00:00');
+"""
+
+FAILING_OUTBOX = """
+CREATE TRIGGER outbox_fails BEFORE INSERT ON outbox BEGIN SELECT RAISE(ABORT, 'outbox unavailable'); END;
+"""
+
+
+@pytest.fixture
+def seeded(client, dal):
+    client.executescript(PROBLEM)
+    return dal
+
+
+def count(client, table):
+    return client._conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+def test_message_is_stored_with_its_deliveries(client, seeded):
+    assert seeded.message(2, 1, 'ARM', 1, 'on my way')
+    assert count(client, 'messages') == 1
+    assert count(client, 'receipts') == 2
+    assert count(client, 'outbox') == 1
+
+
+def test_outbox_failure_rolls_back_the_message(client, seeded):
+    client.executescript(FAILING_OUTBOX)
+    with pytest.raises(DataAccessLayerException):
+        seeded.message(2, 1, 'ARM', 1, 'on my way')
+    assert count(client, 'messages') == 0
+    assert count(client, 'receipts') == 0
+
+
+def test_unqueued_notifications_roll_back_the_message(client, seeded, monkeypatch):
+    monkeypatch.setattr(seeded, 'enqueue_notifications', lambda message_id, push, sms: False)
+    assert not seeded.message(2, 1, 'ARM', 1, 'on my way')
+    assert count(client, 'messages') == 0
+    assert count(client, 'receipts') == 0
+
+
+def test_outbox_failure_rolls_back_the_enclosing_unit(client, seeded):
+    client.executescript(FAILING_OUTBOX)
+    with pytest.raises(DataAccessLayerException):
+        with seeded.transaction():
+            assert seeded.create_problem(2, 1, 'ARM', 'B2', 'A10')
+            seeded.message(2, 1, 'ARM', 1, 'on my way')
+    assert count(client, 'problems') == 1
+    assert count(client, 'messages') == 0
+    assert seeded.board(1, 'ARM') == (0, [])
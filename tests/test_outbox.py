@@ -0,0 +1,34 @@
+PROBLEM = """
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc) VALUES
+    (1, 1, 'ARM', 'A1', 'A00', 2, '2020-01-01 00:00:00');
+INSERT INTO messages(message_id, event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc) VALUES
+    (1, 1, 'ARM', 1, 'one', 2, '2020-01-01 00:00:00');
+"""
+
+PUSH = {'topic': '1ARM', 'title': 'A1', 'body': 'one', 'message_id': 1}
+SMS = [{'from_tn': '5551234567', 'to_tn': '5550000001', 'body': 'one'}]
+
+
+def outbox(client):
+    return client._conn.execute('SELECT outbox_id, attempts, sent_time_utc IS NOT NULL, claim_id IS NOT NULL'
+        ' FROM outbox ORDER BY outbox_id').fetchall()
+
+
+def test_enqueue_dedupes(client, dal):
+    client.executescript(PROBLEM)
+    assert dal.enqueue_notifications(1, PUSH, SMS + SMS)
+    assert [(row[0], row[1]) for row in outbox(client)] == [(1, 0), (2, 0)]
+
+
+def test_claim_complete_retry(client, dal):
+    client.executescript(PROBLEM)
+    dal.enqueue_notifications(1, PUSH, SMS)
+    claimed = dal.claim_outbox(10, 5, 60)
+    assert [(row['outbox_id'], row['channel'], row['attempts']) for row in claimed] == [(1, 'push', 0), (2, 'sms', 0)]
+    assert claimed[1]['payload'] == SMS[0]
+    assert dal.claim_outbox(10, 5, 60) == [] # leased
+    assert dal.complete_outbox([1]) == 1
+    assert dal.retry_outbox([(2, 0, 'twilio timeout')]) == 1
+    assert outbox(client) == [(1, 0, 1, 0), (2, 1, 0, 0)]
+    assert dal.claim_outbox(10, 1, 60) == [] # out of attempts
+    assert [row['outbox_id'] for row in dal.claim_outbox(10, 5, 60)] == [2]
@@ -0,0 +1,110 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+UNREAD = """
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc) VALUES
+    (1, 1, 'ARM', 'A1', 'A00', 2, '2020-01-01 00:00:00');
+INSERT INTO board_problems(event_id, crew_type, problem_id, strip, problem_type, reporter) VALUES
+    (1, 'ARM', 1, 'A1', 'A00', 'armB');
+INSERT INTO boards(event_id, crew_type, version) VALUES (1, 'ARM', 1);
+INSERT INTO messages(message_id, event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc) VALUES
+    (1, 1, 'ARM', 1, 'one', 2, '2020-01-01 00:00:00');
+INSERT INTO receipts(receipt_id, event_id, problem_id, message_id, recipient_id) VALUES (10, 1, 1, 1, 1);
+"""
+
+# user 1 moves to the medical crew of event 2, which already has an open problem
+CREW_CHANGE = """
+INSERT INTO events VALUES (2, 'RJCC', 'RJCC', '2020-01-01 00:00:00', '2099-01-01 00:00:00', 1, '5557654321');
+UPDATE events SET state = 2 WHERE event_id = 1;
+DELETE FROM crews WHERE user_id = 1;
+INSERT INTO crews(event_id, crew_type, user_id, sms) VALUES (2, 'MED', 1, 0);
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc) VALUES
+    (2, 2, 'MED', 'C3', 'M00', 2, '2020-01-01 00:00:00');
+INSERT INTO board_problems(event_id, crew_type, problem_id, strip, problem_type, reporter) VALUES
+    (2, 'MED', 2, 'C3', 'M00', 'armB');
+"""
+
+
+@pytest.fixture
+def seeded(client, dal):
+    client.executescript(UNREAD)
+    return dal
+
+
+def db_time(seconds_ago):
+    return (datetime.utcnow() - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def poll_event(cursor=None):
+    return {'queryStringParameters': {'cursor': cursor} if cursor else None,
+        'requestContext': {'authorizer': {'claims': {'sub': 'sub-a'}}}}
+
+
+def test_full_poll(seeded):
+    user_id, problems, messages, resolved, cursor, board_version = seeded.poll_user('sub-a')
+    assert user_id == 1
+    assert [problem['problem_id'] for problem in problems] == [1]
+    assert [message['message_id'] for message in messages] == [1]
+    assert resolved is None
+    assert cursor.endswith('-1-ARM')
+    assert board_version == 1
+
+
+def test_late_commit_is_delivered(client, seeded):
+    cursor = seeded.poll_user('sub-a')[4]
+    # stamped (and given a lower receipt id) before the cursor was issued, committed after it
+    client._conn.execute('INSERT INTO messages(message_id, event_id, crew_type, problem_id, message_text, sender_id,'
+        ' sent_time_utc) VALUES (2, 1, \'ARM\', 1, \'late\', 2, ?)', (db_time(5),))
+    client._conn.execute('INSERT INTO receipts(receipt_id, event_id, problem_id, message_id, recipient_id)'
+        ' VALUES (5, 1, 1, 2, 1)')
+    client._conn.commit()
+    messages, resolved = seeded.poll_user('sub-a', cursor)[2:4]
+    assert [message['message_id'] for message in messages] == [2]
+    assert resolved == []
+
+
+def test_old_changes_are_not_repeated(seeded):
+    cursor = seeded.poll_user('sub-a')[4]
+    problems, messages, resolved = seeded.poll_user('sub-a', cursor)[1:4]
+    assert (problems, messages, resolved) == ([], [], [])
+
+
+def test_crew_change_forces_full_poll(client, seeded):
+    cursor = seeded.poll_user('sub-a')[4]
+    client.executescript(CREW_CHANGE)
+    _, problems, messages, resolved, next_cursor, _ = seeded.poll_user('sub-a', cursor)
+    assert [problem['problem_id'] for problem in problems] == [2]
+    assert messages == []
+    assert resolved is None
+    assert next_cursor.endswith('-2-MED')
+
+
+def test_cursor_without_crew_forces_full_poll(seeded):
+    problems, messages, resolved = seeded.poll_user('sub-a', '20200101000000-10')[1:4]
+    assert [problem['problem_id'] for problem in problems] == [1]
+    assert resolved is None
+
+
+def test_invalid_cursor(seeded):
+    with pytest.raises(ValueError):
+        seeded.poll_user('sub-a', '2020-10')
+
+
+def test_handler(client, seeded, monkeypatch):
+    import poll
+    monkeypatch.setattr(poll, 'dal', seeded)
+    response = poll.handler(poll_event(), None)
+    assert response['statusCode'] == 200
+    cursor = json.loads(response['body'])['cursor']
+    response = poll.handler(poll_event(cursor), None)
+    assert response['statusCode'] == 304
+    assert response['headers']['X-Poll-Cursor'].endswith('-1-ARM')
+    client.executescript(CREW_CHANGE)
+    response = poll.handler(poll_event(cursor), None)
+    assert response['statusCode'] == 200
+    output = json.loads(response['body'])
+    assert output['reset'] is True
+    assert 'resolved' not in output
+    assert [problem['problem_id'] for problem in output['problems']] == [2]
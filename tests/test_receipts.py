@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+MESSAGES = """
+INSERT INTO problems(problem_id, event_id, crew_type, strip, problem_type, reporter_id, reported_time_utc) VALUES
+    (1, 1, 'ARM', 'A1', 'A00', 2, '2020-01-01 00:00:00'),
+    (2, 1, 'ARM', 'B2', 'A10', 2, '2020-01-01 00:00:00');
+INSERT INTO messages(message_id, event_id, crew_type, problem_id, message_text, sender_id, sent_time_utc) VALUES
+    (1, 1, 'ARM', 1, 'one', 2, '2020-01-01 00:00:00'),
+    (2, 1, 'ARM', 1, 'two', 2, '2020-01-01 00:00:00'),
+    (3, 1, 'ARM', 2, 'three', 2, '2020-01-01 00:00:00'),
+    (4, 1, 'ARM', 2, 'four', 2, '2020-01-01 00:00:00');
+INSERT INTO receipts(event_id, problem_id, message_id, recipient_id) VALUES
+    (1, 1, 1, 1), (1, 1, 2, 1), (1, 2, 3, 1), (1, 2, 4, 1);
+"""
+
+
+@pytest.fixture
+def seeded(client, dal):
+    client.executescript(MESSAGES)
+    return dal
+
+
+def unread(client, user_id=1):
+    rows = client._conn.execute('SELECT message_id FROM receipts WHERE recipient_id = ? AND receipt_time_utc IS NULL'
+        ' ORDER BY message_id', (user_id,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def test_message_ids(client, seeded):
+    results = seeded.receipts(1, message_ids=[2, 9])
+    assert results == [{'message_id': 2, 'status': 'acknowledged'}, {'message_id': 9, 'status': 'not_found'}]
+    assert unread(client) == [1, 3, 4]
+    assert seeded.receipts(1, message_ids=[2]) == [{'message_id': 2, 'status': 'already_acknowledged'}]
+
+
+def test_problem_id(client, seeded):
+    results = seeded.receipts(1, problem_id=2)
+    assert sorted(result['message_id'] for result in results) == [3, 4]
+    assert unread(client) == [1, 2]
+
+
+def test_up_to_message_id(client, seeded):
+    results = seeded.receipts(1, up_to_message_id=3)
+    assert sorted(result['message_id'] for result in results) == [1, 2, 3]
+    assert unread(client) == [4]
+
+
+def test_problem_and_up_to_message_id(client, seeded):
+    seeded.receipts(1, problem_id=2, up_to_message_id=3)
+    assert unread(client) == [1, 2, 4]
+
+
+def test_no_selector_is_rejected(client, seeded):
+    with pytest.raises(ValueError):
+        seeded.receipts(1, message_ids=[])
+    assert unread(client) == [1, 2, 3, 4]
+
+
+def receipt_event(body):
+    return {'body': json.dumps(body), 'requestContext': {'authorizer': {'claims': {'sub': 'sub-a'}}}}
+
+
+def test_handler_rejects_empty_selector(client, seeded, monkeypatch):
+    import receipt
+    monkeypatch.setattr(receipt, 'dal', seeded)
+    response = receipt.handler(receipt_event({'message_ids': []}), None)
+    assert response['statusCode'] == 400
+    assert unread(client) == [1, 2, 3, 4]
+
+
+def test_handler_coerces_selectors(client, seeded, monkeypatch):
+    import receipt
+    monkeypatch.setattr(receipt, 'dal', seeded)
+    response = receipt.handler(receipt_event({'problem_id': '1', 'up_to_message_id': '2'}), None)
+    assert response['statusCode'] == 200
+    assert unread(client) == [3, 4]
+    response = receipt.handler(receipt_event({'problem_id': 'one'}), None)
+    assert response['statusCode'] == 400